@@ -6,22 +6,14 @@
 @date 2023年度
 @details EDTをPDCと結びつけて管理することを主とする
 """
-import platform
-import os
-env = '' # マイコンやOS
-
-if hasattr(os, 'name'):
-    env = platform.system() # Windows, Linux, Darwin
-elif hasattr(os, 'uname'):
-    env = os.uname().sysname # esp32, rp2
-else:
-    env = 'Windows'  # 何にもわからなければWindowsとするけど、多分ここには来ない
-
 if __name__ == '__main__':
+    from EchonetLite.Env import env
     from EchonetLite.utils import deepcopy_list
 elif __name__ == 'EchonetLite.PDCEDT':
+    from .Env import env
     from .utils import deepcopy_list
 else:
+    from Env import env
     from utils import deepcopy_list
 
 class PDCEDT():
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+"""!
+@file PropertyStore.py
+@brief SET可能なプロパティをファイルに保存して、再起動後に戻す
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details ファイル形式 (リトルエンディアン)
+         - ヘッダ '<4sBBH' : b'ELPS', バージョン, 予約0, レコード数
+         - レコード : EOJ 3byte, EPC 1byte, PDC 1byte, EDT PDC byte
+         - 末尾 '<I' : ここまでのCRC32
+         書き込みは一時ファイルに書いてから名前を変えるので、途中で電源が落ちても前の内容が残る。
+         Python 3.4.0 / MicroPython対応
+"""
+import os
+import struct
+
+if __name__ == '__main__':
+    from EchonetLite.Env import env
+elif __name__ == 'EchonetLite.PropertyStore':
+    from .Env import env
+else:
+    from Env import env
+
+if env == 'esp32' or env == 'rp2':
+    import ubinascii as binascii
+else:
+    import binascii
+
+
+class PropertyStore():
+    """!
+    @brief プロパティ保存ファイル
+    """
+    MAGIC = b'ELPS'
+    VERSION = 1
+    HEADER = '<4sBBH'
+
+    def __init__(self, path):
+        """!
+        @brief コンストラクタ
+        @param path (str) 保存先のファイル
+        """
+        self.path = path
+        self.last = None # 最後に読み書きした内容、同じなら書かない
+        self.writes = 0 # 実際に書いた回数
+
+    @staticmethod
+    def encode(records):
+        """!
+        @brief レコードをbytesにする
+        @param records list[(list[int], int, list[int])] (eoj, epc, edt)
+        @return bytes
+        """
+        buf = bytearray(struct.pack(PropertyStore.HEADER, PropertyStore.MAGIC, PropertyStore.VERSION, 0, len(records)))
+        for eoj, epc, edt in records:
+            buf += bytes(eoj)
+            buf.append(epc)
+            buf.append(len(edt))
+            buf += bytes(edt)
+        buf += struct.pack('<I', binascii.crc32(buf) & 0xffffffff)
+        return bytes(buf)
+
+    @staticmethod
+    def decode(blob):
+        """!
+        @brief bytesをレコードに戻す
+        @param blob (bytes)
+        @return list[(list[int], int, list[int])] | None 壊れていたらNone
+        """
+        size = struct.calcsize(PropertyStore.HEADER)
+        if len(blob) < size + 4:
+            return None
+        if struct.unpack('<I', blob[-4:])[0] != binascii.crc32(blob[:-4]) & 0xffffffff:
+            return None
+        magic, version, _, count = struct.unpack(PropertyStore.HEADER, blob[:size])
+        if magic != PropertyStore.MAGIC or version != PropertyStore.VERSION:
+            return None
+        records = []
+        i = size
+        end = len(blob) - 4
+        for _ in range(count):
+            if i + 5 > end or i + 5 + blob[i + 4] > end:
+                return None
+            pdc = blob[i + 4]
+            records.append((list(blob[i:i + 3]), blob[i + 3], list(blob[i + 5:i + 5 + pdc])))
+            i += 5 + pdc
+        return records
+
+    def load(self):
+        """!
+        @brief ファイルを一度で読んでレコードにする
+        @return list[(list[int], int, list[int])] 無いか壊れていたら空
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                blob = f.read()
+        except OSError:
+            return []
+        records = PropertyStore.decode(blob)
+        if records is None:
+            print("# PropertyStore.load() broken file, ignored:", self.path)
+            return []
+        self.last = blob
+        return records
+
+    def save(self, records):
+        """!
+        @brief レコードを書く。前回と同じなら書かない
+        @param records list[(list[int], int, list[int])]
+        @return bool 書いたらTrue
+        """
+        blob = PropertyStore.encode(records)
+        if blob == self.last:
+            return False
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(blob)
+        try:
+            os.rename(tmp, self.path)
+        except OSError: # 上書きできないファイルシステム
+            os.remove(self.path)
+            os.rename(tmp, self.path)
+        self.last = blob
+        self.writes += 1
+        return True
+
+
+if __name__ == '__main__':
+    print("===== PropertyStore.py 単体テスト")
+    s = PropertyStore('el_state_test.bin')
+    print(s.save([([0x01, 0x30, 0x01], 0x80, [0x30]), ([0x01, 0x30, 0x01], 0xb3, [0x1a])]), s.save([([0x01, 0x30, 0x01], 0x80, [0x30]), ([0x01, 0x30, 0x01], 0xb3, [0x1a])]))
+    print(PropertyStore('el_state_test.bin').load())
+    os.remove('el_state_test.bin')
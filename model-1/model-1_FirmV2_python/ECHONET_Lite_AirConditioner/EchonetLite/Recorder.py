@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+"""!
+@file Recorder.py
+@brief ECHONET Liteフレームの記録と読み出し
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details EchonetLiteの送受信フレームを時刻、方向、相手IPと一緒にバイナリログへ追記する。
+         ファイル形式(リトルエンディアン)
+         - ヘッダ 12byte: 'ELRC', version(1byte), 予約(3byte), 記録開始時刻[s](4byte)
+         - レコード 11byte + フレーム: 方向('R'|'T'), 前レコードからの経過[us](4byte), IPv4(4byte), 長さ(2byte), フレーム
+         Python 3.4.0 / MicroPython対応
+"""
+import time
+import struct
+
+if __name__ == '__main__':
+    from EchonetLite.Env import env
+elif __name__ == 'EchonetLite.Recorder':
+    from .Env import env
+else:
+    from Env import env
+
+MAGIC = b'ELRC'
+VERSION = 1
+HEADER = '<4sB3xI'
+HEADER_SIZE = 12
+RECORD = '<BI4sH'
+RECORD_SIZE = 11
+RX = 0x52 # 'R' 受信
+TX = 0x54 # 'T' 送信
+
+
+def _ipBytes(ip):
+    """!
+    @brief IPアドレス文字列を4byteにする内部関数
+    """
+    try:
+        return bytes([int(p) for p in ip.split('.')])
+    except ValueError:
+        return b'\x00\x00\x00\x00'
+
+def _ipString(b):
+    """!
+    @brief 4byteをIPアドレス文字列にする内部関数
+    """
+    return '{}.{}.{}.{}'.format(b[0], b[1], b[2], b[3])
+
+
+class Recorder():
+    """!
+    @brief 送受信フレームをバイナリログに追記する
+    @note EchonetLiteのoptions['recorder']か、el.recorderに設定するとrecvOnce()とsend()/sendMulti()で呼ばれる
+    """
+    def __init__(self, f):
+        """!
+        @brief コンストラクタ
+        @param f (str | file) ファイル名か、バイナリ書き込みで開いたファイル
+        """
+        if isinstance(f, str):
+            f = open(f, 'wb')
+        self.f = f
+        self.count = 0
+        self.last = self._now()
+        start = int(time.time())
+        self.f.write(struct.pack(HEADER, MAGIC, VERSION, start & 0xffffffff))
+
+    def _now(self):
+        """!
+        @brief マイクロ秒の時刻を返す内部関数
+        """
+        if env == 'esp32' or env == 'rp2':
+            return time.ticks_us()
+        return int(time.monotonic() * 1000000)
+
+    def record(self, direction, ip, data):
+        """!
+        @brief 1フレーム記録する
+        @param direction (int) RX | TX
+        @param ip (str) 相手のIPアドレス、送信ならあて先
+        @param data (bytes)
+        """
+        t = self._now()
+        if env == 'esp32' or env == 'rp2':
+            dt = time.ticks_diff(t, self.last)
+        else:
+            dt = t - self.last
+        self.last = t
+        if dt > 0xffffffff:
+            dt = 0xffffffff
+        elif dt < 0:
+            dt = 0
+        self.f.write(struct.pack(RECORD, direction, dt, _ipBytes(ip), len(data)))
+        self.f.write(data)
+        self.count += 1
+
+    def rx(self, ip, data):
+        """!
+        @brief 受信フレームを記録する
+        @param ip (str) 送信元
+        @param data (bytes)
+        """
+        self.record(RX, ip, data)
+
+    def tx(self, ip, data):
+        """!
+        @brief 送信フレームを記録する
+        @param ip (str) あて先
+        @param data (bytes)
+        """
+        self.record(TX, ip, data)
+
+    def flush(self):
+        """!
+        @brief ファイルに書き出す
+        """
+        self.f.flush()
+
+    def close(self):
+        """!
+        @brief ファイルを閉じる
+        """
+        self.f.close()
+
+
+def readRecords(f):
+    """!
+    @brief バイナリログを先頭から読むジェネレータ
+    @param f (str | file) ファイル名か、バイナリ読み込みで開いたファイル
+    @return generator (t_us, direction, ip, data) t_usは記録開始からの経過[us]
+    """
+    if isinstance(f, str):
+        f = open(f, 'rb')
+    head = f.read(HEADER_SIZE)
+    if len(head) < HEADER_SIZE:
+        raise ValueError("readRecords: file is too short")
+    magic, version, start = struct.unpack(HEADER, head)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("readRecords: not a recorder log, magic={} version={}".format(magic, version))
+    t = 0
+    while True:
+        rec = f.read(RECORD_SIZE)
+        if len(rec) < RECORD_SIZE:
+            return
+        direction, dt, ip, n = struct.unpack(RECORD, rec)
+        data = f.read(n)
+        if len(data) < n:
+            return # 書き込み途中で切れたレコード
+        t += dt
+        yield t, direction, _ipString(ip), data
+
+
+if __name__ == '__main__':
+    print("===== Recorder.py 単体テスト")
+    import io
+    buf = io.BytesIO()
+    r = Recorder(buf)
+    r.rx('192.168.1.10', bytes([0x10, 0x81, 0x00, 0x01, 0x05, 0xff, 0x01, 0x01, 0x30, 0x01, 0x62, 0x01, 0x80, 0x00]))
+    r.tx('224.0.23.0', bytes([0x10, 0x81, 0x00, 0x01, 0x01, 0x30, 0x01, 0x05, 0xff, 0x01, 0x73, 0x01, 0x80, 0x01, 0x30]))
+    buf.seek(0)
+    for rec in readRecords(buf):
+        print(rec)
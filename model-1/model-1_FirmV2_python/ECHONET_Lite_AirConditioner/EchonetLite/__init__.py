@@ -4,6 +4,8 @@
 @brief ECHONET Liteモジュールをインポートする
 @author SUGIMURA Hiroshi, Kanagawa Institute of Technology
 @date 2023年度
+@details 起動時のimportを減らすため、ここではEchonetLite本体だけを読む。
+         送受信路やEventLoopなどは EchonetLite.Transport、EchonetLite.EventLoop のようにモジュールからimportする
 """
 from .EchonetLite import EchonetLite, ELOBJ, PDCEDT
 #from EchonetLite.EchonetLite import *
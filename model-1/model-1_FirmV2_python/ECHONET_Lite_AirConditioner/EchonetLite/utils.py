@@ -28,8 +28,7 @@ def deepcopy_dict_pdcedt(src):
     if not src:
         return {}
     result = {}
-    # 遅延インポートでPDCEDTを取得
-    from PDCEDT import PDCEDT
+    # PDCEDTをimportすると循環するので、値のクラスのコピーコンストラクタを使う
     for key, value in src.items():
-        result[key] = PDCEDT(value)
+        result[key] = value.__class__(value)
     return result
@@ -4,14 +4,35 @@ import machine
 import sys
 import select
 import _thread
+import ubinascii
 
 class ESPWiFiConfigurator:
     """
     ESP32用 Wi-Fi設定・接続管理クラス
     シリアル通信経由でSSID/PASSの設定変更やリセットを受け付け、
     CSVファイルに保存して管理します。
+
+    CSVファイルの行:
+        1行目 T/F,SSID,PASS       デフォルト設定
+        2行目 T/F,SSID,PASS       シリアルから設定したもの
+        C,SSID,BSSID,チャンネル,IP,マスク,ゲートウェイ,DNS
+                                  前回つながったAPとDHCPで得た設定（自動で書く）
+        S,IP,マスク,ゲートウェイ,DNS  固定IPにする場合だけ手で書く（DHCPを待たない）
+    前回のAPが分かっていれば、スキャンせずにそのAPへ直接つなぐ。
+
+    シリアル入力は、attach()でEchonetLiteと同じEventLoopに登録すれば、文字が届いた時だけ読む。
+    auto_start=Trueなら従来どおり監視スレッドで100msごとに見る。
     """
-    def __init__(self, config_file="wifi_config.csv", default_ssid="SSID", default_pass="PASS", auto_start=True):
+    POLL_MS = 20 # 接続状態を確認する間隔
+    FAST_TIMEOUT_MS = 3000 # 前回のAPへ直接つなぐ時の待ち時間、だめならスキャンからやり直す
+    TIMEOUT_MS = 10000 # スキャンしてつなぐ時の待ち時間
+    # ファームウェアが一回のconnect()で自動的につなぎ直す回数
+    # ESP32ポートの既定は無制限で、その間status()はSTAT_CONNECTINGのままになり、失敗の理由が返らない
+    # 回数を決めると、使い切った時にSTAT_NO_AP_FOUNDなどが返るので、こちらで方法を切り替えられる
+    RECONNECTS = 2
+    MAX_LINE = 128 # シリアルから受け付ける1行の長さ
+
+    def __init__(self, config_file="wifi_config.csv", default_ssid="SSID", default_pass="PASS", auto_start=True, reuse_lease=False):
         """
         初期化処理
         Args:
@@ -19,11 +40,20 @@ class ESPWiFiConfigurator:
             default_ssid (str): デフォルトのSSID
             default_pass (str): デフォルトのパスワード
             auto_start (bool): 自動でシリアル監視スレッドを開始するかどうか
+                               Falseにした場合はattach()でEventLoopに登録する
+            reuse_lease (bool): 前回DHCPで得たIP設定をそのまま使い、DHCPを待たない
+                                （DHCPサーバが同じIPを払い出し続ける環境でだけ使う）
         """
         self.config_file = config_file
         self.default_ssid = default_ssid
         self.default_pass = default_pass
+        self.reuse_lease = reuse_lease
         self.running = False
+        self.connect_ms = None # 最後の接続にかかった時間
+        self.reconnects = 0 # reconnect()で試した回数
+        self.reconnect_ms = None # reconnect()で最後に試し始めた時刻
+        self.line_buf = '' # シリアルから読んだ、改行がまだ来ていない文字
+        self.loop = None
         
         # シリアル入力監視用のポーリングオブジェクト作成
         self.poll = select.poll()
@@ -51,6 +81,18 @@ class ESPWiFiConfigurator:
             self.update()
             time.sleep(0.1)
 
+    def attach(self, loop):
+        """
+        EventLoopにシリアル入力を登録する。監視スレッドは止める
+        文字が届いた時だけ呼ばれるので、スレッドも定期的な起床も要らない
+        Args:
+            loop (EventLoop): EchonetLiteと同じループ
+        """
+        self.stop_monitoring()
+        self.loop = loop
+        # 設定ファイルの書き込みエラーなどでEventLoopが止まらないよう、例外を捕まえるupdate()を登録する
+        loop.register(sys.stdin, self.update)
+
     def read_config_lines(self):
         """
         設定ファイル(CSV)から全行を読み込む
@@ -97,35 +139,175 @@ class ESPWiFiConfigurator:
                 return parts[1], parts[2]
         return self.default_ssid, self.default_pass
 
+    def read_cache(self, ssid):
+        """
+        前回つながった時のAPとIP設定を読み込む
+        Args:
+            ssid (str): 接続先SSID、前回と違えば使わない
+        Returns:
+            tuple: (bssid(bytes), channel(int), ifconfig(tuple))、無ければNone
+        """
+        for line in self.read_config_lines():
+            parts = line.strip().split(',')
+            if len(parts) >= 8 and parts[0] == 'C' and parts[1] == ssid:
+                try:
+                    return ubinascii.unhexlify(parts[2]), int(parts[3]), tuple(parts[4:8])
+                except ValueError:
+                    return None
+        return None
+
+    def read_static(self):
+        """
+        固定IPの設定を読み込む
+        Returns:
+            tuple: (ip, mask, gateway, dns)、無ければNone
+        """
+        for line in self.read_config_lines():
+            parts = line.strip().split(',')
+            if len(parts) >= 5 and parts[0] == 'S':
+                return tuple(parts[1:5])
+        return None
+
+    def save_cache(self, ssid, bssid, channel, ifconfig):
+        """
+        つながったAPとIP設定を保存する。前回と同じなら書かない（フラッシュの書き込みを減らす）
+        Args:
+            ssid (str): 接続先SSID
+            bssid (bytes): APのBSSID
+            channel (int): APのチャンネル
+            ifconfig (tuple): (ip, mask, gateway, dns)
+        """
+        row = f"C,{ssid},{ubinascii.hexlify(bssid).decode()},{channel},{','.join(ifconfig)}\n"
+        lines = self.read_config_lines()
+        if row in lines:
+            return
+        lines = [line for line in lines if not line.startswith('C,')]
+        lines.append(row)
+        self.save_config_lines(lines)
+
+    def scan_ap(self, wlan, ssid):
+        """
+        SSIDが同じAPのうち、一番電波の強いものを探す
+        Args:
+            wlan: network.WLAN
+            ssid (str): 接続先SSID
+        Returns:
+            tuple: (bssid, channel)、見つからなければ (None, None)
+        """
+        try:
+            aps = wlan.scan()
+        except OSError as e:
+            print(f"[ESP] Wi-Fi Scan Error: {e}")
+            return None, None
+        best = None
+        for ap in aps: # (ssid, bssid, channel, RSSI, security, hidden)
+            if ap[0] == ssid.encode() and (best is None or ap[3] > best[3]):
+                best = ap
+        if best is None:
+            return None, None
+        return best[1], best[2]
+
+    def wait_connected(self, timeout_ms=None, stop_on_fail=False):
+        """
+        Wi-Fiの接続を細かい間隔で確認して待つ
+        Args:
+            timeout_ms (int): 待つ時間、Noneならつながるまでreconnect()でつなぎ直しながら待つ
+            stop_on_fail (bool): パスワード違いやAPが見つからない時に、待たずに戻る
+        Returns:
+            bool: つながったらTrue
+        """
+        wlan = network.WLAN(network.STA_IF)
+        start = time.ticks_ms()
+        fails = (network.STAT_WRONG_PASSWORD, network.STAT_NO_AP_FOUND, network.STAT_CONNECT_FAIL)
+        while not wlan.isconnected():
+            if timeout_ms is not None and time.ticks_diff(time.ticks_ms(), start) >= timeout_ms:
+                return False
+            if stop_on_fail and wlan.status() in fails:
+                return False
+            if timeout_ms is None:
+                # 起動時にAPが止まっていても、RECONNECTSを使い切った後につなぎ直す
+                self.reconnect()
+            if not self.running and self.loop is None:
+                self.update() # つながらない間も設定コマンドを受け付ける
+            time.sleep_ms(self.POLL_MS)
+        return True
+
+    def try_connect(self, wlan, ssid, password, bssid, channel, timeout_ms):
+        """
+        一度だけ接続を試みる
+        Args:
+            wlan: network.WLAN
+            ssid (str): 接続先SSID
+            password (str): パスワード
+            bssid (bytes): 接続先APのBSSID、Noneならどれでもよい
+            channel (int): APのチャンネル、Noneなら指定しない
+            timeout_ms (int): 待つ時間
+        Returns:
+            bool: つながったらTrue
+        """
+        if channel:
+            try:
+                wlan.config(channel=channel)
+            except (OSError, ValueError):
+                pass # STAでチャンネルを指定できないファームウェア
+        try:
+            if bssid:
+                wlan.connect(ssid, password, bssid=bssid)
+            else:
+                wlan.connect(ssid, password)
+        except OSError as e:
+            print(f"[ESP] Wi-Fi Connection Error: {e}")
+            # エラー時もリトライや再設定のために処理を継続
+        return self.wait_connected(timeout_ms, stop_on_fail=True)
+
     def connect_wifi(self, ssid, password):
         """
         指定されたSSIDとパスワードでWi-Fiに接続する
+        前回つながったAPが分かっていればスキャンせずに直接つなぎ、だめならスキャンしてからつなぐ
         Args:
             ssid (str): 接続先SSID
             password (str): パスワード
         """
         wlan = network.WLAN(network.STA_IF)
         wlan.active(True)
-        
-        print(f"[ESP] Connecting... SSID={ssid}")
+        start = time.ticks_ms()
         try:
-            wlan.connect(ssid, password)
-        except OSError as e:
-            print(f"[ESP] Wi-Fi Connection Error: {e}")
-            # エラー時もリトライや再設定のために処理を継続
-        
-        # 接続待機 (最大10秒)
-        try_count = 0
-        while not wlan.isconnected() and try_count < 20:
-            time.sleep(0.5)
-            print(".", end="")
-            try_count += 1
-        print("") # 改行
+            wlan.config(reconnects=self.RECONNECTS)
+        except (OSError, ValueError):
+            pass # reconnectsが無いファームウェア、reconnect()は待ち時間で切り替える
+
+        cache = self.read_cache(ssid)
+        static = self.read_static()
+        lease = static is None and self.reuse_lease and cache is not None
+        if lease:
+            static = cache[2]
+        if static:
+            # DHCPを待たない
+            wlan.ifconfig(static)
+
+        connected = False
+        bssid, channel = None, None
+        if cache:
+            bssid, channel = cache[0], cache[1]
+            print(f"[ESP] Connecting... SSID={ssid} (cached AP, ch{channel})")
+            connected = self.try_connect(wlan, ssid, password, bssid, channel, self.FAST_TIMEOUT_MS)
+            if not connected:
+                # APが変わったかもしれないので、スキャンからやり直す
+                wlan.disconnect()
+                if lease:
+                    wlan.ifconfig('dhcp')
+        if not connected:
+            bssid, channel = self.scan_ap(wlan, ssid)
+            print(f"[ESP] Connecting... SSID={ssid}")
+            connected = self.try_connect(wlan, ssid, password, bssid, channel, self.TIMEOUT_MS)
 
         if wlan.isconnected():
             # 接続成功時、IPアドレスを表示
+            self.connect_ms = time.ticks_diff(time.ticks_ms(), start)
             ip = wlan.ifconfig()[0]
-            print(f"[ESP] Connected successfully. IP: {ip}")
+            print(f"[ESP] Connected successfully. IP: {ip} ({self.connect_ms} ms)")
+            if bssid:
+                self.save_cache(ssid, bssid, channel, wlan.ifconfig())
         else:
             # 接続失敗時のメッセージ表示
             print("[ESP] Failed to connect.")
@@ -134,6 +316,58 @@ class ESPWiFiConfigurator:
             print("SSID,PASS")
             print('[ESP] To reset Wi-Fi, type "RESET"')
 
+    def isconnected(self):
+        """
+        Wi-Fiにつながっているか（EchonetLiteのlinkとして使う）
+        Returns:
+            bool: つながっていればTrue
+        """
+        return network.WLAN(network.STA_IF).isconnected()
+
+    def local_addr(self):
+        """
+        今のIPアドレス
+        Returns:
+            str: IPアドレス
+        """
+        return network.WLAN(network.STA_IF).ifconfig()[0]
+
+    def reconnect(self):
+        """
+        切れたWi-Fiをつなぎ直す。待たずに戻るので、つながるまで何度も呼ぶ
+        前回のAPへの直接接続とスキャンしての接続を交互に試す
+        ESP32ポートではreconnectsを使い切るまでstatus()がSTAT_CONNECTINGを返す。
+        reconnectsを決められないファームウェアでは無制限でSTAT_CONNECTINGのままなので、
+        待ち時間を過ぎたらdisconnect()で止めてから次の方法に切り替える
+        """
+        wlan = network.WLAN(network.STA_IF)
+        now = time.ticks_ms()
+        if wlan.isconnected():
+            self.reconnects = 0
+            self.reconnect_ms = None
+            return
+        if wlan.status() == network.STAT_CONNECTING:
+            if self.reconnect_ms is None:
+                self.reconnect_ms = now # ファームウェアが自分でつなぎ直している
+            timeout_ms = self.FAST_TIMEOUT_MS if self.reconnects % 2 == 1 else self.TIMEOUT_MS
+            if time.ticks_diff(now, self.reconnect_ms) < timeout_ms:
+                return
+            wlan.disconnect()
+        ssid, password = self.load_config()
+        if len(ssid) == 0 or len(password) == 0:
+            ssid, password = self.default_ssid, self.default_pass
+        cache = self.read_cache(ssid)
+        self.reconnects += 1
+        self.reconnect_ms = now
+        print(f"[ESP] Reconnecting... SSID={ssid} ({self.reconnects})")
+        try:
+            if cache and self.reconnects % 2 == 1:
+                wlan.connect(ssid, password, bssid=cache[0])
+            else:
+                wlan.connect(ssid, password)
+        except OSError as e:
+            print(f"[ESP] Wi-Fi Connection Error: {e}")
+
     def process_input(self, input_str):
         """
         シリアルからの入力コマンドを処理する
@@ -159,7 +393,8 @@ class ESPWiFiConfigurator:
             else:
                 lines[1] = "F,,\n"
                 
-            self.save_config_lines(lines)
+            # 固定IPの設定は残し、前回のAPの情報は捨てる
+            self.save_config_lines([line for line in lines if not line.startswith('C,')])
             print("[ESP] Wi-Fi settings cleared.")
             print("[ESP] Rebooting...")
             time.sleep(1.5)
@@ -185,7 +420,8 @@ class ESPWiFiConfigurator:
                 # 2行目(Web設定)を有効(T)にし、新しい設定を保存
                 lines[1] = f"T,{new_ssid},{new_pass}\n"
                 
-                self.save_config_lines(lines)
+                # 固定IPの設定は残し、前回のAPの情報は捨てる
+                self.save_config_lines([line for line in lines if not line.startswith('C,')])
                 print(f"[ESP] Wi-Fi settings saved.: SSID={new_ssid}")
                 print("[ESP] Rebooting...")
                 time.sleep(1.5)
@@ -217,26 +453,40 @@ class ESPWiFiConfigurator:
             # デフォルト設定で接続
             self.connect_wifi(self.default_ssid, self.default_pass)
 
-    def update(self):
+    def update(self, stream=None):
         """
         メインループから定期的に呼び出す更新処理
         シリアル入力をノンブロッキングでチェックする
+        Args:
+            stream: EventLoopから渡されるストリーム（使わない）
+        """
+        try:
+            self.on_serial(stream)
+        except Exception as e:
+            print(f"[ESP] Serial Read Error: {e}")
+
+    def on_serial(self, stream=None):
+        """
+        届いている文字を読み、改行までそろったらコマンドとして処理する
+        行の途中で待たないように、読める文字だけを1文字ずつ読む
+        Args:
+            stream: EventLoopから渡されるストリーム（使わない）
         """
         # データがあるかチェック (timeout=0 で即時リターン)
-        events = self.poll.poll(0)
-        for fd, event in events:
-            if event & select.POLLIN:
-                try:
-                    line = sys.stdin.readline()
-                    if line:
-                        input_str = line.strip()
-                        if input_str:
-                            self.process_input(input_str)
-                except Exception as e:
-                    print(f"[ESP] Serial Read Error: {e}")
+        while self.poll.poll(0):
+            c = sys.stdin.read(1)
+            if not c:
+                break
+            if c == '\r' or c == '\n':
+                input_str = self.line_buf.strip()
+                self.line_buf = ''
+                if input_str:
+                    self.process_input(input_str)
+            elif len(self.line_buf) < self.MAX_LINE:
+                self.line_buf += c
 
 if __name__ == "__main__":
-    configurator = ESPWiFiConfigurator()
+    configurator = ESPWiFiConfigurator(auto_start=False)
     while True:
         configurator.update()
         time.sleep(0.2)
@@ -7,6 +7,7 @@ import os
 import time
 import network
 from EchonetLite import EchonetLite, PDCEDT
+from EchonetLite.EventLoop import EventLoop
 from machine import Pin, PWM
 import neopixel
 from Python_Serial_ESP_Wi_Fi_Configurator_Device import ESPWiFiConfigurator
@@ -250,7 +251,7 @@ def userSetFunc( ip, tid, seoj, deoj, esv, opc, epc, pdcedt):
             
             # 現在の風量設定を取得
             try:
-                fan_val = el.devices[0].GetPDCEDT(0xA0).getEDT()[0]
+                fan_val = el.devices['013001'].GetPDCEDT(0xA0).edt[0]
             except:
                 fan_val = 0x41
             
@@ -264,15 +265,15 @@ def userSetFunc( ip, tid, seoj, deoj, esv, opc, epc, pdcedt):
             
             # 現在のモードに対応した温度を取得（Arduino互換）
             try:
-                mode_val = el.devices[0].GetPDCEDT(0xB0).getEDT()[0]
+                mode_val = el.devices['013001'].GetPDCEDT(0xB0).edt[0]
                 if mode_val == 0x42:  # COOL
-                    temp_val = el.devices[0].GetPDCEDT(0xB5).getEDT()[0]
+                    temp_val = el.devices['013001'].GetPDCEDT(0xB5).edt[0]
                 elif mode_val == 0x43:  # HOT
-                    temp_val = el.devices[0].GetPDCEDT(0xB6).getEDT()[0]
+                    temp_val = el.devices['013001'].GetPDCEDT(0xB6).edt[0]
                 elif mode_val == 0x44:  # DRY
-                    temp_val = el.devices[0].GetPDCEDT(0xB7).getEDT()[0]
+                    temp_val = el.devices['013001'].GetPDCEDT(0xB7).edt[0]
                 else:  # AUTO or WIND
-                    temp_val = el.devices[0].GetPDCEDT(0xB3).getEDT()[0]
+                    temp_val = el.devices['013001'].GetPDCEDT(0xB3).edt[0]
                 el.update(deoj, 0xB3, [temp_val])
             except:
                 pass
@@ -346,7 +347,7 @@ def userSetFunc( ip, tid, seoj, deoj, esv, opc, epc, pdcedt):
             current_temp = pdcedt.edt[0]
             # 対応するモードの温度も更新
             try:
-                current_mode_val = el.devices[0].GetPDCEDT(0xB0).getEDT()[0]
+                current_mode_val = el.devices['013001'].GetPDCEDT(0xB0).edt[0]
                 if current_mode_val == 0x42:  # COOL
                     el.update(deoj, 0xB5, pdcedt.edt)
                 elif current_mode_val == 0x43:  # HOT
@@ -449,17 +450,25 @@ try:
     # setup
     # print('| IP:', connect() ) # WiFi接続
     
-    # Wi-Fi設定・接続管理クラスの初期化（自動的に接続試行とシリアル監視を開始）
-    wifi_configurator = ESPWiFiConfigurator(default_ssid=WIFI_SSID, default_pass=WIFI_PASS)
+    # Wi-Fi設定・接続管理クラスの初期化（自動的に接続試行）
+    # シリアルの設定コマンドは、つながるまではwait_connected()が、その後はEventLoopが受け付ける
+    wifi_configurator = ESPWiFiConfigurator(default_ssid=WIFI_SSID, default_pass=WIFI_PASS, auto_start=False)
     
-    # Wi-Fi接続待ち
+    # Wi-Fi接続待ち（細かい間隔で確認し、つながったらすぐに進む）
     wlan = network.WLAN(network.STA_IF)
-    while not wlan.isconnected():
-        time.sleep(1)
+    wifi_configurator.wait_connected()
     print('| IP:', wlan.ifconfig()[0])
 
     # EchonetLite 初期化（エアコンデバイスコード：0x013001）
-    el = EchonetLite([[0x01, 0x30, 0x01]])
+    # マルチキャストの要求への返信は最大200msばらし、マルチキャストのINFは毎秒5回までにする
+    # 受信はキューに積んでSETを先に処理する。他機器のINFであふれたらINFから捨てる
+    # NeoPixelとPWMの書き換えに時間がかかるので、Setはワーカースレッドで処理してその間もGETに答える
+    # Setの中のupdate()によるINFの送信と保存は、Setが終わってから受信ループのスレッドで行うのでinfRate、storeと一緒に使える
+    # (電気錠と違い、受信ループ以外のスレッドからupdate()はしないこと)
+    # コントローラが再送したSETは、ユーザ関数を呼ばずに覚えている返信を送り直す（同じSETを二度実行しない）
+    # SETされたプロパティはフラッシュに保存し、再起動時(begin)に戻す
+    # Wi-Fiが切れて戻ったら、受信ソケットを作り直してマルチキャストに参加し直し、D5を通知し直す
+    el = EchonetLite([[0x01, 0x30, 0x01]], {'replyJitter': 200, 'infRate': 5, 'recvQueue': 16, 'replyCache': 8, 'setWorker': True, 'store': '/el_state.bin', 'link': wifi_configurator})
     
     deoj = [0x01, 0x30, 0x01]  # デバイスオブジェクトコード
     
@@ -492,6 +501,10 @@ try:
     print("|------------------------")
 
     # loop
+    # 受信とシリアルの設定コマンドを同じEventLoopで待つ
+    loop = EventLoop()
+    el.attach(loop)
+    wifi_configurator.attach(loop)
     while True:
         el.recvProcess()
         time.sleep(0.01)
@@ -0,0 +1,24 @@
+#!/usr/bin/python3
+"""!
+@file Env.py
+@brief 動いている環境(マイコンやOS)を一度だけ調べる
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details 各モジュールがimportのたびに同じ判定をしないように、ここで調べたenvを共有する。
+         CPythonでは platform.system() と同じ値 (Windows, Linux, Darwin)、MicroPythonでは os.uname().sysname (esp32, rp2)。
+         platformモジュールはimportに時間がかかる(reなども読み込む)ので使わない。
+         Python 3.4.0 / MicroPython対応
+"""
+import os
+
+env = '' # マイコンやOS
+
+if hasattr(os, 'name'):
+    if os.name == 'nt':
+        env = 'Windows'
+    else:
+        env = os.uname().sysname # Linux, Darwin
+elif hasattr(os, 'uname'):
+    env = os.uname().sysname # esp32, rp2
+else:
+    env = 'Windows'  # 何にもわからなければWindowsとするけど、多分ここには来ない
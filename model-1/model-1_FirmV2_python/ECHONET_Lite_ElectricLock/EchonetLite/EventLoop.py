@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+"""!
+@file EventLoop.py
+@brief ソケットやシリアルの受信待ちとタイマをまとめて扱う軽量イベントループ
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details select.pollで待ち受けるので、データが来るまでCPUを使わない。
+         複数のEchonetLiteインスタンスを一つのループで動かすことができる。
+         Python 3.4.0 / MicroPython対応
+"""
+import time
+import select
+import heapq
+
+if __name__ == '__main__':
+    from EchonetLite.Env import env
+elif __name__ == 'EchonetLite.EventLoop':
+    from .Env import env
+else:
+    from Env import env
+
+
+class EventLoop():
+    """!
+    @brief イベントループクラス
+    @details registerで登録したストリームが読めるようになったらコールバックを呼び、
+             callLaterで登録した関数を指定時間後に呼ぶ
+    """
+    def __init__(self):
+        """!
+        @brief コンストラクタ
+        """
+        self.handlers = {}  # key -> (stream, callback)
+        self.timers = []    # heap [due_ms, seq, func, args]
+        self.seq = 0
+        self.running = False
+        self.stopping = False
+        self._clock = 0
+        self._last = 0
+        if env == 'esp32' or env == 'rp2':
+            self._last = time.ticks_ms()
+        if hasattr(select, 'poll'):
+            self.poller = select.poll()
+        else:
+            self.poller = None # Windowsはselect.selectで代用
+
+    def _key(self, stream):
+        """!
+        @brief ハンドラ辞書のキーを作る内部関数
+        @param stream (socket | stream)
+        @return int | object
+        @note CPythonのpollはfdを、MicroPythonのpollは登録したオブジェクトを返す
+        """
+        if env == 'esp32' or env == 'rp2':
+            return stream
+        return stream.fileno()
+
+    def now(self):
+        """!
+        @brief ループ内の単調増加時刻を返す
+        @return int|float ミリ秒
+        """
+        if env == 'esp32' or env == 'rp2':
+            t = time.ticks_ms()
+            self._clock += time.ticks_diff(t, self._last)
+            self._last = t
+            return self._clock
+        return time.monotonic() * 1000
+
+    def register(self, stream, callback):
+        """!
+        @brief 受信待ちするストリームを登録する
+        @param stream (socket | stream) 読み込み可能になるのを待つ対象
+        @param callback 読み込み可能になった時に callback(stream) として呼ばれる
+        """
+        self.handlers[self._key(stream)] = (stream, callback)
+        if self.poller is not None:
+            self.poller.register(stream, select.POLLIN)
+
+    def unregister(self, stream):
+        """!
+        @brief 受信待ちを解除する
+        @param stream (socket | stream)
+        """
+        key = self._key(stream)
+        if key in self.handlers:
+            del self.handlers[key]
+            if self.poller is not None:
+                self.poller.unregister(stream)
+
+    def callLater(self, delay_ms, func, *args):
+        """!
+        @brief 指定時間後に関数を呼ぶ
+        @param delay_ms (int) 遅延時間[ms]
+        @param func 呼び出す関数
+        @param args funcに渡す引数
+        @return list タイマのハンドル、cancelに渡すと取り消せる
+        """
+        self.seq += 1
+        timer = [self.now() + delay_ms, self.seq, func, args]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        """!
+        @brief callLaterで登録したタイマを取り消す
+        @param timer (list) callLaterの戻り値
+        """
+        timer[2] = None # ヒープからは取り出し時に捨てる
+
+    def stop(self):
+        """!
+        @brief runForeverを抜ける
+        """
+        self.running = False
+        self.stopping = True
+
+    def _runTimers(self):
+        """!
+        @brief 期限が来たタイマを実行し、次の期限までの待ち時間を返す内部関数
+        @return int 待ち時間[ms]、タイマが無ければ-1
+        @note タイマの中でcallLater(0, ...)したものは次の回に回す。繰り返し登録する処理があってもストリームの受信が止まらない
+        """
+        now = self.now()
+        due = []
+        while self.timers and (self.timers[0][2] is None or self.timers[0][0] <= now):
+            timer = heapq.heappop(self.timers)
+            if timer[2] is not None:
+                due.append(timer)
+        for timer in due:
+            if timer[2] is not None: # 先に実行したタイマで取り消されていない
+                timer[2](*timer[3])
+        if not self.timers:
+            return -1
+        wait = self.timers[0][0] - self.now()
+        if wait > 0:
+            return int(wait) + 1
+        return 0
+
+    def runOnce(self, timeout_ms=-1):
+        """!
+        @brief タイマとストリームを1回分処理する
+        @param timeout_ms (int) 最大待ち時間[ms]、-1なら次のタイマかデータが来るまで待つ
+        """
+        wait = self._runTimers()
+        if self.stopping: # タイマの中でstopされた
+            return
+        if wait < 0 and not self.handlers: # 待つものが無い
+            return
+        if wait < 0 or (0 <= timeout_ms < wait):
+            wait = timeout_ms
+        if self.poller is not None:
+            for ev in self.poller.poll(wait):
+                entry = self.handlers.get(ev[0])
+                if entry is not None:
+                    entry[1](entry[0])
+        else:
+            streams = [v[0] for v in self.handlers.values()]
+            if not streams:
+                time.sleep(wait / 1000 if wait >= 0 else 0.1)
+                return
+            readable = select.select(streams, [], [], wait / 1000 if wait >= 0 else None)[0]
+            for s in readable:
+                entry = self.handlers.get(self._key(s))
+                if entry is not None:
+                    entry[1](entry[0])
+
+    def runForever(self):
+        """!
+        @brief stopされるまでループを回す
+        """
+        self.running = True
+        self.stopping = False
+        while self.running:
+            self.runOnce()
+
+
+if __name__ == '__main__':
+    print("===== EventLoop.py 単体テスト")
+    loop = EventLoop()
+    start = loop.now()
+    loop.callLater(30, lambda: print("t2", int(loop.now() - start)))
+    loop.callLater(10, lambda: print("t1", int(loop.now() - start)))
+    t = loop.callLater(20, lambda: print("cancelled timer fired"))
+    loop.cancel(t)
+    loop.callLater(40, loop.stop)
+    loop.runForever()
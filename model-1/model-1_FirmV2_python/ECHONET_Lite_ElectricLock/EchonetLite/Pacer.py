@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+"""!
+@file Pacer.py
+@brief 送信頻度を抑えるトークンバケット
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details マルチキャストのINFが一斉に出るとWi-FiのAPで落とされやすいので、毎秒rate個、最大burst個まで連続で送れるようにする。
+         時刻はEventLoop.now()などのミリ秒の関数から取る。
+         Python 3.4.0 / MicroPython対応
+"""
+
+
+class TokenBucket():
+    """!
+    @brief トークンバケット
+    """
+    def __init__(self, rate, burst, clock):
+        """!
+        @brief コンストラクタ
+        @param rate (float) 毎秒補充するトークン数
+        @param burst (int) 貯められるトークン数
+        @param clock 現在時刻[ms]を返す関数
+        """
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.last = clock()
+
+    def _refill(self):
+        """!
+        @brief 経過時間分のトークンを補充する内部関数
+        """
+        now = self.clock()
+        dt = now - self.last
+        self.last = now
+        if dt > 0:
+            self.tokens = min(self.burst, self.tokens + dt * self.rate / 1000.0)
+
+    def take(self):
+        """!
+        @brief トークンを一つ使う
+        @return bool 使えたらTrue
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait(self):
+        """!
+        @brief 次のトークンが貯まるまでの時間
+        @return int [ms]
+        """
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return int((1 - self.tokens) * 1000 / self.rate) + 1
+
+
+if __name__ == '__main__':
+    print("===== Pacer.py 単体テスト")
+    t = [0]
+    b = TokenBucket(10, 3, lambda: t[0])
+    print([b.take() for _ in range(5)], b.wait()) # 3回だけ送れて、次は100ms後
+    t[0] += 100
+    print(b.take(), b.take())
@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+"""!
+@file ReplyCache.py
+@brief 返信済み要求のキャッシュ
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details コントローラは返信が届かないとGET/SETCを再送するので、同じ要求が2-3回届くことがある。
+         (ip, TID, SEOJ, ESV)ごとに要求のフレームと送った返信のbytesを覚えておき、短い時間内に
+         フレームが1バイトも違わない要求が来たら、ユーザ関数やハードウェアを動かさずに同じ返信を送り直す。
+         TIDを進めないコントローラもあるので、TIDが同じでも中身が違えば別の要求として扱う。
+         Python 3.4.0 / MicroPython対応
+"""
+import time
+
+if __name__ == '__main__':
+    from EchonetLite.Env import env
+elif __name__ == 'EchonetLite.ReplyCache':
+    from .Env import env
+else:
+    from Env import env
+
+
+class ReplyCache():
+    """!
+    @brief 件数上限つきのLRUキャッシュ
+    @note MicroPythonのdictは順序を保証しないので、順序はリストで持つ。件数は小さい前提
+    """
+    def __init__(self, size=16, window_ms=3000):
+        """!
+        @brief コンストラクタ
+        @param size (int) 覚えておく要求の数
+        @param window_ms (int) 重複とみなす時間[ms]
+        """
+        self.size = size
+        self.window_ms = window_ms
+        self.entries = {} # key -> [時刻ms, [(ip, bytes), ...], 要求のbytes]
+        self.order = [] # 古い順のkey
+        self.hits = 0
+
+    def _now(self):
+        """!
+        @brief ミリ秒の時刻を返す内部関数
+        """
+        if env == 'esp32' or env == 'rp2':
+            return time.ticks_ms()
+        return int(time.monotonic() * 1000)
+
+    def _age(self, t):
+        """!
+        @brief 登録からの経過[ms]を返す内部関数
+        """
+        if env == 'esp32' or env == 'rp2':
+            return time.ticks_diff(self._now(), t)
+        return self._now() - t
+
+    def get(self, key, request):
+        """!
+        @brief 時間内に同じ要求に返信済みならその返信を返す
+        @param key (tuple) (ip, tid, seoj, esv)
+        @param request (bytes) 要求のフレーム、覚えているものと全く同じ時だけ重複とみなす
+        @return list[(ip, bytes)] | None 返信しなかった要求(SETIの成功など)は空のリスト
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if self._age(entry[0]) > self.window_ms or entry[2] != request:
+            del self.entries[key]
+            self.order.remove(key)
+            return None
+        # 最近使ったものとして後ろへ
+        self.order.remove(key)
+        self.order.append(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, request, replies):
+        """!
+        @brief 返信を覚える
+        @param key (tuple) (ip, tid, seoj, esv)
+        @param request (bytes) 要求のフレーム
+        @param replies (list[(ip, bytes)])
+        """
+        if key in self.entries:
+            self.order.remove(key)
+        elif len(self.order) >= self.size:
+            del self.entries[self.order.pop(0)]
+        self.entries[key] = [self._now(), replies, request]
+        self.order.append(key)
+
+    def clear(self):
+        """!
+        @brief 全部忘れる
+        """
+        self.entries = {}
+        self.order = []
+
+
+if __name__ == '__main__':
+    print("===== ReplyCache.py 単体テスト")
+    c = ReplyCache(2, 100)
+    on = b'\x10\x81\x00\x01\x05\xff\x01\x01\x30\x01\x61\x01\x80\x01\x30'
+    off = on[:-1] + b'\x31'
+    c.put(('192.168.1.10', 1, 0x05ff01, 0x61), on, [('192.168.1.10', b'\x10\x81')])
+    c.put(('192.168.1.10', 2, 0x05ff01, 0x61), on, [])
+    print(c.get(('192.168.1.10', 1, 0x05ff01, 0x61), on))
+    c.put(('192.168.1.10', 3, 0x05ff01, 0x61), on, []) # tid 2 が追い出される
+    print(c.get(('192.168.1.10', 2, 0x05ff01, 0x61), on), c.order)
+    print(c.get(('192.168.1.10', 1, 0x05ff01, 0x61), off)) # TIDが同じでも中身が違えば別の要求
+    time.sleep(0.2)
+    print(c.get(('192.168.1.10', 3, 0x05ff01, 0x61), on), c.hits)
+
+    print("-- ワーカーのSetが終わる前に届いた再送")
+    from EchonetLite.EchonetLite import EchonetLite
+    from EchonetLite.EventLoop import EventLoop
+    from EchonetLite.Transport import MemoryNetwork, MemoryTransport
+    net = MemoryNetwork()
+    loop = EventLoop()
+    net.attach(loop)
+    calls = []
+    def setFunc(ip, tid, seoj, deoj, esv, opc, epc, pdcedt):
+        calls.append(epc)
+        time.sleep(0.05) # 再送が届くまで終わらない
+        return True
+    el = EchonetLite([[0x01, 0x30, 0x01]], {'transport': MemoryTransport(net), 'mac': [2, 0, 0, 0, 0, 1], 'replyCache': 8, 'setWorker': True})
+    el.update([0x01, 0x30, 0x01], 0x9e, [0x80])
+    el.begin(setFunc)
+    el.attach(loop)
+    ctl = MemoryTransport(net)
+    replies = []
+    ctl.bind(3610, lambda: replies.append(ctl.recv()[0]))
+    ctl.send(el.LOCAL_ADDR, on)
+    loop.callLater(10, ctl.send, el.LOCAL_ADDR, on) # 再送
+    loop.callLater(200, loop.stop)
+    loop.runForever()
+    el.worker.close()
+    print(calls, [r[10] == 0x71 and r[12:] == b'\x80\x00' for r in replies]) # [128] [True, True]
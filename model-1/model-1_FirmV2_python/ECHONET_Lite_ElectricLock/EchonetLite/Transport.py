@@ -0,0 +1,421 @@
+#!/usr/bin/python3
+"""!
+@file Transport.py
+@brief ECHONET Liteフレームの送受信路
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details EchonetLiteはここにあるTransportを通してフレームを送受信する。
+         - UDPTransport: 実際のUDP socket、224.0.23.0:3610
+         - MemoryTransport: 同一プロセス内のEchonetLite同士でフレームを渡す、システムコール無し
+         Transportは次のメソッドを持つ
+         - getLocalAddr() 自分のアドレス
+         - bind(port, callback) 受信開始、フレームが来たらcallback()が呼ばれるようにする
+         - recv() 受信済みフレームを一つ取り出す (bytes, ip) | None
+           直前にrecv()したフレームがマルチキャストで届いたかを lastMulticast (bool、分からなければNone) に入れる
+         - send(ip, buffer) ユニキャスト送信
+         - sendMulti(buffer) マルチキャスト送信
+         - attach(loop) EventLoopに受信待ちを登録する
+         - reopen() リンクが戻った後に、アドレスを取り直して受信し直す
+         - close()
+         socket, struct はUDPTransportを使う時にimportするので、MemoryTransportだけならsocketを読まない
+"""
+if __name__ == '__main__':
+    from EchonetLite.Env import env
+elif __name__ == 'EchonetLite.Transport':
+    from .Env import env
+else:
+    from Env import env
+
+if env == 'esp32' or env == 'rp2':
+    import network # for ip
+
+from collections import deque
+
+MULTICAST_GROUP = '224.0.23.0' # マルチキャストアドレス
+ECHONETport = 3610 # ECHONET Liteの規格port
+BUFFER_SIZE = 1500 # 受信バッファサイズ
+INADDR_ANY = 0x00000000 # MicroPython対応
+IPPROTO_IP = 0 # socket.IPPROTO_IP、recv()でsocketを引かないように
+# 受信パケットの宛先アドレスを取るオプション。CPythonのsocketに定数が無いことがあるのでLinuxの値を補う
+IP_PKTINFO_LINUX = 8
+
+
+def inet_aton(ip):
+    """!
+    @brief IPアドレスを 文字列からバイト列に変換する。MicroPythonのsocketにはinet_atonが無いので自作
+    @param ip str
+    @return bytes
+    """
+    parts = ip.split('.')
+    return bytes([int(part) for part in parts])
+
+
+class UDPTransport():
+    """!
+    @brief UDP socketによる送受信路
+    @note 受信ポート3610を占有する
+    """
+    def __init__(self, bindAddr=''):
+        """!
+        @brief コンストラクタ、受信ソケットを作ってマルチキャストに参加する
+        @param bindAddr (str) 受信bindアドレス、''は全インタフェース
+        """
+        self.bindAddr = bindAddr
+        self.port = ECHONETport
+        self.callback = None
+        self.bound = False
+        self.loop = None
+        self.lastMulticast = None # 直前の受信がマルチキャストか、分からなければNone
+        import struct
+        self.group = inet_aton(MULTICAST_GROUP)
+        self.mreq = struct.pack('4sL', self.group, INADDR_ANY)
+        self.pktinfoOpt = None
+        self._open()
+
+    def _open(self):
+        """!
+        @brief アドレスを取って受信ソケットを作り、マルチキャストに参加する内部関数
+        """
+        import socket
+        # ip 設定
+        if self.bindAddr != '':
+            self.localAddr = self.bindAddr
+        elif env == 'esp32' or env == 'rp2':
+            wlan = network.WLAN(network.STA_IF)
+            self.localAddr = wlan.ifconfig()[0]
+        else:
+            self.localAddr = self._get_local_ip()
+
+        # 受信ソケットの準備
+        self.rsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.bindAddr == '':
+            # 特定アドレスにbindする場合はマルチキャストを受信できないので、呼び出し側でまとめて受ける
+            self.rsock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, self.mreq)
+        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        # 宛先アドレスが取れればマルチキャストかどうか分かる(Linux)。MicroPythonには無い
+        self.pktinfoOpt = getattr(socket, 'IP_PKTINFO', IP_PKTINFO_LINUX if env == 'Linux' else None)
+        self.pktinfo = self.pktinfoOpt is not None and hasattr(self.rsock, 'recvmsg')
+        if self.pktinfo:
+            self.rsock.setsockopt(socket.IPPROTO_IP, self.pktinfoOpt, 1)
+        self.rsock.setblocking(False) # ノンブロッキング必須
+
+    def _get_local_ip(self):
+        """!
+        @brief ローカルIPアドレスを取得する
+        @return str ローカルIPアドレス
+        """
+        import socket
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.connect(('8.8.8.8', 80))
+            ip = s.getsockname()[0]
+            s.close()
+            return ip
+        except Exception:
+            return '127.0.0.1'
+
+    def getLocalAddr(self):
+        """!
+        @brief 自分のIPアドレス
+        @return str
+        """
+        return self.localAddr
+
+    def bind(self, port, callback=None):
+        """!
+        @brief 受信開始
+        @param port (int)
+        @param callback 受信データがある時に呼ぶ関数、引数なし
+        """
+        self.port = port
+        self.callback = callback
+        self.rsock.bind((self.bindAddr, port))
+        self.bound = True
+
+    def attach(self, loop):
+        """!
+        @brief EventLoopにrsockを登録する
+        @param loop (EventLoop)
+        """
+        self.loop = loop
+        loop.register(self.rsock, lambda s: self.callback())
+
+    def reopen(self):
+        """!
+        @brief リンクが戻った後に、アドレスを取り直して受信ソケットを作り直す
+        @details 古いソケットのマルチキャスト参加は切れる前のインタフェースに残ったままなので、閉じて参加し直す
+        """
+        if self.loop is not None:
+            self.loop.unregister(self.rsock)
+        self.rsock.close()
+        self._open()
+        if self.bound:
+            self.rsock.bind((self.bindAddr, self.port))
+        if self.loop is not None:
+            self.attach(self.loop)
+
+    def recv(self):
+        """!
+        @brief 受信済みデータを一つ取り出す
+        @return (bytes, str) | None
+        """
+        if self.pktinfo:
+            try:
+                data, ancdata, flags, addr = self.rsock.recvmsg(BUFFER_SIZE, 64)
+            except OSError: # timeout
+                return None
+            self.lastMulticast = None
+            for level, kind, cdata in ancdata:
+                if level == IPPROTO_IP and kind == self.pktinfoOpt and len(cdata) >= 12:
+                    # struct in_pktinfo { ifindex, spec_dst, addr }、addrがIPヘッダの宛先
+                    self.lastMulticast = 224 <= cdata[8] <= 239
+            return data, addr[0]
+        try:
+            data, addr = self.rsock.recvfrom(BUFFER_SIZE)
+        except OSError: # timeout
+            return None
+        return data, addr[0]
+
+    def send(self, ip, buffer):
+        """!
+        @brief ユニキャスト送信
+        @param ip (str)
+        @param buffer (bytes)
+        """
+        import socket
+        ssock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # ssock.setsocketopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.bindAddr != '':
+            ssock.bind((self.bindAddr, 0)) # 送信元を自分のアドレスにする
+        ssock.sendto(buffer, (ip, self.port))
+        ssock.close()
+
+    def sendMulti(self, buffer):
+        """!
+        @brief マルチキャスト送信
+        @param buffer (bytes)
+        """
+        import socket
+        ssock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if env == 'esp32' or env == 'rp2':
+            # multiAddr = bytearray([224,0,23,0])
+            # ssock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, struct.pack('4sL', multiAddr))
+            ssock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            ssock.sendto(buffer, (MULTICAST_GROUP, self.port))
+            ssock.close()
+        else:
+            ssock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, inet_aton(self.localAddr))
+            if self.bindAddr != '':
+                ssock.bind((self.bindAddr, 0)) # 送信元を自分のアドレスにする
+            ssock.sendto(buffer, (MULTICAST_GROUP, self.port))
+            ssock.close()
+
+    def close(self):
+        """!
+        @brief 受信ソケットを閉じる
+        """
+        self.rsock.close()
+
+
+class MemoryNetwork():
+    """!
+    @brief MemoryTransport同士をつなぐプロセス内の仮想ネットワーク
+    @details 送信されたフレームは宛先の受信キューに積まれ、pump()か、attachしたEventLoopで処理される
+    """
+    def __init__(self, loopback=True, capacity=256):
+        """!
+        @brief コンストラクタ
+        @param loopback (bool) マルチキャストを送信元自身にも届けるか。実機のIP_MULTICAST_LOOPと同じくTrueが既定
+        @param capacity (int) 各ノードの受信キューの長さ、溢れたら捨てる
+        """
+        self.loopback = loopback
+        self.capacity = capacity
+        self.transports = {} # ip -> MemoryTransport、bind済みのもの
+        self.ready = deque((), 1 << 20) # フレームが届いたTransport、1フレームにつき1回積む
+        self.loop = None
+        self.scheduled = False
+        self.delivered = 0
+        self.dropped = 0
+        self.count = 0
+
+    def newAddr(self):
+        """!
+        @brief 未使用のアドレスを払い出す
+        @return str
+        """
+        self.count += 1
+        return '10.{}.{}.{}'.format((self.count >> 16) & 0xff, (self.count >> 8) & 0xff, self.count & 0xff)
+
+    def join(self, transport):
+        """!
+        @brief bindしたTransportを受信可能にする
+        @param transport (MemoryTransport)
+        """
+        self.transports[transport.ip] = transport
+
+    def leave(self, transport):
+        """!
+        @brief Transportを外す
+        @param transport (MemoryTransport)
+        """
+        if self.transports.get(transport.ip) is transport:
+            del self.transports[transport.ip]
+
+    def _push(self, transport, data, src, multicast=False):
+        """!
+        @brief 受信キューにフレームを積む内部関数
+        """
+        if len(transport.inbox) >= self.capacity:
+            self.dropped += 1
+            return
+        transport.inbox.append((data, src, multicast))
+        self.ready.append(transport)
+        self.delivered += 1
+        if self.loop is not None and not self.scheduled:
+            self.scheduled = True
+            self.loop.callLater(0, self._pumpFromLoop)
+
+    def unicast(self, src, dst, data):
+        """!
+        @brief ユニキャスト配送
+        @param src (str) 送信元アドレス
+        @param dst (str) 宛先アドレス
+        @param data (bytes)
+        """
+        transport = self.transports.get(dst)
+        if transport is None:
+            self.dropped += 1
+            return
+        self._push(transport, data, src)
+
+    def multicast(self, src, data):
+        """!
+        @brief マルチキャスト配送、bind済みの全Transportに届ける
+        @param src (str) 送信元アドレス
+        @param data (bytes)
+        """
+        for transport in list(self.transports.values()):
+            if transport.ip == src and not self.loopback:
+                continue
+            self._push(transport, data, src, True)
+
+    def pump(self, limit=-1):
+        """!
+        @brief 積まれたフレームを処理する
+        @param limit (int) 最大処理数、-1なら空になるまで。処理中に送られたフレームも処理する
+        @return int 処理したフレーム数
+        """
+        n = 0
+        while self.ready and n != limit:
+            transport = self.ready.popleft()
+            if transport.callback is not None:
+                transport.callback()
+            n += 1
+        return n
+
+    def attach(self, loop):
+        """!
+        @brief EventLoopで自動的にpumpする
+        @param loop (EventLoop)
+        """
+        self.loop = loop
+        if self.ready and not self.scheduled:
+            self.scheduled = True
+            loop.callLater(0, self._pumpFromLoop)
+
+    def _pumpFromLoop(self):
+        """!
+        @brief EventLoopから呼ばれるpump、ループを長く止めないように区切る内部関数
+        """
+        self.scheduled = False
+        self.pump(64)
+        if self.ready and not self.scheduled:
+            self.scheduled = True
+            self.loop.callLater(0, self._pumpFromLoop)
+
+
+class MemoryTransport():
+    """!
+    @brief MemoryNetworkにつながる送受信路
+    """
+    def __init__(self, net, ip=None):
+        """!
+        @brief コンストラクタ
+        @param net (MemoryNetwork)
+        @param ip (str) 自分のアドレス、Noneならnetから払い出す
+        """
+        self.net = net
+        self.ip = ip if ip else net.newAddr()
+        self.inbox = deque((), net.capacity + 1)
+        self.callback = None
+        self.bound = False
+        self.lastMulticast = None
+
+    def getLocalAddr(self):
+        """!
+        @brief 自分のアドレス
+        @return str
+        """
+        return self.ip
+
+    def bind(self, port, callback=None):
+        """!
+        @brief 受信開始
+        @param port (int) 使わない
+        @param callback 受信データがある時に呼ぶ関数、引数なし
+        """
+        self.callback = callback
+        self.net.join(self)
+        self.bound = True
+
+    def attach(self, loop):
+        """!
+        @brief EventLoopで受信処理する
+        @param loop (EventLoop)
+        """
+        self.net.attach(loop)
+
+    def reopen(self):
+        """!
+        @brief ネットワークに参加し直す。届いていたフレームは捨てる
+        """
+        while self.inbox: # MicroPythonのdequeにはclearが無い
+            self.inbox.popleft()
+        if self.bound:
+            self.net.leave(self)
+            self.net.join(self)
+
+    def recv(self):
+        """!
+        @brief 受信済みデータを一つ取り出す
+        @return (bytes, str) | None
+        """
+        if not self.inbox:
+            return None
+        data, src, self.lastMulticast = self.inbox.popleft()
+        return data, src
+
+    def send(self, ip, buffer):
+        """!
+        @brief ユニキャスト送信
+        @param ip (str)
+        @param buffer (bytes)
+        """
+        if ip == MULTICAST_GROUP:
+            self.net.multicast(self.ip, buffer)
+        else:
+            self.net.unicast(self.ip, ip, buffer)
+
+    def sendMulti(self, buffer):
+        """!
+        @brief マルチキャスト送信
+        @param buffer (bytes)
+        """
+        self.net.multicast(self.ip, buffer)
+
+    def close(self):
+        """!
+        @brief ネットワークから外れる
+        """
+        self.net.leave(self)
@@ -8,6 +8,7 @@ import time
 import network
 import _thread
 from EchonetLite import EchonetLite, PDCEDT
+from EchonetLite.EventLoop import EventLoop
 from machine import Pin, ADC
 from Python_Serial_ESP_Wi_Fi_Configurator_Device import ESPWiFiConfigurator
 
@@ -74,16 +75,20 @@ def recv_thread():
 # --- メイン ---
 try:
     
-    # Wi-Fi設定・接続管理クラスの初期化（自動的に接続試行とシリアル監視を開始）
-    wifi_configurator = ESPWiFiConfigurator(default_ssid=WIFI_SSID, default_pass=WIFI_PASS)
+    # Wi-Fi設定・接続管理クラスの初期化（自動的に接続試行）
+    # シリアルの設定コマンドは、つながるまではwait_connected()が、その後はEventLoopが受け付ける
+    wifi_configurator = ESPWiFiConfigurator(default_ssid=WIFI_SSID, default_pass=WIFI_PASS, auto_start=False)
     
-    # Wi-Fi接続待ち
+    # Wi-Fi接続待ち（細かい間隔で確認し、つながったらすぐに進む）
     wlan = network.WLAN(network.STA_IF)
-    while not wlan.isconnected():
-        time.sleep(1)
+    wifi_configurator.wait_connected()
     print('| IP:', wlan.ifconfig()[0])
     
-    el = EchonetLite([[0x02, 0x6F, 0x01]])
+    # マルチキャストの要求への返信は最大200msばらす
+    # INFはメインスレッドからも送るので、受信スレッドのループで待たせるinfRateは使わない
+    # 受信はキューに積んでSETを先に処理する。他機器のINFであふれたらINFから捨てる
+    # Wi-Fiが切れて戻ったら、受信ソケットを作り直してマルチキャストに参加し直し、D5を通知し直す
+    el = EchonetLite([[0x02, 0x6F, 0x01]], {'replyJitter': 200, 'recvQueue': 16, 'link': wifi_configurator})
 
     deoj = [0x02, 0x6F, 0x01]
 
@@ -104,6 +109,10 @@ try:
     el.begin(userSetFunc, userGetFunc, userInfFunc)
 
     # 受信スレッド開始
+    # 受信とシリアルの設定コマンドを受信スレッドの同じEventLoopで待つ
+    loop = EventLoop()
+    el.attach(loop)
+    wifi_configurator.attach(loop)
     _thread.start_new_thread(recv_thread, ())
     print("| 受信スレッド開始")
 
@@ -6,6 +6,8 @@
 @date 2023年度
 @details PDCEDTをEPCと結びつけて管理することを主とする
 """
+import _thread
+
 if __name__ == '__main__':
     from EchonetLite.utils import deepcopy_list, deepcopy_dict_pdcedt
     from EchonetLite.PDCEDT import PDCEDT
@@ -16,11 +18,18 @@ else:
     from utils import deepcopy_list, deepcopy_dict_pdcedt
     from PDCEDT import PDCEDT
 
+_writeLock = _thread.allocate_lock() # 書き込み同士の排他、読み出しには使わない
+
 
 class ELOBJ():
     """!
     @brief ELOBJクラス
     @details PDCEDTをEPCと結びつけて管理することを主とする
+    @note pdcedtsは公開したら書き換えないスナップショット。書き込みはコピーを作ってから差し替えるので、
+          受信スレッドはロックなしで読んでも書きかけのプロパティを見ない
+    @note 公開したPDCEDTも書き換えない。セッタは渡されたPDCEDTやリストを写した新しいPDCEDTを入れるので、
+          呼び出し側が後で書き換えても公開済みの値は変わらない。
+          []、GetPDCEDT、セッタの戻り値、snapshot()のPDCEDTは読むだけにし、変える時はSetEDTなどで差し替えること
     """
 
     def __init__(self, other = None):
@@ -76,11 +85,7 @@ class ELOBJ():
         if epc < 0x80 or epc > 0xff:
             raise ValueError("ELOBJ.__getitem__: epc must be 0x80-0xff, got {}".format(hex(epc)))
 
-        if epc in self.pdcedts:
-            # print('exist')
-            return self.pdcedts[epc]
-        else:
-            return None
+        return self.pdcedts.get(epc) # 一回だけ読むので、差し替えと競合しない
 
     def __setitem__(self, epc, pdcedt):
         """!
@@ -97,25 +102,20 @@ class ELOBJ():
         if not isinstance(pdcedt, PDCEDT):
             raise TypeError("ELOBJ.__setitem__: pdcedt must be PDCEDT, got {}".format(type(pdcedt).__name__))
 
-        self.pdcedts[epc] = pdcedt
-        return self.pdcedts[epc]
+        return self._publish(epc, PDCEDT(pdcedt))
 
     def GetPDCEDT(self, epc):
         """!
         @brief EPCに対応するPDCEDTを取得する
         @param epc int
-        @return PDCEDT | None
+        @return PDCEDT | None 公開中のものなので書き換えないこと
         """
         if not isinstance(epc, int):
             raise TypeError("ELOBJ.GetPDCEDT: epc must be int, got {}".format(type(epc).__name__))
         if epc < 0x80 or epc > 0xff:
             raise ValueError("ELOBJ.GetPDCEDT: epc must be 0x80-0xff, got {}".format(hex(epc)))
 
-        if epc in self.pdcedts:
-            # print('exist')
-            return self.pdcedts[epc]
-        else:
-            return None
+        return self.pdcedts.get(epc) # 一回だけ読むので、差し替えと競合しない
 
     def SetPDCEDT(self, epc, pdcedt):
         """!
@@ -130,14 +130,12 @@ class ELOBJ():
             raise ValueError("ELOBJ.SetPDCEDT: epc must be 0x80-0xff, got {}".format(hex(epc)))
 
         if isinstance(pdcedt, PDCEDT):
-            self.pdcedts[epc] = pdcedt
+            return self._publish(epc, PDCEDT(pdcedt)) # 呼び出し側のPDCEDTは公開しない
         elif isinstance(pdcedt, list):
-            self.pdcedts[epc] = PDCEDT(pdcedt)
+            return self._publish(epc, PDCEDT(pdcedt))
         else:
             raise TypeError("ELOBJ.SetPDCEDT: pdcedt must be PDCEDT or list, got {}".format(type(pdcedt).__name__))
 
-        return self.pdcedts[epc]
-
     def SetEDT(self, epc, edt):
         """!
         @brief EPCに対してEDTをセットする。この際、PDCは自動計算する
@@ -153,9 +151,29 @@ class ELOBJ():
         if not isinstance(edt, list):
             raise TypeError("ELOBJ.SetEDT: edt must be list, got {}".format(type(edt).__name__))
 
-        self.pdcedts[epc] = PDCEDT()
-        self.pdcedts[epc].setEDT(edt)
-        return self.pdcedts[epc]
+        pdcedt = PDCEDT() # 作り終えてから公開する
+        pdcedt.setEDT(edt[:]) # setEDTはリストをそのまま持つので、呼び出し側のリストと分ける
+        return self._publish(epc, pdcedt)
+
+    def _publish(self, epc, pdcedt):
+        """!
+        @brief pdcedtsのコピーにプロパティを入れて差し替える内部関数
+        @param epc int
+        @param pdcedt PDCEDT 他から参照されていない新しいもの
+        @return PDCEDT
+        """
+        with _writeLock:
+            pdcedts = dict(self.pdcedts)
+            pdcedts[epc] = pdcedt
+            self.pdcedts = pdcedts # 参照の代入は一度で終わる
+        return pdcedt
+
+    def snapshot(self):
+        """!
+        @brief 今のプロパティ一式を返す。複数のEPCを同じ時点の値で読みたい時に使う
+        @return dict[int, PDCEDT] 書き換えてはいけない
+        """
+        return self.pdcedts
 
     def GetMyPropertyMap(self, epc):
         """!
@@ -196,21 +214,13 @@ class ELOBJ():
             if val < 0x80 or val > 0xff:
                 raise ValueError("ELOBJ.SetMyPropertyMap: epcList[{}] must be 0x80-0xff, got {}".format(i, hex(val)))
 
-        if epc == 0x9d:
-            self.inf_property_map_raw = epcList
-        elif epc == 0x9e:
-            self.set_property_map_raw = epcList
-        elif epc == 0x9f:
-            self.get_property_map_raw = epcList
-        else:
+        if epc != 0x9d and epc != 0x9e and epc != 0x9f:
             raise ValueError("ELOBJ.SetMyPropertyMap: epc must be 0x9d, 0x9e or 0x9f, got {}".format(hex(epc)))
 
         n = len(epcList)
         if n < 16: # format 1
             pdcedt = PDCEDT()
-            epcList.insert(0, n)
-            pdcedt.setEDT(epcList)
-            self.pdcedts[epc] = pdcedt
+            pdcedt.setEDT([n] + epcList) # 呼び出し側のリストは書き換えない
         else: # format 2
             temp_edt = [0] * 17
             temp_edt[0] = n
@@ -220,8 +230,15 @@ class ELOBJ():
                 temp_edt[i] += flag
             pdcedt = PDCEDT()
             pdcedt.setEDT(temp_edt)
-            self.pdcedts[epc] = pdcedt
-        return self.pdcedts[epc]
+
+        # 一覧は新しいリストに差し替える
+        if epc == 0x9d:
+            self.inf_property_map_raw = epcList[:]
+        elif epc == 0x9e:
+            self.set_property_map_raw = epcList[:]
+        else:
+            self.get_property_map_raw = epcList[:]
+        return self._publish(epc, pdcedt)
 
     def hasInfProperty(self, epc):
         """!
@@ -7,44 +7,44 @@
 @details UDP socketやELOBJを管理することを主とする
 """
 
-import platform
-import os
 import sys
 
-env = '' # マイコンやOS
-
-if hasattr(os, 'name'):
-    env = platform.system() # Windows, Linux, Darwin
-elif hasattr(os, 'uname'):
-    env = os.uname().sysname # esp32, rp2
-else:
-    env = 'Windows'  # 何にもわからなければWindowsとするけど、多分ここには来ない
-
-if env == 'Linux' or env == 'Darwin' or env == 'Windows':
-    import uuid # for mac
-    import binascii
-    import traceback
-else:
-    import machine
-    import network # for ip
-    import ubinascii
-
-import time
-import socket
-import struct
-import re
+# uuid, re (getHwAddr), traceback (例外の表示), struct (snapshot/restore), network (getHwAddr), random (replyJitter) は
+# 使う所でimportして、起動時のimportを減らす
+# 送受信路やオプションの部品 (Transport, EventLoop, ReplyCache, Pacer, RecvQueue, Worker, PropertyStore, LinkWatcher) も
+# 使う時に_load()でimportする
 
 if __name__ == '__main__':
     print("unit test")
+    from EchonetLite.Env import env
     from EchonetLite.PDCEDT import PDCEDT
     from EchonetLite.ELOBJ import ELOBJ
 elif __name__ == 'EchonetLite.EchonetLite':
+    from .Env import env
     from .PDCEDT import PDCEDT
     from .ELOBJ import ELOBJ
 else:
+    from Env import env
     from PDCEDT import PDCEDT
     from ELOBJ import ELOBJ
 
+if env == 'esp32' or env == 'rp2':
+    import ubinascii
+else:
+    import binascii
+
+
+def _load(module, name):
+    """!
+    @brief パッケージの中のモジュールを使う時にimportする内部関数
+    @param module (str) モジュール名
+    @param name (str) モジュールから取り出す名前
+    @return モジュールの中のnameのもの
+    """
+    if __name__ == '__main__' or __name__ == 'EchonetLite.EchonetLite':
+        module = 'EchonetLite.' + module
+    return getattr(__import__(module, None, None, [name]), name)
+
 
 class EchonetLite():
     """!
@@ -82,6 +82,13 @@ class EchonetLite():
     INFC = 0x74		# INFC
     INFC_RES = 0x7a	# INFC_RES
     SETGET_RES = 0x7e	# SETGET_RES
+    REQUEST_ESVS = [0x60, 0x61, 0x62, 0x63, 0x6e, 0x74] # 返信を覚える要求 SETI, SETC, GET, INF_REQ, SETGET, INFC
+    INF_QUEUE = 16 # 送信待ちにできるマルチキャストINFの数、あふれたら古いものを捨てる
+    QUEUE_BUDGET = 4 # 受信キューから1回に処理するフレーム数、処理の合間にソケットを読む
+    WORKER_POLL = 5 # ワーカーの完了を確かめる間隔[ms]
+    STORE_MAX_DELAY = 10000 # SETが続いても、最初の変更からこの時間[ms]のうちには保存する
+    SNAPSHOT_MAGIC = b'ELSN' # snapshot()の形式
+    SNAPSHOT_VERSION = 1
     EOJ_Controller = [0x05, 0xff, 0x01] # EOJ:Controller
     EOJ_NodeProfile = [0x0e, 0xf0, 0x01] # EOJ:NodeProfileObject
     INADDR_ANY = 0x00000000 # MicroPython対応
@@ -91,8 +98,29 @@ class EchonetLite():
         """!
         @brief コンストラクタ
         @param eojs eoj[3]の配列、指定がなければコントローラとする
-        @param options デフォルトNone, future reserved
+        @param options デフォルトNone, dict
+            - debug (bool) デバッグ表示
+            - ip (str) 受信・送信に使うローカルIPアドレス。指定すると全インタフェースではなくこのアドレスにbindする
+            - mac (list[int]) 識別番号に使うMACアドレス6byte。指定がなければ自動取得
+            - transport (UDPTransport | MemoryTransport) 送受信路。指定がなければipを使ってUDPTransportを作る
+            - recorder (Recorder) 送受信フレームを記録する
+            - replyCache (int) 再送された要求に返信を送り直すために覚えておく要求の数、デフォルト0で使わない。
+              フレームが全く同じ要求だけを再送とみなす
+            - replyWindow (int) 再送とみなす時間[ms]、デフォルト3000
+            - replyJitter (int) マルチキャストで届いた要求への返信を0〜この時間[ms]ランダムに遅らせる、デフォルト0で遅らせない
+            - infRate (float) マルチキャストINFの送信を毎秒この数までに抑える、デフォルト0で抑えない
+            - infBurst (int) infRateで抑える前に連続で送れるINFの数、デフォルト3
+            - recvQueue (int) 受信キューの大きさ。指定すると受信と処理を分け、SET、GET、INFの順に処理する。デフォルト0で使わない
+            - queuePolicy (str) 受信キューがあふれた時の動作 'drop-new' | 'drop-old' | 'drop-lower'、デフォルト'drop-lower'
+            - setWorker (bool) Setのユーザ関数をワーカースレッドで呼び、終わってからSET_RES/SETC_SNAを返す。デフォルトFalse。
+              ユーザ関数の中でupdate()した時のINFの送信と保存の予約は、終わってからEventLoopのスレッドで行う
+            - store (str) SET可能なプロパティを保存するファイル。begin()で読み戻す。デフォルトNoneで保存しない
+            - storeDelay (int) 最後の変更から保存するまでの時間[ms]、デフォルト2000。続けて来たSETは1回の書き込みにまとめる
+            - link (ESPWiFiConfigurator など) isconnected()を持つリンク。切れて戻ったら送受信路を作り直して通知し直す。デフォルトNoneで見ない
+            - linkInterval (int) リンクを見る間隔[ms]、デフォルト1000
         @note eojsは一つの場合でも次のように配列として定義する [ EchonetLite.EOJ_Controller ]
+        @note ip, macは一つのプロセスで複数インスタンスを動かすシミュレータ向け
+        @note replyJitter, infRate, linkはEventLoopのタイマで動くので、attach()かrecvProcess()で動かした時だけ効く
         """
         # パラメータの検証
         if eojs is not None:
@@ -114,22 +142,92 @@ class EchonetLite():
 
         # optionsを内部に保持
         self.debug = False
+        self.bindAddr = '' # 受信bindアドレス、''は全インタフェース
+        mac = None
+        self.transport = None
+        self.recorder = None
+        cacheSize = 0
+        cacheWindow = 3000
+        self.replyJitter = 0
+        self.infRate = 0
+        self.infBurst = 3
+        queueSize = 0
+        queuePolicy = 'drop-lower'
+        setWorker = False
+        storePath = None
+        self.storeDelay = 2000
+        self.link = None
+        self.linkInterval = 1000
         if options:
             if "debug" in options and options["debug"] == True:
                 self.debug = True
+            if "ip" in options and options["ip"]:
+                self.bindAddr = options["ip"]
+            if "mac" in options and options["mac"]:
+                mac = options["mac"]
+                if not isinstance(mac, list) or len(mac) != 6:
+                    raise ValueError("EchonetLite: options['mac'] must be list of 6 int")
+            if "transport" in options and options["transport"] is not None:
+                self.transport = options["transport"]
+            if "recorder" in options and options["recorder"] is not None:
+                self.recorder = options["recorder"]
+            if "replyCache" in options:
+                cacheSize = options["replyCache"]
+            if "replyWindow" in options:
+                cacheWindow = options["replyWindow"]
+            if "replyJitter" in options:
+                self.replyJitter = options["replyJitter"]
+            if "infRate" in options:
+                self.infRate = options["infRate"]
+            if "infBurst" in options:
+                self.infBurst = options["infBurst"]
+            if "recvQueue" in options:
+                queueSize = options["recvQueue"]
+            if "queuePolicy" in options:
+                queuePolicy = options["queuePolicy"]
+            if "setWorker" in options and options["setWorker"] == True:
+                setWorker = True
+            if "store" in options and options["store"]:
+                storePath = options["store"]
+            if "storeDelay" in options:
+                self.storeDelay = options["storeDelay"]
+            if "link" in options and options["link"] is not None:
+                self.link = options["link"]
+            if "linkInterval" in options:
+                self.linkInterval = options["linkInterval"]
 
         print("# EchonetLite.init()") if self.debug else '' # debug
 
-        # ip 設定
-        if env == 'esp32' or env == 'rp2':
-            wlan = network.WLAN(network.STA_IF)
-            self.LOCAL_ADDR = wlan.ifconfig()[0]
-        else:
-            self.LOCAL_ADDR = self._get_local_ip()
+        # 送受信路とip 設定
+        if self.transport is None:
+            self.transport = _load('Transport', 'UDPTransport')(self.bindAddr)
+        self.rsock = getattr(self.transport, 'rsock', None) # 互換のため
+        self.LOCAL_ADDR = self.transport.getLocalAddr()
 
         print("# Local IP:", self.LOCAL_ADDR) if self.debug else '' # debug
-        self.mac = self.getHwAddr()
+        self.mac = mac if mac is not None else self.getHwAddr()
         self.tid = [0,0]
+        self.rxErrors = 0 # 受信処理で起きた例外の数
+        self.replyCache = _load('ReplyCache', 'ReplyCache')(cacheSize, cacheWindow) if cacheSize else None
+        self.replies = None # 処理中の要求への返信を集める
+        self.replyTid = None
+        self.replyKey = None # 処理中の要求の返信キャッシュのキー
+        self.pendingSets = {} # ワーカーのSetが終わっていない要求 キー -> [終わっていない数, 待っている間に届いた再送の数]
+        self.holdReplies = False # Trueなら返信を集めるだけで送らない
+        self.loop = None
+        self.infPacer = None
+        self.infQueue = [] # ペーサで待たされているマルチキャストINF
+        self.infTimer = None
+        self.infDropped = 0 # 待ちがあふれて捨てたINFの数
+        self.rxQueue = _load('RecvQueue', 'RecvQueue')(queueSize, queuePolicy) if queueSize else None # 受信キュー、Noneなら受信したその場で処理する
+        self.queueTimer = None
+        self.worker = _load('Worker', 'Worker')() if setWorker else None # Set処理用のワーカー
+        self.workerEffects = None # ワーカーの中のupdate()で、後でINFの送信や保存の予約をするもの [(obj, epc)]
+        self.workerTimer = None
+        self.store = _load('PropertyStore', 'PropertyStore')(storePath) if storePath else None # プロパティの保存先
+        self.storeTimer = None
+        self.storeSince = None # 保存していない最初の変更の時刻、変更が無ければNone
+        self.linkWatcher = None # linkの監視、切れていた時間もここに残る
         self.devices = {}
         self.userSetFunc = self.dummyFuncion
         self.userGetFunc = self.dummyFuncion
@@ -178,15 +276,6 @@ class EchonetLite():
 
         self.println() if self.debug else '' # debug
 
-        # 受信ソケットの準備
-        self.rsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.group = self.inet_aton(EchonetLite.MULTICAST_GROUP)
-        self.mreq = struct.pack('4sL', self.group, EchonetLite.INADDR_ANY)
-        self.rsock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, self.mreq)
-        self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # self.rsock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
-        self.rsock.setblocking(False) # ノンブロッキング必須
-
     #  デストラクタ
     def __del__(self):
         """!
@@ -195,22 +284,8 @@ class EchonetLite():
         if hasattr(self, 'debug'):
             print("# EchonetLite.del()") if self.debug else '' # debug
         #  受信設定
-        if hasattr(self, 'rsock'):
-            self.rsock.close()
-
-    def _get_local_ip(self):
-        """!
-        @brief ローカルIPアドレスを取得する
-        @return str ローカルIPアドレス
-        """
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(('8.8.8.8', 80))
-            ip = s.getsockname()[0]
-            s.close()
-            return ip
-        except Exception:
-            return '127.0.0.1'
+        if hasattr(self, 'transport') and self.transport is not None:
+            self.transport.close()
 
     def dummyFuncion(self, ip, tid, seoj, deoj, esv, opc, epc, pdcedt):
         """!
@@ -245,37 +320,147 @@ class EchonetLite():
             self.userGetFunc = gfunc
         if ifunc != None:
             self.userInfFunc = ifunc
+        # 保存してあったプロパティを戻す。通知の前に済ませる
+        if self.store is not None:
+            self.restoreStore()
         # 受信設定
-        self.rsock.bind(('', self.ECHONETport))
-        # インスタンスリスト通知 D5
+        self.transport.bind(self.ECHONETport, self.recvOnce)
+        self.announce()
+        print("# EchonetLite.begin() end.") if self.debug else '' # debug
+
+    def announce(self):
+        """!
+        @brief ノードプロファイルのON通知とインスタンスリスト通知 D5 を送る
+        """
         seoj = self.EOJ_NodeProfile
         deoj = self.EOJ_NodeProfile
         if self.devices['0ef001'][0x80] != None:
             self.sendMultiOPC1(seoj, deoj, self.INF, 0x80, self.devices['0ef001'][0x80]) # ON通知
         if self.devices['0ef001'][0xd5] != None:
             self.sendMultiOPC1(seoj, deoj, self.INF, 0xd5, self.devices['0ef001'][0xd5]) # オブジェクトリスト通知
-        print("# EchonetLite.begin() end.") if self.debug else '' # debug
+
+    def relink(self, outage=0):
+        """!
+        @brief リンクが戻った時に、アドレスを取り直し、送受信路を作り直してマルチキャストに参加し直し、D5を通知し直す
+        @param outage (int) 切れていた時間[ms]、アドレスが変わっただけなら0
+        @note linkを指定するとLinkWatcherから呼ばれる
+        """
+        print("# EchonetLite.relink() outage[ms]:", outage) if self.debug else '' # debug
+        reopen = getattr(self.transport, 'reopen', None)
+        if reopen is not None:
+            reopen()
+        self.rsock = getattr(self.transport, 'rsock', None) # 互換のため
+        self.LOCAL_ADDR = self.transport.getLocalAddr()
+        print("# Local IP:", self.LOCAL_ADDR) if self.debug else '' # debug
+        self.announce()
 
     # 受信スレッド作成
     def recvProcess(self):
-        while True:
-            try:
-                data, ip = self.rsock.recvfrom(EchonetLite.BUFFER_SIZE)
-                # bytesを16進数文字列に変換する
-                self.returner(ip[0], list(data))
-            except OSError as error: # timeout
-                # 大事なExceptionをロギングするためにtimeoutはどけておく
-                # print("# EchonetLite.recv() timeout op.") if self.debug else '' # debug
-                continue
-            except Exception as error:
-                print("# Exception!! EchonetLite.recv() thread:", error)
+        """!
+        @brief 受信処理を回し続ける。戻らない
+        @note attach()していなければEventLoopを作る。返信の遅延やINFの送信もこのループで行う
+        """
+        if self.loop is None:
+            self.attach(_load('EventLoop', 'EventLoop')())
+        self.loop.runForever()
+
+    def attach(self, loop):
+        """!
+        @brief EventLoopに受信処理を登録する。begin()の後に呼ぶ
+        @param loop (EventLoop)
+        """
+        self.loop = loop
+        if self.infRate:
+            self.infPacer = _load('Pacer', 'TokenBucket')(self.infRate, self.infBurst, loop.now)
+        if self.storeSince is not None: # ループが無い間の変更
+            self.storeSince = None
+            self.persist()
+        self.transport.attach(loop)
+        if self.link is not None:
+            if self.linkWatcher is not None:
+                self.linkWatcher.stop()
+            self.linkWatcher = _load('LinkWatcher', 'LinkWatcher')(self.link, self.relink, self.linkInterval)
+            self.linkWatcher.attach(loop)
+
+    def recvOnce(self):
+        """!
+        @brief 受信済みのパケットを一つだけ処理する
+        @return bool  True=処理した, False=受信データなし
+        @note attach()でEventLoopに登録すると、データが来た時だけ呼ばれるのでビジーループにならない
+        @note 受信キューを使う場合は、受信済みのものをまとめてキューに積み、処理はEventLoopのタイマで行う
+        """
+        frame = self.transport.recv()
+        if frame is None:
+            # print("# EchonetLite.recv() timeout op.") if self.debug else '' # debug
+            return False
+        if self.rxQueue is not None:
+            self.enqueue(frame)
+            for _ in range(self.rxQueue.size - 1): # ソケットに溜まっている分も取り出しておく
+                frame = self.transport.recv()
+                if frame is None:
+                    break
+                self.enqueue(frame)
+            if self.loop is None:
+                self.processQueue(-1)
+            elif self.queueTimer is None:
+                self.queueTimer = self.loop.callLater(0, self.processQueue)
+            return True
+        if self.recorder is not None:
+            self.recorder.rx(frame[1], frame[0])
+        self.handleFrame(frame[1], frame[0])
+        return True
+
+    def enqueue(self, frame):
+        """!
+        @brief 受信したフレームを優先度をつけてキューに積む
+        @param frame (bytes, ip)
+        """
+        if self.recorder is not None:
+            self.recorder.rx(frame[1], frame[0])
+        data = frame[0]
+        level = self.rxQueue.classify(data[EchonetLite.ESV]) if len(data) > EchonetLite.ESV else self.rxQueue.INF
+        if not self.rxQueue.push(frame, level):
+            print("# EchonetLite.enqueue() queue full, dropped:", self.rxQueue.dropped) if self.debug else '' # debug
+
+    def processQueue(self, limit=QUEUE_BUDGET):
+        """!
+        @brief 受信キューから優先度の高い順に処理する。EventLoopのタイマから呼ばれる
+        @param limit (int) 処理するフレーム数、-1なら空になるまで
+        """
+        self.queueTimer = None
+        n = 0
+        while n != limit:
+            frame = self.rxQueue.pop()
+            if frame is None:
+                return
+            self.handleFrame(frame[1], frame[0])
+            n += 1
+        if len(self.rxQueue) and self.loop is not None: # 残りは次の回、その前にソケットを読む
+            self.queueTimer = self.loop.callLater(0, self.processQueue)
+
+    def handleFrame(self, ip, data):
+        """!
+        @brief 受信したフレームを処理する。例外はここで止める
+        @param ip (str)
+        @param data (bytes)
+        """
+        try:
+            # bytesを16進数文字列に変換する
+            self.returner(ip, list(data))
+        except Exception as error:
+            # 異常パケットが大量に来ても重くならないように、スタックトレースはデバッグ時だけ
+            self.rxErrors += 1
+            self.replies = None
+            self.holdReplies = False
+            if self.debug:
+                print("# Exception!! EchonetLite.handleFrame():", error)
                 if env == 'esp32' or env == 'rp2':
                     sys.print_exception(error)
                 else:
+                    import traceback
                     traceback.print_exception(error)
-            finally:
-                # print("# EchonetLite.recv() finally op.") if self.debug else '' # debug
-                pass
+            elif self.rxErrors & 0xff == 1: # 1回目と、その後は256回に1回
+                print("# Exception!! EchonetLite.handleFrame():", type(error).__name__, error, "count:", self.rxErrors)
 
     def update(self, obj, epc, edt):
         """!
@@ -292,9 +477,79 @@ class EchonetLite():
             self.devices[obj].SetMyPropertyMap(epc, edt)
         else:
             self.devices[obj].SetEDT(epc, edt)
-            self.checkInfAndSend(obj, epc)
+            if self.worker is not None and self.worker.inWorker():
+                # タイマや送信の状態はEventLoopのスレッドだけが触る。finishSetDetailでまとめて行う
+                self.workerEffects.append((obj, epc))
+            else:
+                self.updated(obj, epc)
         # print("# EchonetLite.update() end.") if self.debug else '' # debug
 
+    def updated(self, obj, epc):
+        """!
+        @brief プロパティを更新した後の処理、INFの送信と保存の予約
+        @param obj str
+        @param epc int
+        """
+        self.checkInfAndSend(obj, epc)
+        if self.store is not None and obj != '0ef001' and self.devices[obj].hasSetProperty(epc):
+            self.persist()
+
+
+    def persist(self):
+        """!
+        @brief プロパティの変更を保存するように予約する
+        @note 書き込みはEventLoopのタイマで行い、返信の処理中にはフラッシュに書かない。
+        続けて変更があれば待ち直すが、最初の変更からSTORE_MAX_DELAYを超えては待たない
+        """
+        if self.storeSince is None:
+            self.storeSince = self.loop.now() if self.loop is not None else 0 # ループが無ければ印だけ
+        if self.loop is None: # attach()で予約する
+            return
+        if self.storeTimer is not None:
+            self.loop.cancel(self.storeTimer)
+        delay = min(self.storeDelay, self.storeSince + EchonetLite.STORE_MAX_DELAY - self.loop.now())
+        self.storeTimer = self.loop.callLater(max(0, delay), self.flushStore)
+
+    def flushStore(self):
+        """!
+        @brief SET可能なプロパティをファイルに書く。EventLoopのタイマから呼ばれる
+        """
+        self.storeTimer = None
+        self.storeSince = None
+        records = []
+        for eoj in self.eojs:
+            obj = self.devices[self.getHexString(eoj)]
+            pdcedts = obj.snapshot()
+            for epc in obj.set_property_map_raw:
+                if epc in pdcedts:
+                    records.append((eoj, epc, pdcedts[epc].edt))
+        try:
+            if self.store.save(records):
+                print("# EchonetLite.flushStore() saved:", len(records)) if self.debug else '' # debug
+        except OSError as error:
+            print("# EchonetLite.flushStore() failed:", error)
+
+    def restoreStore(self):
+        """!
+        @brief 保存してあったプロパティを戻す
+        @details 先に保存してあった値をすべてdevicesに入れてから、ハードウェアにも反映するようにSETCとしてユーザ関数を呼ぶ。
+                 動作状態0x80は最後に呼ぶので、ユーザ関数は電源ONの処理の中でdevicesから他の設定を読める。
+                 ユーザ関数がFalseを返しても(電源OFF中は受け付けないなど)、devicesには保存してあった値を残す
+        """
+        restored = []
+        power = [] # 0x80は最後に呼ぶ
+        for eoj, epc, edt in self.store.load():
+            obj = self.devices.get(self.getHexString(eoj))
+            if obj is None or not obj.hasSetProperty(epc):
+                continue
+            now = obj[epc]
+            if now is not None and now.edt == edt:
+                continue
+            print("# EchonetLite.restoreStore()", self.getHexString(eoj), hex(epc), edt) if self.debug else '' # debug
+            obj.SetPDCEDT(epc, [len(edt)] + edt)
+            (power if epc == 0x80 else restored).append((eoj, epc, edt))
+        for eoj, epc, edt in restored + power:
+            self.userSetFunc(self.LOCAL_ADDR, [0, 0], EchonetLite.EOJ_Controller, eoj, EchonetLite.SETC, 1, epc, PDCEDT([len(edt)] + edt))
 
     #  送信
     def send(self, ip, message):
@@ -317,10 +572,11 @@ class EchonetLite():
         else:
             return
 
-        ssock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        # ssock.setsocketopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        ssock.sendto(buffer, (ip, self.ECHONETport))
-        ssock.close()
+        if self.replies is not None and buffer[2:4] == self.replyTid: # 要求への返信なら覚える
+            self.replies.append((ip, buffer))
+            if self.holdReplies: # 後でreturnerが遅らせて送る
+                return
+        self.transmit(ip, buffer)
         # print("# EchonetLite.send() end.") if self.debug else '' # debug
 
     def sendOPC1TID(self, ip, tid, seoj, deoj, esv, epc, pdcedt):
@@ -438,25 +694,82 @@ class EchonetLite():
 
         print("# EchonetLite.sendMulti() message:", message) if self.debug else '' # debug
 
+        if self.replies is not None and buffer[2:4] == self.replyTid: # 要求への返信なら覚える
+            self.replies.append((EchonetLite.MULTICAST_GROUP, buffer))
+            if self.holdReplies: # 後でreturnerが遅らせて送る
+                return
         try:
-            ssock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            if env == 'esp32' or env == 'rp2':
-                # multiAddr = bytearray([224,0,23,0])
-                # ssock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, struct.pack('4sL', multiAddr))
-                ssock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                ssock.sendto(buffer, (EchonetLite.MULTICAST_GROUP, EchonetLite.ECHONETport))
-                ssock.close()
-            else:
-                ssock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, self.inet_aton(self.LOCAL_ADDR))
-                ssock.sendto(buffer, (EchonetLite.MULTICAST_GROUP, EchonetLite.ECHONETport))
-                ssock.close()
+            self.transmit(EchonetLite.MULTICAST_GROUP, buffer, True)
         except Exception as error:
             print("except in sendMulti()")
             print(error)
-            sys.print_exception(error)
+            if env == 'esp32' or env == 'rp2':
+                sys.print_exception(error)
+            else:
+                import traceback
+                traceback.print_exception(error)
         # print("# EchonetLite.sendMulti() end.") if self.debug else '' # debug
 
 
+    def transmit(self, ip, buffer, multi=False):
+        """!
+        @brief 組み立て済みのフレームを送信路に渡す。マルチキャストのINFはペーサを通す
+        @param ip (str)
+        @param buffer (bytes)
+        @param multi (bool) Trueならマルチキャスト送信
+        """
+        if self.infPacer is not None and ip == EchonetLite.MULTICAST_GROUP and buffer[EchonetLite.ESV] == EchonetLite.INF:
+            if self.infQueue or not self.infPacer.take(): # 順番を守るため、待ちがあれば後ろに並ぶ
+                self.queueInf(buffer, multi)
+                return
+        if self.recorder is not None:
+            self.recorder.tx(ip, buffer)
+        if multi:
+            self.transport.sendMulti(buffer)
+        else:
+            self.transport.send(ip, buffer)
+
+    def queueInf(self, buffer, multi):
+        """!
+        @brief ペーサで止められたマルチキャストINFを待たせる
+        @param buffer (bytes)
+        @param multi (bool)
+        """
+        if len(self.infQueue) >= EchonetLite.INF_QUEUE:
+            self.infQueue.pop(0)
+            self.infDropped += 1
+            print("# EchonetLite.queueInf() queue full, dropped:", self.infDropped) if self.debug else '' # debug
+        self.infQueue.append((buffer, multi))
+        if self.infTimer is None:
+            self.infTimer = self.loop.callLater(self.infPacer.wait(), self.drainInf)
+
+    def drainInf(self):
+        """!
+        @brief トークンが貯まった分だけ待たせていたINFを送る。EventLoopのタイマから呼ばれる
+        """
+        self.infTimer = None
+        while self.infQueue and self.infPacer.take():
+            buffer, multi = self.infQueue.pop(0)
+            if self.recorder is not None:
+                self.recorder.tx(EchonetLite.MULTICAST_GROUP, buffer)
+            if multi:
+                self.transport.sendMulti(buffer)
+            else:
+                self.transport.send(EchonetLite.MULTICAST_GROUP, buffer)
+        if self.infQueue:
+            self.infTimer = self.loop.callLater(self.infPacer.wait(), self.drainInf)
+
+    def sendReplies(self, replies):
+        """!
+        @brief returnerで集めた返信をまとめて送る
+        @param replies list[(ip, bytes)]
+        """
+        for r in replies:
+            if r[0] == EchonetLite.MULTICAST_GROUP:
+                self.sendMulti(r[1])
+            else:
+                self.send(r[0], r[1])
+
     def sendMultiOPC1TID(self, tid, seoj, deoj, esv, epc, pdcedt):
         """!
         @brief OPCが1としてマルチキャスト、TID指定
@@ -602,6 +915,8 @@ class EchonetLite():
         @return bool
         """
         print("# EchonetLite.replySetDetail()") if self.debug else '' # debug
+        if self.worker is not None and self.loop is not None:
+            return self.deferSetDetail(ip, tid, seoj, deoj, esv, opc, details)
         success = True
         rep_details = {}  # 返信用のEPC,PDC,EDT[PDC]をすべて並べる
 
@@ -618,6 +933,21 @@ class EchonetLite():
                     else:
                         rep_details[epc] = PDCEDT([0]) # Setの成功はPDC=0
 
+        return self.sendSetResult(ip, tid, seoj, deoj, esv, opc, success, rep_details)
+
+    def sendSetResult(self, ip, tid, seoj, deoj, esv, opc, success, rep_details):
+        """!
+        @brief Setの結果を返信する内部関数
+        @param ip (str)
+        @param tid (list[int])
+        @param seoj (list[int]) 要求のSEOJ
+        @param deoj (list[int]) 要求のDEOJ
+        @param esv (int) 要求のESV
+        @param opc (int)
+        @param success (bool)
+        @param rep_details (dict)
+        @return bool success
+        """
         if success == False and esv == self.SETI:
             esv = EchonetLite.SETI_SNA
         elif success == False and esv == self.SETC:
@@ -633,6 +963,92 @@ class EchonetLite():
         # print("# EchonetLite.replySetDetail() end.") if self.debug else '' # debug
         return success
 
+    def deferSetDetail(self, ip, tid, seoj, deoj, esv, opc, details):
+        """!
+        @brief Setのユーザ関数をワーカーで呼び、終わったら返信する内部関数
+        @return bool 受け付けたらTrue、結果はfinishSetDetailで返す
+        @note 待っている間もGETなどの受信処理は続く。再送された要求ではユーザ関数を二重に呼ばず、
+              終わった時に再送の分も返信する
+        """
+        epcs = [] # ユーザ関数を呼ぶEPC
+        for epc in details:
+            if self.replySetDetail_sub(deoj, epc) != None:
+                epcs.append(epc)
+        # deojはreturnerのインスタンスループで書き換わるのでコピーしておく
+        request = (ip, tid[:], seoj[:], deoj[:], esv, opc, details, self.replies, self.replyKey)
+        if self.replyKey is not None:
+            pending = self.pendingSets.setdefault(self.replyKey, [0, 0])
+            pending[0] += 1
+        self.worker.submit(self.runSetFunc, request[:7] + (epcs,), lambda result, error: self.finishSetDetail(request, result, error))
+        if self.workerTimer is None:
+            self.workerTimer = self.loop.callLater(EchonetLite.WORKER_POLL, self.pollWorker)
+        return True
+
+    def runSetFunc(self, ip, tid, seoj, deoj, esv, opc, details, epcs):
+        """!
+        @brief ワーカースレッドでSetのユーザ関数を呼ぶ内部関数
+        @return (list[int], list[(str, int)], Exception|None) 成功したEPC、ユーザ関数の中でupdate()したプロパティ、ユーザ関数の例外
+        @note 例外の前にupdate()したものも通知するので、例外はここで受け止めて返す
+        """
+        ok = []
+        effects = self.workerEffects = []
+        error = None
+        try:
+            for epc in epcs:
+                if self.userSetFunc(ip, tid, seoj, deoj, esv, opc, epc, details[epc]) != False:
+                    ok.append(epc)
+        except Exception as e:
+            error = e
+        return ok, effects, error
+
+    def finishSetDetail(self, request, result, error):
+        """!
+        @brief ワーカーのSet処理が終わったら返信する内部関数。EventLoopのスレッドで呼ばれる
+        @param request (tuple) deferSetDetailで覚えた要求と返信キャッシュのリスト
+        @param result (tuple) runSetFuncの戻り値
+        @param error (Exception|None) ワーカーで起きた例外
+        """
+        ip, tid, seoj, deoj, esv, opc, details, replies, key = request
+        if error is None:
+            ok, effects, error = result
+        else:
+            ok, effects = [], []
+        # ユーザ関数の中でupdate()したプロパティのINFと保存の予約は、EventLoopのスレッドのここで行う
+        for obj, epc in effects:
+            self.updated(obj, epc)
+        if error is not None:
+            print("# Exception!! EchonetLite.runSetFunc():", type(error).__name__, error)
+            ok = []
+        success = True
+        rep_details = {}
+        for epc in details:
+            if epc in ok:
+                rep_details[epc] = PDCEDT([0]) # Setの成功はPDC=0
+            else:
+                rep_details[epc] = details[epc] # 失敗やプロパティ無しは要求の値を返却する
+                success = False
+        # 返信キャッシュに入っている要求なら、その返信として覚える
+        self.replies = replies
+        self.replyTid = bytes(tid)
+        self.sendSetResult(ip, tid, seoj, deoj, esv, opc, success, rep_details)
+        self.replies = None
+        pending = self.pendingSets.get(key)
+        if pending is not None:
+            pending[0] -= 1
+            if pending[0] == 0: # インスタンス0宛てなら全部のインスタンスが終わってから
+                del self.pendingSets[key]
+                for _ in range(pending[1]):
+                    self.sendReplies(replies)
+
+    def pollWorker(self):
+        """!
+        @brief ワーカーの完了を確かめる。EventLoopのタイマから呼ばれる
+        """
+        self.workerTimer = None
+        self.worker.poll()
+        if self.worker.pending:
+            self.workerTimer = self.loop.callLater(EchonetLite.WORKER_POLL, self.pollWorker)
+
 
     def replySetDetail_sub(self, eoj, epc):
         """!
@@ -718,14 +1134,14 @@ class EchonetLite():
         @param deoj list[int]
         @param esv int
         @param opc int
-        @param details dict
+        @param details dict parseDetails()の結果、GET部分に答える
         @return bool
         """
         print("# EchonetLite.replySetgetDetail()") if self.debug else '' # debug
         success = True
         rep_details = {}  # 返信用のEPC,PDC,EDT[PDC]をすべて並べる
 
-        for epc in details:
+        for epc in details['GET']:
             devProp = self.replyInfreqDetail_sub(deoj, epc)
             if devProp == None:
                 rep_details[epc] = PDCEDT([0]) # GetのエラーはPDC=0
@@ -737,11 +1153,11 @@ class EchonetLite():
         if success == True:
             # 成功したらマルチキャストでINF
             esv = EchonetLite.INF
-            self.sendDetails(EchonetLite.MULTICAST_GROUP, tid, deoj, seoj, esv, opc, rep_details)
+            self.sendDetails(EchonetLite.MULTICAST_GROUP, tid, deoj, seoj, esv, len(rep_details), rep_details)
         else:
             # 失敗したらユニキャストでINF_SNA
             esv = EchonetLite.INF_SNA
-            self.sendDetails(ip, tid, deoj, seoj, esv, opc, rep_details)
+            self.sendDetails(ip, tid, deoj, seoj, esv, len(rep_details), rep_details)
         # print("# EchonetLite.replySetgetDetail() end.") if self.debug else '' # debug
         return success
 
@@ -798,12 +1214,36 @@ class EchonetLite():
         # print("# EchonetLite.returner() packet is OK.") if self.debug else '' # debug
 
         # 受信データをまずは意味づけしておく
-        tid = data[EchonetLite.TID:EchonetLite.SEOJ]
-        seoj = data[EchonetLite.SEOJ:EchonetLite.DEOJ]
-        deoj = data[EchonetLite.DEOJ:EchonetLite.ESV]
-        esv = data[EchonetLite.ESV]
-        opc = data[EchonetLite.OPC]
-        details = self.parseDetails( esv, opc, data[EchonetLite.EPC:])
+        tid, seoj, deoj, esv, opc, details = self.decode(data)
+
+        # マルチキャストの要求には全機器が同時に返信するので、ばらけるように遅らせる
+        self.replies = None
+        hold = self.replyJitter > 0 and self.loop is not None and esv in EchonetLite.REQUEST_ESVS and self.isMulticastRequest(deoj)
+
+        # 再送された要求には、ユーザ関数を呼ばずに覚えている返信を送り直す
+        cacheKey = None
+        if self.replyCache is not None and esv in EchonetLite.REQUEST_ESVS:
+            cacheKey = (ip, (tid[0] << 8) | tid[1], (seoj[0] << 16) | (seoj[1] << 8) | seoj[2], esv)
+            request = bytes(data)
+            replies = self.replyCache.get(cacheKey, request)
+            pending = self.pendingSets.get(cacheKey)
+            if replies is not None and pending is not None:
+                # ワーカーのSetが終わっていないので、まだ返信が揃っていない。終わった時に再送にも返信する
+                print("# EchonetLite.returner() duplicate request, set pending") if self.debug else '' # debug
+                pending[1] += 1
+                return
+            if replies is not None:
+                print("# EchonetLite.returner() duplicate request, resend:", len(replies)) if self.debug else '' # debug
+                if hold:
+                    self.loop.callLater(self.getJitter(), self.sendReplies, replies)
+                else:
+                    self.sendReplies(replies)
+                return
+        if cacheKey is not None or hold:
+            self.replies = []
+            self.replyTid = bytes(tid)
+            self.replyKey = cacheKey
+            self.holdReplies = hold
 
         # print("tid:",tid, ", seoj:", seoj, ", deoj:", deoj, ", esv:", esv, ", opc:", opc)
 
@@ -819,7 +1259,7 @@ class EchonetLite():
             deoj[2] = i
 
             # デバイスオブジェクトあるか
-            if self.devices[ self.getHexString( deoj )] == None:
+            if self.devices.get( self.getHexString( deoj )) == None:
                 # ないのでDrop
                 print("# EchonetLite.returner() invalid DEOJ:", self.getHexString(deoj)) if self.debug else '' # debug
                 continue
@@ -855,6 +1295,49 @@ class EchonetLite():
             else:
                 print("# EchonetLite.returner() invalid ESV:", esv) if self.debug else '' # debug
 
+        if cacheKey is not None:
+            self.replyCache.put(cacheKey, request, self.replies)
+        if hold and self.replies:
+            self.loop.callLater(self.getJitter(), self.sendReplies, self.replies[:]) # 後からワーカーの返信が追加されることがあるのでコピー
+        self.replies = None
+        self.replyKey = None
+        self.holdReplies = False
+
+    def isMulticastRequest(self, deoj):
+        """!
+        @brief 受信中の要求がマルチキャストで届いたか
+        @param deoj list[int]
+        @return bool
+        @note 送信路が宛先を教えてくれない場合(MicroPython)は、インスタンス0宛てとノードプロファイル宛てをマルチキャストとみなす
+        """
+        multicast = getattr(self.transport, 'lastMulticast', None)
+        if multicast is not None:
+            return multicast
+        return deoj[2] == 0 or (deoj[0] == 0x0e and deoj[1] == 0xf0)
+
+    def getJitter(self):
+        """!
+        @brief 返信を遅らせる時間
+        @return int 0〜replyJitter [ms]
+        """
+        import random
+        return random.getrandbits(16) % (self.replyJitter + 1)
+
+
+    def decode(self, data):
+        """!
+        @brief 検査済みの受信データを意味づけする
+        @param data list[int]
+        @return tuple (tid, seoj, deoj, esv, opc, details) detailsはparseDetails()の結果
+        @note returner()とpcapなどのオフライン解析で共通に使う
+        """
+        tid = data[EchonetLite.TID:EchonetLite.SEOJ]
+        seoj = data[EchonetLite.SEOJ:EchonetLite.DEOJ]
+        deoj = data[EchonetLite.DEOJ:EchonetLite.ESV]
+        esv = data[EchonetLite.ESV]
+        opc = data[EchonetLite.OPC]
+        details = self.parseDetails( esv, opc, data[EchonetLite.EPC:])
+        return tid, seoj, deoj, esv, opc, details
 
     def parseDetails(self, esv, opc, details):
         """!
@@ -872,56 +1355,45 @@ class EchonetLite():
         if( esv == EchonetLite.GET or
            esv == EchonetLite.INF_REQ or
            esv == EchonetLite.INFC ):
-            i = 0
-            for _ in range(0,opc):
-                epc = details[i]
-                pdc = details[i+1]
-                gres[epc] = PDCEDT(details[i+1:i+pdc+2])
-                i += pdc+2
+            self.parseProperties(details, 0, opc, gres)
         elif( esv == EchonetLite.SETI or
-           esv == EchonetLite.SETC or
            esv == EchonetLite.SETC ):
-            i = 0
-            for _ in range(0,opc):
-                epc = details[i]
-                pdc = details[i+1]
-                sres[epc] = PDCEDT(details[i+1:i+pdc+2])
-                i += pdc+2
-        elif( esv == EchonetLite.SETGET ): # OPC計算おかしい
-            i = 0
-            for _ in range(0,opc):
-                epc = details[i]
-                pdc = details[i+1]
-                sres[epc] = PDCEDT(details[i+1:i+pdc+2])
-                i += pdc+2
-            for _ in range(0,opc):
-                epc = details[i]
-                pdc = details[i+1]
-                gres[epc] = PDCEDT(details[i+1:i+pdc+2])
-                i += pdc+2
+            self.parseProperties(details, 0, opc, sres)
+        elif( esv == EchonetLite.SETGET ):
+            # OPCSet個のSETの後に、OPCGetとOPCGet個のGETが続く
+            i = self.parseProperties(details, 0, opc, sres)
+            if i < len(details):
+                self.parseProperties(details, i + 1, details[i], gres)
         elif(  esv == EchonetLite.SETGET_RES or
                 esv == EchonetLite.SETGET_SNA):
-            i = 0
-            for _ in range(0,opc):
-                epc = details[i]
-                pdc = details[i+1]
-                ires[epc] = PDCEDT(details[i+1:i+pdc+2])
-                i += pdc+2
-            for _ in range(0,opc):
-                epc = details[i]
-                pdc = details[i+1]
-                ires[epc] = PDCEDT(details[i+1:i+pdc+2])
-                i += pdc+2
+            i = self.parseProperties(details, 0, opc, ires)
+            if i < len(details):
+                self.parseProperties(details, i + 1, details[i], ires)
         else: # *_SNA, *_RES, INF,
-            i = 0
-            for _ in range(0,opc):
-                epc = details[i]
-                pdc = details[i+1]
-                ires[epc] = PDCEDT(details[i+1:i+pdc+2])
-                i += pdc+2
+            self.parseProperties(details, 0, opc, ires)
         # print("# EchonetLite.parseDetails() end.") if self.debug else '' # debug
         return {'SET': sres, 'GET':gres, 'INF':ires}
 
+    def parseProperties(self, details, i, opc, res):
+        """!
+        @brief EPC, PDC, EDTをopc個読んでresに入れる内部関数
+        @param details (list[byte])
+        @param i (int) 最初のEPCの位置
+        @param opc (int)
+        @param res (dict) epc -> PDCEDT
+        @return int 続きの位置
+        @note PDCがdetailsを超えていたらそこで止める
+        """
+        size = len(details)
+        for _ in range(opc):
+            if i + 2 > size:
+                break
+            pdc = details[i+1]
+            if i + 2 + pdc > size:
+                break
+            res[details[i]] = PDCEDT(details[i+1:i+pdc+2])
+            i += pdc+2
+        return i
 
 
     def parsePropertyMap(self, pdcedt):
@@ -1006,10 +1478,11 @@ class EchonetLite():
             self.sendMultiOPC1(obj,EchonetLite.EOJ_Controller,EchonetLite.INF,epc,self.devices[obj][epc])
 
 
-    def verifyPacket(self, data):
+    def verifyPacket(self, data, checkEOJ=True):
         """!
         @brief 受信パケットの正常性チェック
         @param data (list)
+        @param checkEOJ (bool) Falseなら自分の持っていないDEOJあてのパケットも通す。キャプチャの解析用
         @return bool
         """
         # print("# EchonetLite.verifyPacket()") if self.debug else '' # debug
@@ -1031,14 +1504,12 @@ class EchonetLite():
 
         # EOJ もってなければDrop
         deoj = data[EchonetLite.DEOJ:EchonetLite.ESV]
-        if self.hasEOJs(deoj) == False:
+        if checkEOJ and self.hasEOJs(deoj) == False:
             print("# EchonetLite.verifyPacket() droped reason = DEOJ:", self.getHexString(data[EchonetLite.DEOJ:EchonetLite.ESV])) if self.debug else '' # debug
             return False
 
         esv = data[EchonetLite.ESV]
         opc = data[EchonetLite.OPC]
-        o = 0 # now opc
-        i = EchonetLite.PDC # data へのindex 、PDC から開始
 
         if (esv == EchonetLite.SETI_SNA or
             esv == EchonetLite.SETC_SNA or
@@ -1053,24 +1524,127 @@ class EchonetLite():
             esv == EchonetLite.INF or
             esv == EchonetLite.INFC or
             esv ==  EchonetLite.INFC_RES ):
-            # ここから慎重にメモリアクセス
-            # OPC
-            while o < opc:
-                if i > packetSize: # サイズ超えた
-                    print("# EchonetLite.verifyPacket() droped reason = OPC:", opc) if self.debug else '' # debug
-                    return False # 異常パケット
-                i += 2 + data[i] # 2 byte 固定(EPC,PDC) + edtでindex更新
-                o += 1
+            if self.verifyProperties(data, EchonetLite.EPC, opc) < 0:
+                print("# EchonetLite.verifyPacket() droped reason = OPC:", opc) if self.debug else '' # debug
+                return False # 異常パケット
         elif ( esv == EchonetLite.SETGET or
             esv == EchonetLite.SETGET_SNA or
             esv == EchonetLite.SETGET_RES ):
-            print("# EchonetLite.verifyPacket() SETGET noticed") if self.debug else '' # debug
-            return True
+            # OPCSet, EPC.., OPCGet, EPC.. の順
+            i = self.verifyProperties(data, EchonetLite.EPC, opc)
+            if i < 0 or i >= packetSize or self.verifyProperties(data, i + 1, data[i]) < 0:
+                print("# EchonetLite.verifyPacket() droped reason = SETGET OPC") if self.debug else '' # debug
+                return False # 異常パケット
         else:
             print("# EchonetLite.verifyPacket() droped reason = unknown:", data) if self.debug else '' # debug
             return False
         return True
 
+    def verifyProperties(self, data, i, opc):
+        """!
+        @brief EPC, PDC, EDTがopc個、パケットに収まっているか調べる内部関数
+        @param data (list)
+        @param i (int) 最初のEPCの位置
+        @param opc (int)
+        @return int 続きの位置、収まっていなければ-1
+        """
+        packetSize = len(data)
+        for _ in range(opc):
+            if i + 2 > packetSize: # EPC, PDCが無い
+                return -1
+            if data[i] < 0x80: # EPCは0x80-0xff
+                return -1
+            i += 2 + data[i + 1] # 2 byte 固定(EPC,PDC) + edtでindex更新
+        if i > packetSize: # EDTが足りない
+            return -1
+        return i
+
+    def snapshot(self):
+        """!
+        @brief devicesをすべてbytesにする。restore()で戻せる
+        @return bytes
+        @details 形式 (リトルエンディアン)
+            - ヘッダ '<4sBB' : b'ELSN', バージョン, オブジェクト数
+            - オブジェクト : EOJ 3byte, INF/SET/GETプロパティマップの一覧 (数1byte + EPC), プロパティ数 1byte, (EPC, PDC, EDT) の並び
+            - 末尾 '<I' : ここまでのCRC32
+        """
+        import struct
+        buf = bytearray(struct.pack('<4sBB', EchonetLite.SNAPSHOT_MAGIC, EchonetLite.SNAPSHOT_VERSION, len(self.devices)))
+        for k in self.devices:
+            obj = self.devices[k]
+            buf += bytes(int(k[i:i + 2], 16) for i in (0, 2, 4))
+            for raw in (obj.inf_property_map_raw, obj.set_property_map_raw, obj.get_property_map_raw):
+                buf.append(len(raw))
+                buf += bytes(raw)
+            pdcedts = obj.snapshot()
+            buf.append(len(pdcedts))
+            for epc in pdcedts:
+                edt = pdcedts[epc].edt
+                buf.append(epc)
+                buf.append(len(edt))
+                buf += bytes(edt)
+        buf += struct.pack('<I', self.crc32(buf))
+        return bytes(buf)
+
+    def restore(self, blob):
+        """!
+        @brief snapshot()のbytesからdevicesを作り直す
+        @param blob (bytes)
+        @note 別のインスタンスのsnapshot()でもよい。その場合eojsもそれに合わせる
+        """
+        import struct
+        if len(blob) < 10 or struct.unpack('<I', blob[-4:])[0] != self.crc32(blob[:-4]):
+            raise ValueError("EchonetLite.restore: broken snapshot")
+        magic, version, count = struct.unpack('<4sBB', blob[:6])
+        if magic != EchonetLite.SNAPSHOT_MAGIC or version != EchonetLite.SNAPSHOT_VERSION:
+            raise ValueError("EchonetLite.restore: unsupported snapshot {} v{}".format(magic, version))
+        end = len(blob) - 4
+        i = 6
+        devices = {}
+        eojs = []
+        try:
+            for _ in range(count):
+                eoj = list(blob[i:i + 3])
+                i += 3
+                obj = ELOBJ()
+                maps = []
+                for _ in range(3):
+                    n = blob[i]
+                    maps.append(list(blob[i + 1:i + 1 + n]))
+                    i += 1 + n
+                obj.inf_property_map_raw, obj.set_property_map_raw, obj.get_property_map_raw = maps
+                pdcedts = {}
+                n = blob[i]
+                i += 1
+                for _ in range(n):
+                    pdcedt = PDCEDT() # 検証済みのデータなのでsetEDTを通さずに詰める
+                    pdcedt.pdc = blob[i + 1]
+                    pdcedt.edt = list(blob[i + 2:i + 2 + pdcedt.pdc])
+                    pdcedt.length = pdcedt.pdc + 1
+                    pdcedts[blob[i]] = pdcedt
+                    i += 2 + pdcedt.pdc
+                obj.pdcedts = pdcedts
+                devices[self.getHexString(eoj)] = obj
+                if eoj != EchonetLite.EOJ_NodeProfile:
+                    eojs.append(eoj)
+        except IndexError:
+            raise ValueError("EchonetLite.restore: truncated snapshot")
+        if i != end or '0ef001' not in devices:
+            raise ValueError("EchonetLite.restore: broken snapshot")
+        self.devices = devices
+        self.eojs = eojs
+        self.instanceNumber = len(eojs)
+
+    def crc32(self, buf):
+        """!
+        @brief CRC32を計算する
+        @param buf (bytes|bytearray)
+        @return int
+        """
+        if env == 'esp32' or env == 'rp2':
+            return ubinascii.crc32(buf) & 0xffffffff
+        return binascii.crc32(buf) & 0xffffffff
+
     def println(self):
         """!
         @brief オブジェクトの状態を表示する。主にデバッグ用
@@ -1190,17 +1764,20 @@ class EchonetLite():
         """
         # print("# EchonetLite.getHwAddr()") if self.debug else '' # debug
         if env == 'esp32' or env == 'rp2': # raspberry pi pico w
+            import network
             wlan = network.WLAN(network.STA_IF)
             wlan.active(True)
             macStr = ubinascii.hexlify(network.WLAN().config('mac'),':').decode()
             ar = macStr.split(':')[0:6]
             return [int(x,16) for x in ar]
         elif env == 'Windows': # windows
+            import uuid, re
             mac = uuid.getnode()
             macStr = ':'.join(re.findall('..', '%012x' % mac))
             ar = macStr.split(':')[0:6]
             return [int(x,16) for x in ar]
         elif env == 'Darwin': # Mac
+            import uuid, re
             mac = uuid.getnode()
             macStr = ':'.join(re.findall('..', '%012x' % mac))
             ar = macStr.split(':')[0:6]
@@ -1222,6 +1799,7 @@ class EchonetLite():
 if __name__ == '__main__':
     print("===== echonet_lite.py unit test")
     import time
+    import network
     WIFI_SSID = 'test'
     WIFI_PASS = 'pass'
     wlan = network.WLAN(network.STA_IF)      # WLANオブジェクトを作成
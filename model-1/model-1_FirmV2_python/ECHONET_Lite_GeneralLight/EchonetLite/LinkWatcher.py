@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+"""!
+@file LinkWatcher.py
+@brief Wi-Fiなどのリンクが切れて戻ったことを見つける
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details EventLoopのタイマで一定間隔ごとにリンクの状態を見る。
+         リンクが戻った時と、つながったままアドレスが変わった時に callback(outage) を呼ぶ。
+         リンクは次のメソッドを持つもの(ESPWiFiConfiguratorなど)
+         - isconnected() つながっていればTrue
+         - local_addr() 今のアドレス、無くてもよい
+         - reconnect() 切れている間に呼ばれる、待たずに戻ること。無くてもよい
+         切れていた時間は見た間隔の精度になる。
+         Python 3.4.0 / MicroPython対応
+"""
+
+
+class LinkWatcher():
+    """!
+    @brief リンクの監視
+    """
+    def __init__(self, link, callback, interval=1000):
+        """!
+        @brief コンストラクタ
+        @param link リンク、isconnected()を持つもの
+        @param callback リンクが戻った時に callback(outage) として呼ばれる。outageは切れていた時間[ms]、アドレスが変わっただけなら0
+        @param interval (int) リンクを見る間隔[ms]
+        """
+        self.link = link
+        self.callback = callback
+        self.interval = interval
+        self.loop = None
+        self.timer = None
+        self.up = True
+        self.downSince = None # 切れたのを見つけた時刻
+        self.addr = None
+        self.outages = 0 # 切れて戻った回数
+        self.lastOutage = 0 # 最後に切れていた時間[ms]
+        self.totalOutage = 0 # 切れていた時間の合計[ms]
+
+    def attach(self, loop):
+        """!
+        @brief EventLoopで監視を始める
+        @param loop (EventLoop)
+        """
+        self.loop = loop
+        self.addr = self._addr()
+        self.timer = loop.callLater(self.interval, self.check)
+
+    def stop(self):
+        """!
+        @brief 監視をやめる
+        """
+        if self.timer is not None:
+            self.loop.cancel(self.timer)
+            self.timer = None
+
+    def _addr(self):
+        """!
+        @brief リンクのアドレスを取る内部関数
+        @return str | None
+        """
+        addr = getattr(self.link, 'local_addr', None)
+        if addr is None:
+            return None
+        return addr()
+
+    def check(self):
+        """!
+        @brief リンクの状態を一度見る。EventLoopのタイマから呼ばれる
+        """
+        self.timer = self.loop.callLater(self.interval, self.check)
+        now = self.loop.now()
+        if not self.link.isconnected():
+            if self.up:
+                self.up = False
+                self.downSince = now
+            reconnect = getattr(self.link, 'reconnect', None)
+            if reconnect is not None:
+                reconnect()
+            return
+        addr = self._addr()
+        if not self.up:
+            outage = int(now - self.downSince)
+            self.up = True
+            self.downSince = None
+            self.outages += 1
+            self.lastOutage = outage
+            self.totalOutage += outage
+            self.addr = addr
+            self.callback(outage)
+        elif addr is not None and addr != self.addr:
+            self.addr = addr
+            self.callback(0)
+
+
+if __name__ == '__main__':
+    print("===== LinkWatcher.py 単体テスト")
+    from EchonetLite.EventLoop import EventLoop
+
+    class Link():
+        connected = True
+        addr = '192.168.1.10'
+        def isconnected(self):
+            return self.connected
+        def local_addr(self):
+            return self.addr
+
+    loop = EventLoop()
+    link = Link()
+    w = LinkWatcher(link, lambda outage: print("relink", outage > 0, link.addr), 10)
+    w.attach(loop)
+    loop.callLater(25, lambda: setattr(link, 'connected', False))
+    loop.callLater(85, lambda: setattr(link, 'connected', True)) # relink True
+    loop.callLater(125, lambda: setattr(link, 'addr', '192.168.1.11')) # relink False
+    loop.callLater(170, loop.stop)
+    loop.runForever()
+    print(w.outages, 40 <= w.lastOutage <= 80)
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+"""!
+@file RecvQueue.py
+@brief 優先度つきの固定長受信キュー
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details 受信したフレームをすぐソケットから取り出してここに積み、処理は後から優先度の高い順に行う。
+         同じマルチキャストグループの他機器からINFが大量に来ても、SETやGETが後回しにならないようにする。
+         優先度は 0: SETI/SETC/SETGET, 1: GET/INF_REQ/INFC, 2: INF/応答/不可応答 の3段階。
+         Python 3.4.0 / MicroPython対応
+"""
+
+
+class RecvQueue():
+    """!
+    @brief 優先度ごとのリングバッファを束ねた受信キュー
+    @details 合計の件数をsizeまでに抑える。あふれた時の動作はpolicyで選ぶ
+             - 'drop-new' 新しく来たフレームを捨てる
+             - 'drop-old' 同じ優先度の一番古いフレームを捨てる。同じ優先度のものが無ければ新しいフレームを捨てる
+             - 'drop-lower' 新しいフレームより優先度の低いフレームのうち、一番低い優先度の一番古いものを捨てる。無ければ新しいフレームを捨てる
+    """
+    SET = 0 # SETI, SETC, SETGET
+    GET = 1 # GET, INF_REQ, INFC
+    INF = 2 # INF, *_RES, *_SNA, その他
+    LEVELS = 3
+    POLICIES = ['drop-new', 'drop-old', 'drop-lower']
+
+    def __init__(self, size=32, policy='drop-lower'):
+        """!
+        @brief コンストラクタ
+        @param size (int) 積んでおけるフレームの数
+        @param policy (str) あふれた時の動作
+        """
+        if policy not in RecvQueue.POLICIES:
+            raise ValueError("RecvQueue: policy must be one of {}, got {}".format(RecvQueue.POLICIES, policy))
+        if size <= 0:
+            raise ValueError("RecvQueue: size must be positive, got {}".format(size))
+        self.size = size
+        self.policy = policy
+        self.rings = [[None] * size for _ in range(RecvQueue.LEVELS)] # 優先度ごとのリング
+        self.heads = [0] * RecvQueue.LEVELS # 優先度ごとの先頭位置
+        self.counts = [0] * RecvQueue.LEVELS # 優先度ごとの件数
+        self.count = 0 # 合計件数
+        self.enqueued = 0 # 積んだ数
+        self.dropped = [0] * RecvQueue.LEVELS # 捨てた数、捨てられたフレームの優先度ごと
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def classify(esv):
+        """!
+        @brief ESVから優先度を決める
+        @param esv (int)
+        @return int 0が最優先
+        """
+        if esv == 0x60 or esv == 0x61 or esv == 0x6e:
+            return RecvQueue.SET
+        if esv == 0x62 or esv == 0x63 or esv == 0x74:
+            return RecvQueue.GET
+        return RecvQueue.INF
+
+    def _popLevel(self, level):
+        """!
+        @brief 指定した優先度の一番古いものを取り出す内部関数
+        """
+        ring = self.rings[level]
+        head = self.heads[level]
+        item = ring[head]
+        ring[head] = None
+        self.heads[level] = (head + 1) % self.size
+        self.counts[level] -= 1
+        self.count -= 1
+        return item
+
+    def push(self, item, level):
+        """!
+        @brief フレームを積む
+        @param item 積むもの、(bytes, ip)など
+        @param level (int) 優先度、classify()の戻り値
+        @return bool 積めたらTrue、捨てたらFalse
+        """
+        if self.count >= self.size:
+            victim = -1
+            if self.policy == 'drop-old':
+                if self.counts[level] > 0:
+                    victim = level
+            elif self.policy == 'drop-lower':
+                for lower in range(RecvQueue.LEVELS - 1, level, -1):
+                    if self.counts[lower] > 0:
+                        victim = lower
+                        break
+            if victim < 0:
+                self.dropped[level] += 1
+                return False
+            self._popLevel(victim)
+            self.dropped[victim] += 1
+        ring = self.rings[level]
+        ring[(self.heads[level] + self.counts[level]) % self.size] = item
+        self.counts[level] += 1
+        self.count += 1
+        self.enqueued += 1
+        return True
+
+    def pop(self):
+        """!
+        @brief 優先度の高い順に一つ取り出す
+        @return 積んだもの | None
+        """
+        if self.count == 0:
+            return None
+        for level in range(RecvQueue.LEVELS):
+            if self.counts[level] > 0:
+                return self._popLevel(level)
+        return None
+
+    def clear(self):
+        """!
+        @brief 全部捨てる。捨てた数には数えない
+        """
+        while self.count:
+            self.pop()
+
+
+if __name__ == '__main__':
+    print("===== RecvQueue.py 単体テスト")
+    q = RecvQueue(4, 'drop-lower')
+    for i in range(4):
+        q.push(('inf', i), RecvQueue.classify(0x73))
+    print(q.push(('setc', 0), RecvQueue.classify(0x61)), q.push(('inf', 4), RecvQueue.INF)) # SETCはINFを追い出して入る、INFは入れない
+    print([q.pop() for _ in range(5)], q.dropped, q.enqueued)
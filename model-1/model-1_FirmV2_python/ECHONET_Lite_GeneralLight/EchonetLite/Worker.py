@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+"""!
+@file Worker.py
+@brief 時間のかかるユーザ関数を別スレッドで動かす
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details NeoPixelの書き換えやPWMの変更などで時間のかかるSet処理を受信処理から切り離す。
+         CPythonではThreadPoolExecutor、MicroPythonでは_threadのスレッドを一つ使う。
+         終わった処理のコールバックは、poll()を呼んだスレッド(EventLoop)で実行する。
+         inWorker()で、今ワーカースレッドの中にいるかが分かる。
+         Python 3.4.0 / MicroPython対応
+"""
+
+if __name__ == '__main__':
+    from EchonetLite.Env import env
+elif __name__ == 'EchonetLite.Worker':
+    from .Env import env
+else:
+    from Env import env
+
+
+class Worker():
+    """!
+    @brief ワーカースレッド
+    """
+    def __init__(self, threads=1):
+        """!
+        @brief コンストラクタ、スレッドを起動する
+        @param threads (int) CPythonでのスレッド数。MicroPythonでは常に1
+        @note 複数のSetが同時に来ても順番に処理されるように、既定は1スレッド。inWorker()は1スレッドの時だけ正しい
+        """
+        self.pending = 0 # 投入して、まだコールバックしていない数
+        self.done = [] # 終わった処理 [callback, result, error]
+        self.threadId = None # ワーカースレッドのid、最初の処理で分かる
+        # スレッドのモジュールは使う時にimportする。concurrent.futuresはimportが重い
+        if env == 'esp32' or env == 'rp2':
+            import _thread
+            self.getIdent = _thread.get_ident
+            self.lock = _thread.allocate_lock()
+            self.wake = _thread.allocate_lock()
+            self.wake.acquire() # 仕事が来るまでスレッドを止めておく
+            self.jobs = []
+            self.executor = None
+            _thread.start_new_thread(self._loop, ())
+        else:
+            import threading
+            from concurrent.futures import ThreadPoolExecutor
+            self.getIdent = threading.get_ident
+            self.lock = threading.Lock()
+            self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def submit(self, func, args, callback):
+        """!
+        @brief 処理を投入する
+        @param func 別スレッドで呼ぶ関数
+        @param args (tuple) funcの引数
+        @param callback poll()で呼ばれる関数 callback(result, error)。errorは例外、成功時はNone
+        """
+        self.pending += 1
+        if self.executor is not None:
+            self.executor.submit(self._run, func, args, callback)
+        else:
+            with self.lock:
+                self.jobs.append((func, args, callback))
+            if self.wake.locked():
+                self.wake.release()
+
+    def _run(self, func, args, callback):
+        """!
+        @brief ワーカースレッドで処理を実行する内部関数
+        """
+        result = None
+        error = None
+        self.threadId = self.getIdent()
+        try:
+            result = func(*args)
+        except Exception as e:
+            error = e
+        with self.lock:
+            self.done.append((callback, result, error))
+
+    def _loop(self):
+        """!
+        @brief MicroPythonのワーカースレッド本体、内部関数
+        """
+        while True:
+            self.wake.acquire()
+            while True:
+                with self.lock:
+                    job = self.jobs.pop(0) if self.jobs else None
+                if job is None:
+                    break
+                self._run(job[0], job[1], job[2])
+
+    def inWorker(self):
+        """!
+        @brief 呼んだのがワーカースレッドか
+        @return bool
+        """
+        return self.threadId is not None and self.getIdent() == self.threadId
+
+    def poll(self):
+        """!
+        @brief 終わった処理のコールバックを呼ぶ。呼んだスレッドで実行される
+        @return int 呼んだコールバックの数
+        """
+        if not self.done:
+            return 0
+        with self.lock:
+            done = self.done
+            self.done = []
+        for callback, result, error in done:
+            self.pending -= 1
+            callback(result, error)
+        return len(done)
+
+    def close(self):
+        """!
+        @brief CPythonではスレッドを止める。MicroPythonのスレッドは止められないので何もしない
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    import time
+    print("===== Worker.py 単体テスト")
+    w = Worker()
+    w.submit(time.sleep, (0.05,), lambda r, e: print("sleep done", r, e))
+    w.submit(int, ('x',), lambda r, e: print("int done", r, type(e).__name__))
+    while w.pending:
+        time.sleep(0.01)
+        w.poll()
+    w.close()
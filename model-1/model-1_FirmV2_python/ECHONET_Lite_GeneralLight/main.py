@@ -4,6 +4,7 @@ import os
 import time
 import network
 from EchonetLite import EchonetLite, PDCEDT
+from EchonetLite.EventLoop import EventLoop
 import neopixel
 from Python_Serial_ESP_Wi_Fi_Configurator_Device import ESPWiFiConfigurator
 
@@ -158,17 +159,22 @@ WIFI_PASS = "pass"
 
 # main
 try:
-    # Wi-Fi設定・接続管理クラスの初期化（自動的に接続試行とシリアル監視を開始）
-    wifi_configurator = ESPWiFiConfigurator(default_ssid=WIFI_SSID, default_pass=WIFI_PASS)
+    # Wi-Fi設定・接続管理クラスの初期化（自動的に接続試行）
+    # シリアルの設定コマンドは、つながるまではwait_connected()が、その後はEventLoopが受け付ける
+    wifi_configurator = ESPWiFiConfigurator(default_ssid=WIFI_SSID, default_pass=WIFI_PASS, auto_start=False)
     
-    # Wi-Fi接続待ち
+    # Wi-Fi接続待ち（細かい間隔で確認し、つながったらすぐに進む）
     wlan = network.WLAN(network.STA_IF)
-    while not wlan.isconnected():
-        time.sleep(1)
+    wifi_configurator.wait_connected()
     print('| IP:', wlan.ifconfig()[0])
 
     # EchonetLite 初期化（一般照明デバイスコード：0x029001）
-    el = EchonetLite([[0x02, 0x90, 0x01]])  # General Lighting object
+    # マルチキャストの要求への返信は最大200msばらし、マルチキャストのINFは毎秒5回までにする
+    # 受信はキューに積んでSETを先に処理する。他機器のINFであふれたらINFから捨てる
+    # コントローラが再送したSETは、ユーザ関数を呼ばずに覚えている返信を送り直す（同じSETを二度実行しない）
+    # SETされたプロパティはフラッシュに保存し、再起動時(begin)に戻す
+    # Wi-Fiが切れて戻ったら、受信ソケットを作り直してマルチキャストに参加し直し、D5を通知し直す
+    el = EchonetLite([[0x02, 0x90, 0x01]], {'replyJitter': 200, 'infRate': 5, 'recvQueue': 16, 'replyCache': 8, 'store': '/el_state.bin', 'link': wifi_configurator})  # General Lighting object
     
     deoj = [0x01, 0x30, 0x01]  # デバイスオブジェクトコード
 
@@ -200,6 +206,10 @@ try:
     #edt = [0x01, 0x31]
     #el.sendMultiOPC1(deoj, EchonetLite.INF, 0x80, edt)  
 
+    # 受信とシリアルの設定コマンドを同じEventLoopで待つ
+    loop = EventLoop()
+    el.attach(loop)
+    wifi_configurator.attach(loop)
     while True:
         el.recvProcess()
         time.sleep(0.5)
@@ -5,40 +5,60 @@ import csv
 import os
 import sys
 import subprocess
+import base64
+import hashlib
 import serial
 import serial.tools.list_ports
 import time
+import shutil
+import tempfile
+import importlib.util
+import multiprocessing
+import queue
+import re
 
 # ファイルパス定義
 WIFI_FILE = 'wifi_config.csv'
+# ESP32が動いている間に作るファイル。フォルダに無くても差分書き込みでは消さない
+DEVICE_FILES = ('el_state.bin', 'el_state.bin.tmp', WIFI_FILE)
+
+# mpy-crossのアーキテクチャ（画面の表示名 -> -marchの値、Noneならソースのまま書き込む）
+MPY_ARCHS = {
+    'ソースのまま書き込む': None,
+    'ESP32-C3 (rv32imc)': 'rv32imc',
+    'ESP32 / ESP32-S3 (xtensawin)': 'xtensawin',
+}
+# -marchの値 -> sys.implementation._mpy に入るアーキテクチャ番号 (MP_NATIVE_ARCH_*)
+MPY_ARCH_CODES = {'xtensawin': 10, 'rv32imc': 11}
+# ソースのまま書き込むファイル（起動時に実行されるのでコンパイルしない）
+MPY_KEEP_SOURCE = ('main.py', 'boot.py')
+# 複数ボードに書き込む時、同時に動かすワーカープロセスの数
+MAX_PARALLEL = 8
+# 画面の「書き込む」で動いている一台分の書き込み
+single_job = {'flasher': None, 'build_dir': None, 'port': None}
+# ファームウェアイメージのヘッダのチップID -> (esptoolの--chip, 書き込むアドレス)
+IMAGE_CHIPS = {
+    0: ('esp32', 0x1000),
+    2: ('esp32s2', 0x1000),
+    5: ('esp32c3', 0x0),
+    9: ('esp32s3', 0x0),
+}
+IMAGE_BAUDRATE = 460800
 
 def get_serial_ports():
     ports = serial.tools.list_ports.comports()
     return [port.device for port in ports]
 
+def get_serial_boards():
+    """(ポート, USBシリアル番号) の一覧。シリアル番号が取れなければ空文字"""
+    return [(port.device, port.serial_number or '') for port in serial.tools.list_ports.comports()]
+
 def write_wifi_csv(ssid, password):
     with open(WIFI_FILE, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow(['T',ssid, password])
         writer.writerow(['F','ssid', 'password'])
 
-def run_mpremote_command(cmd, max_retries=3, delay=2.0):
-    """mpremoteコマンドをリトライ付きで実行する"""
-    last_error = None
-    for attempt in range(max_retries):
-        try:
-            subprocess.run(cmd, check=True)
-            return True
-        except subprocess.CalledProcessError as e:
-            last_error = e
-            print(f"Command failed (attempt {attempt+1}/{max_retries})")
-            if attempt < max_retries - 1:
-                print(f"Retrying in {delay} seconds...")
-                time.sleep(delay)
-    
-    if last_error:
-        raise last_error
-
 def check_serial_port_availability(port, timeout=3.0):
     """シリアルポートが使用可能かチェックする（リトライあり）"""
     start_time = time.time()
@@ -54,10 +74,137 @@ def check_serial_port_availability(port, timeout=3.0):
             # まだ時間があるなら少し待って再試行
             time.sleep(0.5)
 
-def clean_esp32(port):
-    """ESP32内の全ファイルを削除してクリーンにする"""
-    clean_script = "_clean_esp32_temp.py"
-    script_content = """
+class RawReplError(Exception):
+    """raw REPLでの実行エラー"""
+    pass
+
+class RawRepl:
+    """MicroPythonのraw REPLでコードを実行し、ファイルを転送する（mpremote/pyboard.pyと同じ手順）
+    一つのシリアル接続のまま、フォルダ全体を書き込める"""
+    CHUNK = 256 # raw-pasteが使えない時に一度にシリアルへ書くバイト数、USBシリアルの受信バッファを溢れさせない
+    BLOCK = 2048 # 1回のexecで送るファイルのバイト数
+
+    def __init__(self, port, baudrate=115200, timeout=10.0):
+        self.serial = serial.Serial(port, baudrate=baudrate, timeout=0.5)
+        self.timeout = timeout
+        self.raw_paste = True # 使えなければexecで分かった時点でFalseにする
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.serial.close()
+
+    def read_until(self, ending, timeout=None):
+        """endingを受信するまで読む。データが来ている間は待ち時間を延ばす"""
+        timeout = self.timeout if timeout is None else timeout
+        data = b''
+        deadline = time.time() + timeout
+        while not data.endswith(ending):
+            c = self.serial.read(1)
+            if c:
+                data += c
+                deadline = time.time() + timeout
+            elif time.time() > deadline:
+                raise RawReplError(f"timeout waiting for {ending!r}: {data[-80:]!r}")
+        return data
+
+    def write(self, data):
+        for i in range(0, len(data), self.CHUNK):
+            self.serial.write(data[i:i + self.CHUNK])
+            time.sleep(0.01)
+
+    def enter(self):
+        """動いているプログラムを止めてraw REPLに入る。ソフトリセットでスレッドも止める（main.pyは実行されない）"""
+        self.serial.write(b'\r\x03')
+        time.sleep(0.1)
+        self.serial.write(b'\x03')
+        time.sleep(0.1)
+        self.serial.reset_input_buffer()
+        self.serial.write(b'\r\x01')
+        self.read_until(b'raw REPL; CTRL-B to exit\r\n>')
+        self.serial.write(b'\x04')
+        self.read_until(b'soft reboot\r\n')
+        self.read_until(b'raw REPL; CTRL-B to exit\r\n>')
+
+    def paste(self, code):
+        """raw-pasteモードで送る。受信側が空けたウインドウの分だけ書くので、待ち時間を入れなくてよい"""
+        window = int.from_bytes(self.serial.read(2), 'little')
+        remain = window
+        i = 0
+        while i < len(code):
+            while remain == 0 or self.serial.in_waiting:
+                c = self.serial.read(1)
+                if c == b'\x01':
+                    remain += window
+                elif c == b'\x04': # 受信側で中断された
+                    self.serial.write(b'\x04')
+                    return
+                else:
+                    raise RawReplError(f"unexpected read during raw paste: {c!r}")
+            block = code[i:i + remain]
+            self.serial.write(block)
+            remain -= len(block)
+            i += len(block)
+        self.serial.write(b'\x04')
+        self.read_until(b'\x04')
+
+    def exec(self, code):
+        """コードを実行して標準出力を返す。例外が出たらRawReplError"""
+        if isinstance(code, str):
+            code = code.encode('utf-8')
+        sent = False
+        if self.raw_paste:
+            self.serial.write(b'\x05A\x01')
+            resp = self.serial.read(2)
+            if resp == b'R\x01':
+                self.paste(code)
+                sent = True
+            else:
+                self.raw_paste = False
+                if resp != b'R\x00': # raw-pasteを知らない古いファームウェア
+                    self.read_until(b'w REPL; CTRL-B to exit\r\n>')
+        if not sent:
+            self.write(code)
+            self.serial.write(b'\x04')
+            if self.serial.read(2) != b'OK':
+                raise RawReplError(f"could not exec: {code[:40]!r}")
+        out = self.read_until(b'\x04')[:-1]
+        err = self.read_until(b'\x04')[:-1]
+        self.read_until(b'>')
+        if err:
+            raise RawReplError(err.decode('utf-8', 'replace'))
+        return out
+
+    def mkdir(self, remote):
+        self.exec(f"import os\ntry:\n os.mkdir({remote!r})\nexcept OSError:\n pass")
+
+    def remove(self, remote, is_dir=False):
+        self.exec(f"import os\ntry:\n os.{'rmdir' if is_dir else 'remove'}({remote!r})\nexcept OSError:\n pass")
+
+    def put(self, local, remote, progress=None):
+        """ファイルを書き込む。progress(バイト数)で進み具合を知らせる"""
+        with open(local, 'rb') as f:
+            data = f.read()
+        self.exec(f"import ubinascii\nf=open({remote!r},'wb')\nw=f.write\nd=ubinascii.a2b_base64")
+        for i in range(0, len(data), self.BLOCK):
+            block = data[i:i + self.BLOCK]
+            self.exec(f"w(d({base64.b64encode(block)!r}))")
+            if progress:
+                progress(len(block))
+        self.exec("f.close()")
+        return len(data)
+
+    def reset(self):
+        """raw REPLを抜けてソフトリセットし、main.pyを起動する"""
+        self.serial.write(b'\x02')
+        time.sleep(0.1)
+        self.serial.write(b'\x04')
+
+CLEAN_SCRIPT = """
 import os
 def rm(p):
     try:
@@ -70,100 +217,370 @@ def rm(p):
     except OSError:
         pass
 
-try:
-    for f in os.listdir():
-        rm(f)
-    print("Filesystem cleaned")
-except Exception as e:
-    print("Clean error:", e)
+for f in os.listdir():
+    rm(f)
+print("Filesystem cleaned")
 """
-    try:
-        # 一時スクリプト作成
-        with open(clean_script, "w", encoding="utf-8") as f:
-            f.write(script_content)
-        
-        print("Cleaning ESP32 filesystem...")
-        # スクリプトをESP32上で実行
-        run_mpremote_command([sys.executable, '-m', 'mpremote', 'connect', port, 'run', clean_script])
-    except Exception as e:
 
+def clean_esp32(repl):
+    """ESP32内の全ファイルを削除してクリーンにする"""
+    print("Cleaning ESP32 filesystem...")
+    try:
+        print(repl.exec(CLEAN_SCRIPT).decode().strip())
+    except RawReplError as e:
         print(f"Warning: Failed to clean ESP32: {e}")
-    finally:
-        # 一時スクリプト削除
-        if os.path.exists(clean_script):
-            os.remove(clean_script)
 
-def flash_files(port, base_path, wifi_source_file):
+# ESP32内の全ファイルのSHA-256を 'f<TAB>パス<TAB>16進', ディレクトリを 'd<TAB>パス' で出力する
+HASH_SCRIPT = """
+import os, hashlib, ubinascii
+b = bytearray(512)
+m = memoryview(b)
+def walk(p):
+    for f in os.listdir(p if p else '.'):
+        q = p + '/' + f if p else f
+        if os.stat(q)[0] & 0x4000:
+            print('d\\t' + q)
+            walk(q)
+        else:
+            h = hashlib.sha256()
+            with open(q, 'rb') as fp:
+                while True:
+                    n = fp.readinto(b)
+                    if not n:
+                        break
+                    h.update(m[:n])
+            print('f\\t' + q + '\\t' + ubinascii.hexlify(h.digest()).decode())
+walk('')
+"""
+
+def device_hashes(repl):
+    """ESP32内のファイルのハッシュを調べる。戻り値は ({パス: 16進}, {ディレクトリ})"""
+    files = {}
+    dirs = set()
+    for line in repl.exec(HASH_SCRIPT).decode('utf-8').splitlines():
+        fields = line.split('\t')
+        if fields[0] == 'f' and len(fields) == 3:
+            files[fields[1]] = fields[2]
+        elif fields[0] == 'd' and len(fields) == 2:
+            dirs.add(fields[1])
+    return files, dirs
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def list_upload_files(base_path, wifi_source_file):
+    """書き込むディレクトリとファイルを順番に並べる。wifi_config.csvとmain.pyは最後"""
+    dirs_out = []
+    files_out = []
+    deferred_main = None
+    for root_dir, dirs, files in os.walk(base_path):
+        # __pycache__ などはスキップ
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__' and not d.startswith('.'))
+        rel_path = os.path.relpath(root_dir, base_path)
+        remote_base = '' if rel_path == '.' else rel_path.replace(os.sep, '/')
+        for d in dirs:
+            dirs_out.append(f"{remote_base}/{d}" if remote_base else d)
+        for file in sorted(files):
+            # wifi_config.csv は別途書き込むのでスキップ
+            if file == 'wifi_config.csv' or file.startswith('.') or file.endswith('.pyc'):
+                continue
+            local_file = os.path.join(root_dir, file)
+            remote_file = f"{remote_base}/{file}" if remote_base else file
+            if remote_file == 'main.py':
+                deferred_main = (local_file, remote_file)
+                continue
+            files_out.append((local_file, remote_file))
+    # Wi-Fi設定はmain.pyの前、main.pyは最後に書き込む
+    files_out.append((wifi_source_file, 'wifi_config.csv'))
+    if deferred_main:
+        files_out.append(deferred_main)
+    return dirs_out, files_out
+
+def stale_entries(remote_files, remote_dirs, files, dirs):
+    """ESP32にあってフォルダに無いファイルとディレクトリを、消す順に返す。DEVICE_FILESは残す"""
+    local_names = set(remote for _, remote in files)
+    stale_files = sorted(f for f in remote_files if f not in local_names and f not in DEVICE_FILES)
+    # 深いディレクトリから消す
+    stale_dirs = sorted((d for d in remote_dirs if d not in dirs), key=lambda d: -d.count('/'))
+    return stale_files, stale_dirs
+
+def upload_tree(port, base_path, wifi_source_file, progress=None, full=False, mpy=None):
+    """一つのシリアル接続でフォルダを書き込む
+    ESP32内のファイルのハッシュと比べて、変わったファイルだけを書き、フォルダに無いファイルは消す
+    fullならハッシュを比べずに、全部消してから全部書く
+    progress(書き込んだバイト数, 全体のバイト数, ファイル名) で進み具合を知らせる
+    mpyを (.mpyの形式, ソースのフォルダ) で指定すると、ESP32のファームウェアが読めない.mpyの時はソースを書き込む
+    戻り値は (書き込んだバイト数, 秒)"""
+    done = [0]
+    start = time.time()
+    with RawRepl(port) as repl:
+        repl.enter()
+        if mpy:
+            reason = mpy_mismatch(mpy[0], device_mpy(repl))
+            if reason:
+                print(f"Warning: {reason}, write source files instead")
+                base_path = mpy[1]
+        dirs, files = list_upload_files(base_path, wifi_source_file)
+        remote_files, remote_dirs = {}, set()
+        if not full:
+            try:
+                remote_files, remote_dirs = device_hashes(repl)
+            except RawReplError as e: # hashlibが無いファームウェアなど
+                print(f"Warning: Failed to hash ESP32 files, rewrite all: {e}")
+                full = True
+        if full:
+            clean_esp32(repl)
+        stale_files, stale_dirs = stale_entries(remote_files, remote_dirs, files, dirs)
+        unchanged = [remote for local, remote in files if remote_files.get(remote) == file_hash(local)]
+        files = [(local, remote) for local, remote in files if remote not in unchanged]
+        total = sum(os.path.getsize(local) for local, _ in files)
+        for f in stale_files:
+            print(f"Removing :{f}")
+            repl.remove(f)
+        for d in stale_dirs:
+            print(f"Removing :{d}/")
+            repl.remove(d, is_dir=True)
+        for d in dirs:
+            if d not in remote_dirs:
+                repl.mkdir(d)
+        for local_file, remote_file in files:
+            if not progress:
+                print(f"Writing {local_file} to :{remote_file}")
+            def step(n, name=remote_file):
+                done[0] += n
+                if progress:
+                    progress(done[0], total, name)
+            if os.path.getsize(local_file) == 0 and progress:
+                progress(done[0], total, remote_file)
+            repl.put(local_file, remote_file, step)
+        repl.reset()
+    elapsed = time.time() - start
+    print(f"Wrote {len(files)} files, {total} bytes in {elapsed:.1f} s ({total / elapsed / 1024:.1f} KiB/s), "
+          f"{len(unchanged)} unchanged, {len(stale_files)} removed")
+    return total, elapsed
+
+def print_progress(done, total, name):
+    """コンソールに進み具合を表示する"""
+    print(f"\r  {done * 100 // max(total, 1):3d}% {done}/{total} bytes {name}", end='', flush=True)
+    if done >= total:
+        print()
+
+def find_esptool():
+    """esptoolの起動コマンドを探す。見つからなければNone"""
+    if importlib.util.find_spec('esptool') is not None: # pip install esptool
+        return [sys.executable, '-m', 'esptool']
+    for name in ('esptool', 'esptool.py'):
+        exe = shutil.which(name)
+        if exe:
+            return [exe]
+    return None
+
+def image_chip(path):
+    """ファームウェアイメージのヘッダからチップと書き込みアドレスを調べる。分からなければNone"""
+    with open(path, 'rb') as f:
+        header = f.read(16)
+    if len(header) < 16 or header[0] != 0xE9: # ESPイメージのマジック
+        return None
+    return IMAGE_CHIPS.get(int.from_bytes(header[12:14], 'little'))
+
+def write_image(port, image):
+    """el_freeze.pyで作ったファームウェアイメージをesptoolで書き込み、再起動を待つ
+    ファイルシステムの領域は消さないので、この後にupload_treeで差分書き込みをする"""
+    esptool = find_esptool()
+    if esptool is None:
+        raise FileNotFoundError("esptool が見つかりません (pip install esptool)")
+    chip = image_chip(image)
+    if chip is None:
+        raise ValueError(f"ESP32のファームウェアイメージではありません: {image}")
+    print(f"Writing image {image} ({chip[0]}, 0x{chip[1]:x})")
+    subprocess.run(esptool + ['--chip', chip[0], '--port', port, '--baud', str(IMAGE_BAUDRATE),
+                              'write_flash', '-z', hex(chip[1]), image], check=True)
+    # 書き込み後のリセットでUSBシリアルが一度消えるので、戻ってくるのを待つ
+    time.sleep(1.0)
+    if not check_serial_port_availability(port, timeout=10.0):
+        raise serial.SerialException(f"ポート {port} が再起動後に見つかりません")
+
+def find_board_csv(csv_dir, port, serial_number, default):
+    """ボード別のWi-Fi設定ファイルを探す
+    <USBシリアル番号>.csv、<ポート名>.csv (COM3.csv, ttyUSB0.csv など) の順に探し、無ければdefault"""
+    names = [serial_number + '.csv'] if serial_number else []
+    names.append(os.path.basename(port) + '.csv')
+    for name in names:
+        path = os.path.join(csv_dir, name)
+        if os.path.exists(path):
+            return path
+    return default
+
+def flash_worker(port, base_path, wifi_source_file, events, full=False, image=None, mpy=None):
+    """ワーカープロセスで一つのボードに書き込む。進み具合と結果はeventsのキューで親プロセスに送る"""
+    def progress(done, total, name):
+        events.put(('progress', port, done, total, name))
     try:
-        # まずESP32をクリーンにする
-        clean_esp32(port)
-        print("Waiting for ESP32 to restart...")
-        time.sleep(3.0) # クリーン後の再起動待ち
-
-        deferred_main = None
-
-        # 選択されたフォルダ内のファイルを再帰的に書き込み
-        for root_dir, dirs, files in os.walk(base_path):
-            # 相対パスを計算
-            rel_path = os.path.relpath(root_dir, base_path)
-            
-            # リモートのディレクトリパスを作成
-            if rel_path == '.':
-                remote_base = ''
+        if not check_serial_port_availability(port):
+            raise RawReplError(f"ポート {port} にアクセスできません")
+        if image:
+            progress(0, 0, os.path.basename(image))
+            write_image(port, image)
+        total, elapsed = upload_tree(port, base_path, wifi_source_file, progress, full, mpy)
+        events.put(('done', port, total, elapsed))
+    except Exception as e:
+        events.put(('error', port, str(e)))
+
+class BatchFlasher:
+    """複数のボードをワーカープロセスで並列に書き込む
+    GUIのスレッドを止めないように、poll()を root.after で定期的に呼んで状態を更新する"""
+    def __init__(self, jobs, base_path, parallel=MAX_PARALLEL, full=False, image=None, mpy=None):
+        """jobs は [(ポート, Wi-Fi設定ファイル)]、fullなら差分を取らずに全部書き直す
+        imageを指定すると、先にファームウェアイメージを書き込む
+        mpyはupload_treeと同じ"""
+        # Tkを動かしているプロセスをforkしないようにspawnで起動する（Windowsと同じ動き）
+        self.ctx = multiprocessing.get_context('spawn')
+        self.events = self.ctx.Queue()
+        self.base_path = base_path
+        self.parallel = parallel
+        self.full = full
+        self.image = image
+        self.mpy = mpy
+        self.waiting = list(jobs)
+        self.running = {} # ポート -> Process
+        self.state = {port: {'status': '待機', 'done': 0, 'total': 0, 'message': ''} for port, _ in jobs}
+        self.start_next()
+
+    @property
+    def finished(self):
+        return not self.waiting and not self.running
+
+    def start_next(self):
+        while self.waiting and len(self.running) < self.parallel:
+            port, wifi_source = self.waiting.pop(0)
+            proc = self.ctx.Process(target=flash_worker, args=(port, self.base_path, wifi_source, self.events, self.full, self.image, self.mpy), daemon=True)
+            proc.start()
+            self.running[port] = proc
+            self.state[port]['status'] = '書き込み中'
+
+    def poll(self):
+        """ワーカーからの知らせを反映し、空いた分だけ次のボードを始める。状態が変わったポートを返す"""
+        changed = set()
+        # 先に終わったプロセスを調べる。終わる前に送った知らせはこの後のキューの読み出しで必ず届く
+        exited = [port for port, proc in self.running.items() if not proc.is_alive()]
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            kind, port = event[0], event[1]
+            st = self.state[port]
+            if kind == 'progress':
+                st['done'], st['total'], st['message'] = event[2], event[3], event[4]
+            elif kind == 'done':
+                st['status'] = '完了'
+                st['done'] = st['total'] = event[2]
+                st['message'] = f"{event[3]:.1f} 秒 ({event[2] / event[3] / 1024:.1f} KiB/s)"
             else:
-                remote_base = rel_path.replace(os.sep, '/')
-            
-            # ディレクトリ作成（ルート以外）
-            for d in dirs:
-                remote_dir = f"{remote_base}/{d}" if remote_base else d
-                # __pycache__ などはスキップ
-                if d == '__pycache__' or d.startswith('.'):
-                    continue
-                try:
-                    run_mpremote_command([sys.executable, '-m', 'mpremote', 'connect', port, 'fs', 'mkdir', f':{remote_dir}'], max_retries=1)
-                    time.sleep(0.2)
-                except Exception:
-
-                    pass # 既に存在する場合などは無視
-
-            # ファイル書き込み
-            for file in files:
-                # 特定のファイルや隠しファイルはスキップ
-                # wifi_config.csv は別途書き込むのでスキップ
-                if file == 'wifi_config.csv' or file.startswith('.') or file.endswith('.pyc'):
-                    continue
-                
-                local_file = os.path.join(root_dir, file)
-                remote_file = f":{remote_base}/{file}" if remote_base else f":{file}"
-                
-                # main.py は最後に書き込むためにスキップして保存
-                if remote_file == ':main.py':
-                    deferred_main = (local_file, remote_file)
+                st['status'] = 'エラー'
+                st['message'] = event[2]
+            changed.add(port)
+        for port in exited:
+            proc = self.running.pop(port)
+            proc.join()
+            if self.state[port]['status'] == '書き込み中': # 知らせを送らずに落ちた
+                self.state[port]['status'] = 'エラー'
+                self.state[port]['message'] = f"worker exited with code {proc.exitcode}"
+            changed.add(port)
+        self.start_next()
+        return changed
+
+    def stop(self):
+        """まだ始めていないボードを取り消し、書き込み中のプロセスを止める"""
+        for port, _ in self.waiting:
+            self.state[port]['status'] = '中止'
+        self.waiting = []
+        for port, proc in self.running.items():
+            proc.terminate()
+            proc.join()
+            self.state[port]['status'] = '中止'
+        self.running = {}
+
+def find_mpy_cross():
+    """mpy-crossの起動コマンドを探す。見つからなければNone"""
+    exe = shutil.which('mpy-cross')
+    if exe:
+        return [exe]
+    if importlib.util.find_spec('mpy_cross') is not None: # pip install mpy-cross
+        return [sys.executable, '-m', 'mpy_cross']
+    return None
+
+def mpy_cross_version(mpy_cross):
+    """mpy-cross --version の 'mpy-cross emitting mpy v6.3' から (バージョン, サブバージョン) を返す。分からなければNone"""
+    try:
+        result = subprocess.run(mpy_cross + ['--version'], capture_output=True, text=True)
+    except OSError:
+        return None
+    m = re.search(r'mpy v(\d+)(?:\.(\d+))?', result.stdout + result.stderr)
+    if m is None:
+        return None
+    return int(m.group(1)), int(m.group(2) or 0)
+
+def device_mpy(repl):
+    """ESP32のファームウェアが読める.mpyの (バージョン, サブバージョン, アーキテクチャ番号) を返す
+    sys.implementation._mpy が無い（.mpyを読めない）ファームウェアならNone"""
+    out = repl.exec("import sys\nprint(getattr(sys.implementation, '_mpy', 0))").decode().strip()
+    value = int(out or 0)
+    if not value:
+        return None
+    # 下位8ビットがバージョン、次の2ビットがサブバージョン、その上がアーキテクチャ
+    return value & 0xff, (value >> 8) & 3, value >> 10
+
+def mpy_mismatch(target, device):
+    """build_mpyで作った.mpyの形式 target がESP32で読めなければ理由の文字列、読めればNoneを返す"""
+    if device is None:
+        return "firmware has no sys.implementation._mpy"
+    if target[:2] != device[:2]:
+        return f"mpy-cross emits mpy v{target[0]}.{target[1]} but firmware reads v{device[0]}.{device[1]}"
+    # アーキテクチャ番号0はネイティブコードを持たないポートで、チェックできない
+    if device[2] and target[2] != device[2]:
+        names = {code: name for name, code in MPY_ARCH_CODES.items()}
+        return f"mpy-cross targets {names.get(target[2], target[2])} but firmware is {names.get(device[2], device[2])}"
+    return None
+
+def build_mpy(base_path, arch):
+    """フォルダを一時フォルダにコピーし、main.py以外の.pyを.mpyにコンパイルする
+    mpy-crossが無い、またはコンパイルに失敗したファイルはソースのまま残す
+    戻り値は (書き込むフォルダ（呼び出し側で削除する）, .mpyの形式)
+    .mpyの形式は (バージョン, サブバージョン, アーキテクチャ番号) でupload_treeに渡す。コンパイルしなければNone"""
+    build_dir = tempfile.mkdtemp(prefix='el_build_')
+    mpy_cross = find_mpy_cross()
+    version = None
+    if mpy_cross is None:
+        print("mpy-cross が見つからないので、ソースのまま書き込みます (pip install mpy-cross)")
+    else:
+        version = mpy_cross_version(mpy_cross)
+        if version is None:
+            print("mpy-cross のバージョンが分からないので、ソースのまま書き込みます")
+            mpy_cross = None
+    compiled = 0
+    for root_dir, dirs, files in os.walk(base_path):
+        dirs[:] = [d for d in dirs if d != '__pycache__' and not d.startswith('.')]
+        rel_path = os.path.relpath(root_dir, base_path)
+        out_dir = build_dir if rel_path == '.' else os.path.join(build_dir, rel_path)
+        os.makedirs(out_dir, exist_ok=True)
+        for file in files:
+            if file.startswith('.') or file.endswith('.pyc'):
+                continue
+            src = os.path.join(root_dir, file)
+            if mpy_cross and file.endswith('.py') and not (rel_path == '.' and file in MPY_KEEP_SOURCE):
+                dst = os.path.join(out_dir, file[:-3] + '.mpy')
+                result = subprocess.run(mpy_cross + [f'-march={arch}', '-o', dst, src], capture_output=True, text=True)
+                if result.returncode == 0:
+                    compiled += 1
                     continue
-
-                print(f"Writing {local_file} to {remote_file}")
-                run_mpremote_command([sys.executable, '-m', 'mpremote', 'connect', port, 'fs', 'cp', local_file, remote_file])
-                time.sleep(0.5)
-
-        # Wi-Fi.csv の書き込み（main.pyの前に書き込む）
-        # 指定されたソースファイルを使用する
-        print(f"Writing WiFi config from {wifi_source_file}")
-        run_mpremote_command([sys.executable, '-m', 'mpremote', 'connect', port, 'fs', 'cp', wifi_source_file, ':wifi_config.csv'])
-        time.sleep(0.5)
-
-        # main.py の書き込み（最後に実行）
-        if deferred_main:
-            local_file, remote_file = deferred_main
-            print(f"Writing {local_file} to {remote_file}")
-            run_mpremote_command([sys.executable, '-m', 'mpremote', 'connect', port, 'fs', 'cp', local_file, remote_file])
-            time.sleep(0.5)
-
-
-
-        messagebox.showinfo("完了", f"ESP32 ({port}) への書き込みが完了しました。")
-
-    except subprocess.CalledProcessError as e:
-        messagebox.showerror("エラー", f"書き込み中にエラーが発生しました:\n{e}")
+                print(f"mpy-cross failed, use source: {src}\n{result.stderr}")
+            shutil.copy2(src, os.path.join(out_dir, file))
+    print(f"Build: {compiled} files compiled to .mpy ({arch}) in {build_dir}")
+    if not compiled:
+        return build_dir, None
+    return build_dir, version + (MPY_ARCH_CODES.get(arch, 0),)
 
 def select_folder():
     folder_selected = filedialog.askdirectory()
@@ -177,6 +594,25 @@ def select_csv():
         csv_path_var.set(csv_selected)
         csv_entry.xview_moveto(1)
 
+def select_image():
+    image_selected = filedialog.askopenfilename(filetypes=[("Firmware Image", "*.bin"), ("All Files", "*.*")])
+    if image_selected:
+        image_path_var.set(image_selected)
+        image_entry.xview_moveto(1)
+
+def get_image():
+    """画面で選んだファームウェアイメージ。選ばれていなければ空文字、使えなければ警告を出してNone"""
+    image = image_path_var.get().strip()
+    if not image:
+        return ''
+    if not os.path.exists(image):
+        messagebox.showwarning("エラー", "選択されたファームウェアイメージが存在しません。")
+        return None
+    if image_chip(image) is None:
+        messagebox.showwarning("エラー", "ESP32のファームウェアイメージではありません。")
+        return None
+    return image
+
 def toggle_wifi_input():
     if use_csv_var.get():
         ssid_entry.config(state='disabled')
@@ -189,9 +625,43 @@ def toggle_wifi_input():
         csv_entry.config(state='disabled')
         csv_btn.config(state='disabled')
 
+def get_program_folder():
+    """画面で選んだプログラムフォルダ。選ばれていなければ警告を出してNone"""
+    folder_path = folder_path_var.get()
+    if not folder_path:
+        messagebox.showwarning("フォルダ未選択", "プログラムフォルダを選択してください。")
+        return None
+    if not os.path.exists(folder_path):
+        messagebox.showwarning("エラー", "選択されたフォルダが存在しません。")
+        return None
+    return folder_path
+
+def get_wifi_source(required=True):
+    """画面の入力からWi-Fi設定ファイルを決める
+    入力が足りなければ、requiredなら警告を出してNone、そうでなければ黙ってNone"""
+    if use_csv_var.get():
+        # CSVファイルを使用する場合
+        csv_path = csv_path_var.get()
+        if not csv_path:
+            if required:
+                messagebox.showwarning("CSV未選択", "読み込むCSVファイルを選択してください。")
+            return None
+        if not os.path.exists(csv_path):
+            messagebox.showwarning("エラー", "選択されたCSVファイルが存在しません。")
+            return None
+        return csv_path
+    # 手動入力を使用する場合
+    ssid = ssid_entry.get().strip()
+    password = password_entry.get().strip()
+    if not ssid or not password:
+        if required:
+            messagebox.showwarning("入力エラー", "SSIDとパスワードを両方入力してください。")
+        return None
+    write_wifi_csv(ssid, password)
+    return WIFI_FILE
+
 def on_submit():
     port = port_var.get()
-    folder_path = folder_path_var.get()
 
     if not port:
         messagebox.showwarning("ポート未選択", "シリアルポートを選択してください。")
@@ -211,37 +681,195 @@ def on_submit():
                              "・USBケーブルを抜き差しする")
         return
 
-    if not folder_path:
-        messagebox.showwarning("フォルダ未選択", "プログラムフォルダを選択してください。")
+    folder_path = get_program_folder()
+    if folder_path is None:
         return
 
-    if not os.path.exists(folder_path):
-        messagebox.showwarning("エラー", "選択されたフォルダが存在しません。")
+    wifi_source = get_wifi_source()
+    if wifi_source is None:
         return
 
-    wifi_source = WIFI_FILE # デフォルトは生成される wifi_config.csv
+    image = get_image()
+    if image is None:
+        return
 
-    if use_csv_var.get():
-        # CSVファイルを使用する場合
-        csv_path = csv_path_var.get()
-        if not csv_path:
-            messagebox.showwarning("CSV未選択", "読み込むCSVファイルを選択してください。")
+    # .mpyにコンパイルする場合は一時フォルダに作ってから書き込む
+    # ESP32のファームウェアが読めない.mpyなら、書き込む前にソースへ切り替える
+    arch = MPY_ARCHS.get(arch_var.get())
+    mpy = None
+    if arch is not None:
+        single_job['build_dir'], target = build_mpy(folder_path, arch)
+        if target:
+            mpy = (target, os.path.abspath(folder_path))
+        folder_path = single_job['build_dir']
+    # 一括書き込みと同じワーカープロセスで書き込み、GUIのスレッドは止めない
+    single_job['port'] = port
+    single_job['flasher'] = BatchFlasher([(port, os.path.abspath(wifi_source))], os.path.abspath(folder_path),
+                                         full=not delta_var.get(), image=os.path.abspath(image) if image else None, mpy=mpy)
+    submit_btn.config(state='disabled')
+    batch_btn.config(state='disabled')
+    poll_single()
+
+def poll_single():
+    """一台の書き込みの進み具合をボタンとコンソールに表示し、終わったら結果を知らせる"""
+    flasher = single_job['flasher']
+    port = single_job['port']
+    st = flasher.state[port]
+    if port in flasher.poll() and st['status'] == '書き込み中' and st['total']:
+        print_progress(st['done'], st['total'], st['message'])
+        submit_btn.config(text=f"書き込み中 {st['done'] * 100 // st['total']}%")
+    if not flasher.finished:
+        root.after(200, poll_single)
+        return
+    single_job['flasher'] = None
+    if single_job['build_dir']:
+        shutil.rmtree(single_job['build_dir'], ignore_errors=True)
+        single_job['build_dir'] = None
+    submit_btn.config(text="書き込む", state='normal')
+    batch_btn.config(state='normal')
+    if st['status'] == '完了':
+        messagebox.showinfo("完了", f"ESP32 ({port}) への書き込みが完了しました。\n{st['total']} bytes, {st['message']}")
+    else:
+        messagebox.showerror("エラー", f"書き込み中にエラーが発生しました:\n{st['message']}")
+
+def open_batch_window():
+    """複数ボードへの一括書き込み画面を開く"""
+    win = tk.Toplevel(root)
+    win.title("複数ボードへの一括書き込み")
+    win.geometry("760x420")
+    win.columnconfigure(1, weight=1)
+    win.rowconfigure(0, weight=1)
+    job = {'flasher': None, 'build_dir': None}
+
+    columns = ('serial', 'wifi', 'status', 'progress', 'message')
+    tree = ttk.Treeview(win, columns=columns, selectmode='extended')
+    tree.heading('#0', text="ポート")
+    tree.column('#0', width=110, stretch=False)
+    for name, text, width in (('serial', "シリアル番号", 120), ('wifi', "Wi-Fi設定", 120),
+                              ('status', "状態", 70), ('progress', "進捗", 60), ('message', "メッセージ", 250)):
+        tree.heading(name, text=text)
+        tree.column(name, width=width, stretch=(name == 'message'))
+    tree.grid(row=0, column=0, columnspan=3, padx=10, pady=5, sticky="nsew")
+
+    # ボード別のWi-Fi設定（<シリアル番号>.csv か <ポート名>.csv を置いたフォルダ）
+    tk.Label(win, text="ボード別Wi-Fiフォルダ:").grid(row=1, column=0, padx=10, pady=5, sticky="e")
+    board_csv_var = tk.StringVar()
+    tk.Entry(win, textvariable=board_csv_var).grid(row=1, column=1, padx=10, pady=5, sticky="ew")
+
+    def select_board_csv():
+        folder_selected = filedialog.askdirectory(parent=win)
+        if folder_selected:
+            board_csv_var.set(folder_selected)
+            refresh_boards()
+
+    tk.Button(win, text="選択", command=select_board_csv).grid(row=1, column=2, padx=5, pady=5)
+
+    buttons = tk.Frame(win)
+    buttons.grid(row=2, column=0, columnspan=3, padx=10, pady=10, sticky="ew")
+    for i in range(4):
+        buttons.columnconfigure(i, weight=1)
+
+    def board_wifi(port, serial_number, default):
+        csv_dir = board_csv_var.get()
+        if csv_dir and os.path.isdir(csv_dir):
+            return find_board_csv(csv_dir, port, serial_number, default)
+        return default
+
+    def refresh_boards():
+        tree.delete(*tree.get_children())
+        for port, serial_number in get_serial_boards():
+            wifi = board_wifi(port, serial_number, None)
+            tree.insert('', 'end', iid=port, text=port,
+                        values=(serial_number, os.path.basename(wifi) if wifi else "共通", '', '', ''))
+
+    def set_running(running):
+        for child in buttons.winfo_children():
+            child.config(state='disabled' if running else 'normal')
+        stop_btn.config(state='normal' if running else 'disabled')
+
+    def start(ports):
+        if not ports:
+            messagebox.showwarning("ボード未選択", "書き込むボードを選択してください。", parent=win)
             return
-        if not os.path.exists(csv_path):
-            messagebox.showwarning("エラー", "選択されたCSVファイルが存在しません。")
+        folder_path = get_program_folder()
+        if folder_path is None:
             return
-        wifi_source = csv_path
-    else:
-        # 手動入力を使用する場合
-        ssid = ssid_entry.get().strip()
-        password = password_entry.get().strip()
-        if not ssid or not password:
-            messagebox.showwarning("入力エラー", "SSIDとパスワードを両方入力してください。")
+        image = get_image()
+        if image is None:
             return
-        write_wifi_csv(ssid, password)
-        wifi_source = WIFI_FILE
-
-    flash_files(port, folder_path, wifi_source)
+        # ボード別の設定が全部のボードにあれば、共通の設定は無くてもよい
+        default = get_wifi_source(required=False)
+        jobs = []
+        for port in ports:
+            wifi = board_wifi(port, tree.set(port, 'serial'), default)
+            if wifi is None:
+                tree.set(port, 'status', 'エラー')
+                tree.set(port, 'message', "Wi-Fi設定がありません")
+                continue
+            tree.set(port, 'status', '待機')
+            tree.set(port, 'progress', '')
+            tree.set(port, 'message', '')
+            jobs.append((port, os.path.abspath(wifi)))
+        if not jobs:
+            return
+        # .mpyへのコンパイルは一度だけ行い、全ボードで同じものを書き込む
+        # ボードごとにファームウェアの.mpyの形式を確かめ、読めなければソースを書き込む
+        arch = MPY_ARCHS.get(arch_var.get())
+        mpy = None
+        if arch is not None:
+            job['build_dir'], target = build_mpy(folder_path, arch)
+            if target:
+                mpy = (target, os.path.abspath(folder_path))
+            folder_path = job['build_dir']
+        job['flasher'] = BatchFlasher(jobs, os.path.abspath(folder_path), full=not delta_var.get(),
+                                      image=os.path.abspath(image) if image else None, mpy=mpy)
+        set_running(True)
+        poll()
+
+    def finish():
+        flasher = job['flasher']
+        job['flasher'] = None
+        if job['build_dir']:
+            shutil.rmtree(job['build_dir'], ignore_errors=True)
+            job['build_dir'] = None
+        set_running(False)
+        statuses = [st['status'] for st in flasher.state.values()]
+        messagebox.showinfo("一括書き込み",
+                            f"完了: {statuses.count('完了')} 台, エラー: {statuses.count('エラー')} 台, "
+                            f"中止: {statuses.count('中止')} 台", parent=win)
+
+    def poll():
+        flasher = job['flasher']
+        if flasher is None:
+            return
+        for port in flasher.poll():
+            st = flasher.state[port]
+            tree.set(port, 'status', st['status'])
+            tree.set(port, 'progress', f"{st['done'] * 100 // max(st['total'], 1)}%")
+            tree.set(port, 'message', st['message'])
+        if flasher.finished:
+            finish()
+        else:
+            win.after(200, poll)
+
+    def stop():
+        flasher = job['flasher']
+        if flasher is not None:
+            flasher.stop()
+
+    def on_close():
+        stop()
+        if job['build_dir']:
+            shutil.rmtree(job['build_dir'], ignore_errors=True)
+        win.destroy()
+
+    tk.Button(buttons, text="ポート更新", command=refresh_boards).grid(row=0, column=0, padx=5, sticky="ew")
+    tk.Button(buttons, text="選択したボードに書き込む", command=lambda: start(list(tree.selection()))).grid(row=0, column=1, padx=5, sticky="ew")
+    tk.Button(buttons, text="全てのボードに書き込む", command=lambda: start(list(tree.get_children()))).grid(row=0, column=2, padx=5, sticky="ew")
+    stop_btn = tk.Button(win, text="中止", command=stop, state='disabled')
+    stop_btn.grid(row=3, column=0, columnspan=3, padx=10, pady=(0, 10), sticky="ew")
+    win.protocol("WM_DELETE_WINDOW", on_close)
+    refresh_boards()
 
 def refresh_ports():
     ports = get_serial_ports()
@@ -252,54 +880,83 @@ def refresh_ports():
         port_var.set('')
 
 # GUI
-root = tk.Tk()
-root.title("ESP32-S3 MicroPython 書き込みツール")
-root.geometry("600x250")
-
-# カラム設定（中央を伸縮可能に）
-root.columnconfigure(1, weight=1)
-
-# ポート選択
-tk.Label(root, text="シリアルポート:").grid(row=0, column=0, padx=10, pady=5, sticky="e")
-port_var = tk.StringVar()
-port_combo = ttk.Combobox(root, textvariable=port_var, values=get_serial_ports(), state="readonly")
-port_combo.grid(row=0, column=1, padx=10, pady=5, sticky="ew")
-
-refresh_btn = tk.Button(root, text="ポート更新", command=refresh_ports)
-refresh_btn.grid(row=0, column=2, padx=5, pady=5)
-
-# フォルダ選択
-tk.Label(root, text="プログラムフォルダ:").grid(row=1, column=0, padx=10, pady=5, sticky="e")
-folder_path_var = tk.StringVar()
-folder_entry = tk.Entry(root, textvariable=folder_path_var)
-folder_entry.grid(row=1, column=1, padx=10, pady=5, sticky="ew")
-folder_btn = tk.Button(root, text="選択", command=select_folder)
-folder_btn.grid(row=1, column=2, padx=5, pady=5)
-
-# SSID
-tk.Label(root, text="SSID:").grid(row=2, column=0, padx=10, pady=5, sticky="e")
-ssid_entry = tk.Entry(root)
-ssid_entry.grid(row=2, column=1, padx=10, pady=5, columnspan=2, sticky="ew")
-
-# Password
-tk.Label(root, text="Password:").grid(row=3, column=0, padx=10, pady=5, sticky="e")
-password_entry = tk.Entry(root, show='*')
-password_entry.grid(row=3, column=1, padx=10, pady=5, columnspan=2, sticky="ew")
-
-# CSV選択
-use_csv_var = tk.BooleanVar()
-use_csv_check = tk.Checkbutton(root, text="wifi_config.csvを読み込む", variable=use_csv_var, command=toggle_wifi_input)
-use_csv_check.grid(row=4, column=0, padx=10, pady=5, sticky="e")
-
-csv_path_var = tk.StringVar()
-csv_entry = tk.Entry(root, textvariable=csv_path_var, state='disabled')
-csv_entry.grid(row=4, column=1, padx=10, pady=5, sticky="ew")
-
-csv_btn = tk.Button(root, text="選択", command=select_csv, state='disabled')
-csv_btn.grid(row=4, column=2, padx=5, pady=5)
-
-# 書き込みボタン
-submit_btn = tk.Button(root, text="書き込む", command=on_submit)
-submit_btn.grid(row=5, column=0, columnspan=3, pady=15, padx=10, sticky="ew")
-
-root.mainloop()
+# ワーカープロセスはspawnでこのファイルを読み直すので、画面は直接起動した時だけ作る
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    if sys.argv[1:] == ['--selftest']:
+        print("===== 差分書き込みで消すファイル")
+        remote = {'main.py': '', 'old.py': '', 'el_state.bin': '', 'el_state.bin.tmp': '', 'wifi_config.csv': '', 'lib/x.py': ''}
+        print(stale_entries(remote, {'lib', 'lib/sub'}, [('main.py', 'main.py')], []))
+        sys.exit(0)
+    root = tk.Tk()
+    root.title("ESP32-S3 MicroPython 書き込みツール")
+    root.geometry("600x345")
+
+    # カラム設定（中央を伸縮可能に）
+    root.columnconfigure(1, weight=1)
+
+    # ポート選択
+    tk.Label(root, text="シリアルポート:").grid(row=0, column=0, padx=10, pady=5, sticky="e")
+    port_var = tk.StringVar()
+    port_combo = ttk.Combobox(root, textvariable=port_var, values=get_serial_ports(), state="readonly")
+    port_combo.grid(row=0, column=1, padx=10, pady=5, sticky="ew")
+
+    refresh_btn = tk.Button(root, text="ポート更新", command=refresh_ports)
+    refresh_btn.grid(row=0, column=2, padx=5, pady=5)
+
+    # フォルダ選択
+    tk.Label(root, text="プログラムフォルダ:").grid(row=1, column=0, padx=10, pady=5, sticky="e")
+    folder_path_var = tk.StringVar()
+    folder_entry = tk.Entry(root, textvariable=folder_path_var)
+    folder_entry.grid(row=1, column=1, padx=10, pady=5, sticky="ew")
+    folder_btn = tk.Button(root, text="選択", command=select_folder)
+    folder_btn.grid(row=1, column=2, padx=5, pady=5)
+
+    # SSID
+    tk.Label(root, text="SSID:").grid(row=2, column=0, padx=10, pady=5, sticky="e")
+    ssid_entry = tk.Entry(root)
+    ssid_entry.grid(row=2, column=1, padx=10, pady=5, columnspan=2, sticky="ew")
+
+    # Password
+    tk.Label(root, text="Password:").grid(row=3, column=0, padx=10, pady=5, sticky="e")
+    password_entry = tk.Entry(root, show='*')
+    password_entry.grid(row=3, column=1, padx=10, pady=5, columnspan=2, sticky="ew")
+
+    # CSV選択
+    use_csv_var = tk.BooleanVar()
+    use_csv_check = tk.Checkbutton(root, text="wifi_config.csvを読み込む", variable=use_csv_var, command=toggle_wifi_input)
+    use_csv_check.grid(row=4, column=0, padx=10, pady=5, sticky="e")
+
+    csv_path_var = tk.StringVar()
+    csv_entry = tk.Entry(root, textvariable=csv_path_var, state='disabled')
+    csv_entry.grid(row=4, column=1, padx=10, pady=5, sticky="ew")
+
+    csv_btn = tk.Button(root, text="選択", command=select_csv, state='disabled')
+    csv_btn.grid(row=4, column=2, padx=5, pady=5)
+
+    # .mpyへのコンパイル（起動が速くなり、ヒープも空く）
+    tk.Label(root, text="コンパイル:").grid(row=5, column=0, padx=10, pady=5, sticky="e")
+    arch_var = tk.StringVar(value=list(MPY_ARCHS)[0])
+    arch_combo = ttk.Combobox(root, textvariable=arch_var, values=list(MPY_ARCHS), state="readonly")
+    arch_combo.grid(row=5, column=1, padx=10, pady=5, columnspan=2, sticky="ew")
+
+    # ファームウェアイメージ（tools/el_freeze.pyで作ったもの、空ならファイルだけ書き込む）
+    tk.Label(root, text="ファームウェアイメージ:").grid(row=6, column=0, padx=10, pady=5, sticky="e")
+    image_path_var = tk.StringVar()
+    image_entry = tk.Entry(root, textvariable=image_path_var)
+    image_entry.grid(row=6, column=1, padx=10, pady=5, sticky="ew")
+    image_btn = tk.Button(root, text="選択", command=select_image)
+    image_btn.grid(row=6, column=2, padx=5, pady=5)
+
+    # 変わったファイルだけ書き込む（外すと全部消してから書き直す）
+    delta_var = tk.BooleanVar(value=True)
+    delta_check = tk.Checkbutton(root, text="変更したファイルだけ書き込む", variable=delta_var)
+    delta_check.grid(row=7, column=1, padx=10, pady=5, sticky="w")
+
+    # 書き込みボタン
+    submit_btn = tk.Button(root, text="書き込む", command=on_submit)
+    submit_btn.grid(row=8, column=0, columnspan=2, pady=15, padx=10, sticky="ew")
+    batch_btn = tk.Button(root, text="複数ボード...", command=open_batch_window)
+    batch_btn.grid(row=8, column=2, pady=15, padx=5, sticky="ew")
+
+    root.mainloop()
@@ -0,0 +1,373 @@
+#!/usr/bin/python3
+"""!
+@file device_farm.py
+@brief 仮想ミニチュア機器を一つのプロセスで大量に動かすシミュレータ
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details エアコン、一般照明、電気錠の各ファームウェアと同じプロパティ構成の仮想ノードを
+         N台起動し、コントローラの負荷試験に使う。
+         - 各ノードはループバックの別名アドレス(127.0.1.1, 127.0.1.2, ...)やnetns内のアドレスにbindする
+         - 全ノードで一つのEventLoopを共有し、受信が無い間はCPUを使わない
+         - プロファイルのPDCEDTは起動時に一度だけ作り、全ノードで同じオブジェクトを参照する。
+           公開したPDCEDTは書き換えられず、更新はノードごとに差し替えられるので共有してよい
+         - マルチキャストはファームで一つのソケットで受け、各ノードの送受信路に渡して普段の受信処理を通す
+         - MemoryNetworkを渡すとUDPを使わず、同じプロセス内のコントローラと直接やり取りする
+         Linux用。netnsで動かすときは `ip netns exec <ns> python3 device_farm.py --base-ip <netnsのアドレス>`
+"""
+import argparse
+import os
+import socket
+import struct
+import sys
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ECHONET_Lite_AirConditioner'))
+
+from EchonetLite import EchonetLite, ELOBJ
+from EchonetLite.EventLoop import EventLoop
+from EchonetLite.Transport import MemoryTransport, UDPTransport
+
+
+# ========== 各ファームウェアのSet処理 ==========
+def _aircon_set(el, deoj, epc, edt):
+    """!
+    @brief エアコン(ECHONET_Lite_AirConditioner/main.py)相当のSet処理、ハードウェア操作は無し
+    @return bool
+    """
+    if len(edt) < 1:
+        return False
+    v = edt[0]
+    if epc == 0x80:
+        if v != 0x30 and v != 0x31:
+            return False
+        el.update(deoj, epc, edt)
+        return True
+    # 以下の操作は電源ONの場合のみ有効
+    if el.devices[el.getHexString(deoj)][0x80].edt != [0x30]:
+        return False
+    if epc == 0x8F:
+        ok = v == 0x41 or v == 0x42
+    elif epc == 0xA0:
+        ok = v == 0x41 or 0x31 <= v <= 0x38
+    elif epc == 0xB0:
+        if not 0x41 <= v <= 0x45:
+            return False
+        # AUTO・WINDは風量0x41、それ以外は0x35
+        el.update(deoj, 0xA0, [0x41] if v == 0x41 or v == 0x45 else [0x35])
+        el.update(deoj, 0xB3, [0xFD] if v == 0x45 else [0x19])
+        ok = True
+    elif epc == 0xB3 or epc == 0xB5 or epc == 0xB6 or epc == 0xB7:
+        ok = 0x00 <= v <= 0x32
+    elif epc == 0xB4:
+        ok = 0x00 <= v <= 0x64
+    else:
+        ok = False
+    if ok:
+        el.update(deoj, epc, edt)
+    return ok
+
+def _light_set(el, deoj, epc, edt):
+    """!
+    @brief 一般照明(ECHONET_Lite_GeneralLight/main.py)相当のSet処理、ハードウェア操作は無し
+    @return bool
+    """
+    if len(edt) < 1:
+        return False
+    if epc == 0x80:
+        if edt != [0x30] and edt != [0x31]:
+            return False
+    elif epc == 0x81 or epc == 0x88:
+        pass
+    elif epc == 0xB0:
+        if edt[0] > 100:
+            return False
+    elif epc == 0xB6:
+        if edt[0] == 0x41 or edt[0] == 0x42:
+            el.update(deoj, 0xC0, [255, 255, 255])
+        elif edt[0] == 0x43:
+            el.update(deoj, 0xC0, [255, 150, 0])
+        elif edt[0] != 0x45:
+            return False
+    elif epc == 0xC0:
+        if len(edt) != 3:
+            return False
+        el.update(deoj, 0xB6, [0x45]) # カラー灯モードに切り替える
+    else:
+        return False
+    el.update(deoj, epc, edt)
+    return True
+
+def _lock_set(el, deoj, epc, edt):
+    """!
+    @brief 電気錠(ECHONET_Lite_ElectricLock/main.py)はSET可能プロパティなし
+    @return bool
+    """
+    return False
+
+
+# ========== プロファイルテーブル ==========
+# props は [EPC, EDT] の並び。main.pyの初期化と同じ内容
+PROFILES = {
+    'aircon': {
+        'eoj': [0x01, 0x30, 0x01],
+        'props': [
+            [0x80, [0x31]], [0x81, [0xFF]], [0x82, [0x00, 0x00, 0x52, 0x01]], [0x88, [0x42]],
+            [0x8A, [0x00, 0x00, 0x77]], [0x8E, [0x07, 0xE8, 0x01, 0x01]], [0x8F, [0x42]],
+            [0xA0, [0x41]], [0xB0, [0x41]], [0xB3, [0xFD]], [0xB4, [0x32]], [0xB5, [0x1C]],
+            [0xB6, [0x14]], [0xB7, [0x1C]], [0xBA, [0x32]], [0xBB, [0x16]],
+        ],
+        'inf': [0x80, 0x8F, 0xA0, 0xB0],
+        'set': [0x80, 0x8F, 0xA0, 0xB0, 0xB3, 0xB4, 0xB5, 0xB6, 0xB7],
+        'get': [0x80, 0x81, 0x82, 0x83, 0x88, 0x8A, 0x8E, 0x8F, 0xA0, 0xB0, 0xB3, 0xB4, 0xB5, 0xB6, 0xB7, 0xBA, 0xBB, 0x9D, 0x9E, 0x9F],
+        'setFunc': _aircon_set,
+    },
+    'light': {
+        'eoj': [0x02, 0x90, 0x01],
+        'props': [
+            [0x80, [0x31]], [0x88, [0x42]], [0x8A, [0x00, 0x00, 0x77]], [0x8E, [0x07, 0xE8, 0x01, 0x01]],
+            [0xB0, [100]], [0xB6, [0x42]], [0xC0, [255, 255, 255]],
+        ],
+        'inf': [0x80, 0xB6],
+        'set': [0x80, 0xB0, 0xB6, 0xC0],
+        'get': [0x80, 0x81, 0x82, 0x83, 0x88, 0x8A, 0x8E, 0xB0, 0xB6, 0xC0, 0x9D, 0x9E, 0x9F],
+        'setFunc': _light_set,
+    },
+    'lock': {
+        'eoj': [0x02, 0x6F, 0x01],
+        'props': [
+            [0x80, [0x30]], [0x81, [0xFF]], [0x82, [0x00, 0x00, 0x52, 0x01]], [0x88, [0x42]],
+            [0x8A, [0x00, 0x00, 0x77]], [0x8E, [0x07, 0xE8, 0x01, 0x01]], [0xE0, [0x42]], [0xE3, [0x42]],
+        ],
+        'inf': [0x80, 0xE0, 0xE3],
+        'set': [],
+        'get': [0x80, 0x81, 0x82, 0x88, 0x8A, 0x8E, 0xE0, 0xE3, 0x9D, 0x9E, 0x9F],
+        'setFunc': _lock_set,
+    },
+}
+
+def compileProfile(profile):
+    """!
+    @brief プロファイル定義からテンプレートのELOBJを作る
+    @param profile (dict) PROFILESの要素
+    @return ELOBJ
+    @note テンプレートのPDCEDTは全ノードで同じオブジェクトを参照する(VirtualNode)。
+          ELOBJは公開したPDCEDTを書き換えず、更新はpdcedtsごと差し替えるので、共有しても他のノードに影響しない
+    """
+    tpl = ELOBJ()
+    for epc, edt in profile['props']:
+        tpl.SetEDT(epc, edt[:])
+    tpl.SetMyPropertyMap(0x9d, profile['inf'][:])
+    tpl.SetMyPropertyMap(0x9e, profile['set'][:])
+    tpl.SetMyPropertyMap(0x9f, profile['get'][:])
+    return tpl
+
+def ipAdd(ip, n):
+    """!
+    @brief IPv4アドレスにnを足す
+    @param ip (str)
+    @param n (int)
+    @return str
+    """
+    v = struct.unpack('!I', socket.inet_aton(ip))[0] + n
+    return socket.inet_ntoa(struct.pack('!I', v))
+
+
+class FarmTransport(UDPTransport):
+    """!
+    @brief ファームが受けたマルチキャストを渡せるUDPTransport
+    @details ノードのソケットは自分のアドレスにbindするのでマルチキャストを受けられない。
+             ファームのソケットで受けたものをinject()で積み、ソケットで受けたものと同じくrecv()から返す
+    """
+    def __init__(self, bindAddr):
+        """!
+        @brief コンストラクタ
+        @param bindAddr (str) ノードのアドレス
+        """
+        self.pending = deque((), 64) # マルチキャストで届いたフレーム (bytes, ip)
+        UDPTransport.__init__(self, bindAddr)
+
+    def inject(self, data, ip):
+        """!
+        @brief マルチキャストで届いたフレームを積み、受信のコールバックを呼ぶ
+        @param data (bytes)
+        @param ip (str) 送信元
+        """
+        self.pending.append((data, ip))
+        if self.callback is not None:
+            self.callback()
+
+    def recv(self):
+        """!
+        @brief 積まれたマルチキャスト、ソケットの順に一つ取り出す
+        @return (bytes, str) | None
+        """
+        if self.pending:
+            self.lastMulticast = True
+            return self.pending.popleft()
+        frame = UDPTransport.recv(self)
+        if frame is not None and not self.pktinfo:
+            self.lastMulticast = False # 自分のアドレスにbindしたソケットにはユニキャストしか届かない
+        return frame
+
+
+class VirtualNode():
+    """!
+    @brief 仮想ノード一台分
+    """
+    def __init__(self, index, kind, ip, template, debug=False, net=None):
+        """!
+        @brief コンストラクタ
+        @param index (int) 通し番号、MACアドレスの生成に使う
+        @param kind (str) PROFILESのキー
+        @param ip (str) bindするアドレス
+        @param template (ELOBJ) compileProfileで作ったテンプレート
+        @param debug (bool)
+        @param net (MemoryNetwork) 指定すればUDPの代わりにMemoryTransportを使う
+        """
+        profile = PROFILES[kind]
+        self.kind = kind
+        self.ip = ip
+        self.eoj = profile['eoj']
+        self.setFunc = profile['setFunc']
+        mac = [0x02, 0x00, (index >> 24) & 0xff, (index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff]
+        transport = FarmTransport(ip) if net is None else MemoryTransport(net, ip)
+        self.el = EchonetLite([self.eoj[:]], {'transport': transport, 'mac': mac, 'debug': debug})
+        obj = self.el.devices[self.el.getHexString(self.eoj)]
+        # SetPDCEDTはコピーを作るので、テンプレートのPDCEDTをそのまま入れて共有する
+        pdcedts = dict(obj.pdcedts)
+        pdcedts.update(template.pdcedts)
+        obj.pdcedts = pdcedts
+        obj.inf_property_map_raw = template.inf_property_map_raw
+        obj.set_property_map_raw = template.set_property_map_raw
+        obj.get_property_map_raw = template.get_property_map_raw
+
+    def userSetFunc(self, ip, tid, seoj, deoj, esv, opc, epc, pdcedt):
+        """!
+        @brief EchonetLiteのSetコールバック
+        """
+        if deoj != self.eoj:
+            return False
+        return self.setFunc(self.el, deoj, epc, pdcedt.edt)
+
+    def userNopFunc(self, ip, tid, seoj, deoj, esv, opc, epc, pdcedt):
+        """!
+        @brief Get, INFのコールバック、何もしない
+        """
+        return True
+
+
+class DeviceFarm():
+    """!
+    @brief 仮想ノードの集合と、それを動かすEventLoop
+    """
+    def __init__(self, counts, base_ip='127.0.1.1', mcast_if='127.0.0.1', debug=False, net=None):
+        """!
+        @brief コンストラクタ
+        @param counts (list) [[kind, 台数], ...]
+        @param base_ip (str) 最初のノードのアドレス、以降1ずつ増やす
+        @param mcast_if (str) マルチキャストを受けるインタフェースのアドレス
+        @param debug (bool)
+        @param net (MemoryNetwork) 指定すればUDPを使わずにこのネットワークにつなぐ
+        """
+        self.loop = EventLoop()
+        self.nodes = []
+        self.mcast_if = mcast_if
+        self.net = net
+        self.rx_multicast = 0
+        templates = {}
+        index = 0
+        for kind, n in counts:
+            if kind not in templates:
+                templates[kind] = compileProfile(PROFILES[kind])
+            for _ in range(n):
+                self.nodes.append(VirtualNode(index, kind, ipAdd(base_ip, index), templates[kind], debug, net))
+                index += 1
+        self.msock = None
+
+    def _openMulticast(self):
+        """!
+        @brief 全ノード共通のマルチキャスト受信ソケットを作る内部関数
+        """
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((EchonetLite.MULTICAST_GROUP, EchonetLite.ECHONETport))
+        mreq = struct.pack('4s4s', socket.inet_aton(EchonetLite.MULTICAST_GROUP), socket.inet_aton(self.mcast_if))
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        s.setblocking(False)
+        self.msock = s
+        self.loop.register(s, self._onMulticast)
+
+    def _onMulticast(self, sock):
+        """!
+        @brief マルチキャスト受信、要求系のESVだけ全ノードの送受信路に渡す内部関数
+        @note 仮想ノードは通知(INF, *_RES, *_SNA)を使わないので、ノード同士のINFで負荷が二乗にならないように捨てる
+        @note ノードは受信キューや記録を含めて、ソケットで受けた時と同じ処理をする
+        """
+        try:
+            data, addr = sock.recvfrom(EchonetLite.BUFFER_SIZE)
+        except OSError:
+            return
+        self.rx_multicast += 1
+        if len(data) <= EchonetLite.ESV or (data[EchonetLite.ESV] & 0xf0) != 0x60:
+            return
+        for node in self.nodes:
+            try:
+                node.el.transport.inject(data, addr[0])
+            except Exception as error:
+                print("# DeviceFarm multicast error:", node.ip, error)
+
+    def _beginNode(self, node):
+        """!
+        @brief ノードの受信を開始してループに登録する内部関数
+        """
+        node.el.begin(node.userSetFunc, node.userNopFunc, node.userNopFunc)
+        node.el.attach(self.loop)
+
+    def start(self, ramp_ms=0):
+        """!
+        @brief 全ノードを起動する
+        @param ramp_ms (int) ノードごとの起動間隔[ms]、0なら一斉に起動
+        """
+        if self.net is None:
+            self._openMulticast() # MemoryNetworkはマルチキャストも自分で配る
+        for i, node in enumerate(self.nodes):
+            if ramp_ms > 0:
+                self.loop.callLater(i * ramp_ms, self._beginNode, node)
+            else:
+                self._beginNode(node)
+
+    def run(self):
+        """!
+        @brief Ctrl+Cまでループを回す
+        """
+        try:
+            self.loop.runForever()
+        except KeyboardInterrupt:
+            pass
+        print("# DeviceFarm: multicast rx =", self.rx_multicast)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ECHONET Lite virtual device farm')
+    parser.add_argument('--aircon', type=int, default=0, help='エアコンの台数')
+    parser.add_argument('--light', type=int, default=0, help='一般照明の台数')
+    parser.add_argument('--lock', type=int, default=0, help='電気錠の台数')
+    parser.add_argument('--base-ip', default='127.0.1.1', help='最初のノードのアドレス')
+    parser.add_argument('--mcast-if', default='127.0.0.1', help='マルチキャストを受けるインタフェースのアドレス')
+    parser.add_argument('--ramp-ms', type=int, default=0, help='ノードごとの起動間隔[ms]')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+
+    counts = [['aircon', args.aircon], ['light', args.light], ['lock', args.lock]]
+    if sum(n for _, n in counts) == 0:
+        counts = [['aircon', 1], ['light', 1], ['lock', 1]]
+    farm = DeviceFarm(counts, args.base_ip, args.mcast_if, args.debug)
+    for node in farm.nodes:
+        print('|', node.ip, node.kind, node.el.getHexString(node.eoj))
+    print("| DeviceFarm:", len(farm.nodes), "nodes")
+    farm.start(args.ramp_ms)
+    farm.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+#!/usr/bin/python3
+"""!
+@file el_analyze.py
+@brief キャプチャしたECHONET Liteトラフィックの列指向解析(NumPy)
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details tcpdumpのキャプチャ(pcap/pcapng)を列ごとのNumPy配列にして、ベクトル演算で集計する。
+         - フレーム表: ts, src, dst, seoj, deoj, esv, tid, opc, 共有バッファ内のoffset, length, valid
+         - プロパティ表: frame(フレーム表の行), epc, pdc, edt(共有バッファ内のEDTのoffset), section(SETGETの後半なら1)
+         - 集計: TIDによる要求と応答の対応付け、機器ごとの応答遅延分布、EPCごとのINF頻度、機器ごとのSNA率
+         フレームの解析はparseDetails()の辞書を作らず、OPCの何番目かごとに全フレームをまとめて進める。
+         numpyが必要(pip install numpy)。
+         例: python3 el_analyze.py week.pcapng --save week.npz
+             python3 el_analyze.py --load week.npz --json
+"""
+import json
+import os
+import sys
+import time
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from el_pcap import readUDP
+
+MULTICAST_ADDRS = ['224.0.23.0', 'ff02:0:0:0:0:0:0:1']
+SETGET_ESVS = [0x6E, 0x7E, 0x5E]
+INF_ESVS = [0x73, 0x74]
+
+# 要求ESV: [正常応答ESV, 不可応答ESV]、SETIは正常時に応答しない
+REQUESTS = {
+    0x60: [None, 0x50], # SETI
+    0x61: [0x71, 0x51], # SETC
+    0x62: [0x72, 0x52], # GET
+    0x63: [0x73, 0x53], # INF_REQ
+    0x6E: [0x7E, 0x5E], # SETGET
+}
+
+
+def _familyTables():
+    """!
+    @brief ESVから要求/応答の種類番号を引く表を作る内部関数
+    @return (reqFamily, resFamily) 0は該当なし
+    """
+    reqFamily = np.zeros(256, np.int64)
+    resFamily = np.zeros(256, np.int64)
+    for n, esv in enumerate(sorted(REQUESTS)):
+        reqFamily[esv] = n + 1
+        for r in REQUESTS[esv]:
+            if r is not None:
+                resFamily[r] = n + 1
+    return reqFamily, resFamily
+
+
+class Capture():
+    """!
+    @brief キャプチャの列指向表現
+    """
+    FRAME_COLUMNS = ['ts', 'src', 'dst', 'seoj', 'deoj', 'esv', 'tid', 'opc', 'offset', 'length', 'valid']
+    PROPERTY_COLUMNS = ['frame', 'epc', 'pdc', 'edt', 'section']
+
+    def __init__(self):
+        """!
+        @brief コンストラクタ、load()かfromPcap()で作る
+        """
+        self.buf = None # 全フレームを連結した共有バッファ uint8
+        self.addrs = [] # src, dst の番号 -> IPアドレス文字列
+        self.dropped = 0 # ECHONET Liteのヘッダを持たないUDP/3610
+        for name in self.FRAME_COLUMNS + self.PROPERTY_COLUMNS:
+            setattr(self, name, None)
+
+    @classmethod
+    def fromPcap(cls, path):
+        """!
+        @brief pcap/pcapngから作る
+        @param path (str)
+        @return Capture
+        """
+        buf = bytearray()
+        ts = array('d')
+        src = array('I')
+        dst = array('I')
+        offset = array('q')
+        length = array('I')
+        ids = {}
+        addrs = []
+        for t, s, d, payload in readUDP(path):
+            for a in (s, d):
+                if a not in ids:
+                    ids[a] = len(addrs)
+                    addrs.append(a)
+            ts.append(t)
+            src.append(ids[s])
+            dst.append(ids[d])
+            offset.append(len(buf))
+            length.append(len(payload))
+            buf += payload
+        self = cls()
+        self.addrs = addrs
+        self.buf = np.frombuffer(bytes(buf), np.uint8)
+        self._build(np.frombuffer(ts, np.float64), np.frombuffer(src, np.uint32), np.frombuffer(dst, np.uint32),
+                    np.frombuffer(offset, np.int64), np.frombuffer(length, np.uint32).astype(np.int64))
+        return self
+
+    def _build(self, ts, src, dst, offset, length):
+        """!
+        @brief ヘッダとプロパティを列にする内部関数
+        """
+        buf = self.buf
+        # EHDとヘッダ長を満たすものだけ残す
+        ok = length >= 12
+        head = offset[ok]
+        ok[ok] = (buf[head] == 0x10) & (buf[head + 1] == 0x81)
+        self.dropped = int(len(ok) - ok.sum())
+        self.ts, self.src, self.dst, self.offset, self.length = ts[ok], src[ok], dst[ok], offset[ok], length[ok]
+        off = self.offset
+        b = lambda k: buf[off + k].astype(np.uint32)
+        self.tid = (b(2) << 8 | b(3)).astype(np.uint16)
+        self.seoj = b(4) << 16 | b(5) << 8 | b(6)
+        self.deoj = b(7) << 16 | b(8) << 8 | b(9)
+        self.esv = buf[off + 10]
+        self.opc = buf[off + 11]
+        self._parseProperties()
+
+    def _parseProperties(self):
+        """!
+        @brief EPC, PDC, EDTを全フレームまとめて読む内部関数
+        @details OPCのk番目のプロパティを全フレーム分ベクトル演算で読み、posを進める。
+                 フレーム長を超えるものはvalid=Falseにしてプロパティ表から除く。
+        """
+        buf = self.buf
+        n = len(self.offset)
+        end = self.offset + self.length
+        pos = self.offset + 12
+        alive = np.ones(n, bool)
+        setget = np.isin(self.esv, SETGET_ESVS)
+        cols = [[], [], [], [], []] # frame, epc, pdc, edt, section
+        for section in (0, 1):
+            remaining = np.zeros(n, np.int64)
+            if section == 0:
+                member = np.ones(n, bool)
+                remaining[:] = self.opc
+            else:
+                # SETGETは後半のOPCが続く
+                sel = np.nonzero(alive & setget)[0]
+                short = pos[sel] >= end[sel]
+                alive[sel[short]] = False
+                sel = sel[~short]
+                remaining[sel] = buf[pos[sel]]
+                pos[sel] += 1
+                member = np.zeros(n, bool)
+                member[sel] = True
+            kmax = int(remaining[member].max()) if member.any() else 0
+            for k in range(kmax):
+                sel = np.nonzero(alive & member & (remaining > k))[0]
+                if sel.size == 0:
+                    break
+                p = pos[sel]
+                short = p + 2 > end[sel]
+                alive[sel[short]] = False
+                sel, p = sel[~short], p[~short]
+                pdc = buf[p + 1].astype(np.int64)
+                over = p + 2 + pdc > end[sel]
+                alive[sel[over]] = False
+                sel, p, pdc = sel[~over], p[~over], pdc[~over]
+                cols[0].append(sel)
+                cols[1].append(buf[p])
+                cols[2].append(pdc.astype(np.uint8))
+                cols[3].append(p + 2)
+                cols[4].append(np.full(sel.size, section, np.uint8))
+                pos[sel] = p + 2 + pdc
+        dtypes = [np.int64, np.uint8, np.uint8, np.int64, np.uint8]
+        merged = [np.concatenate(c) if c else np.zeros(0, t) for c, t in zip(cols, dtypes)]
+        order = np.argsort(merged[0], kind='stable') # フレーム順に並べる
+        keep = alive[merged[0][order]]
+        self.frame, self.epc, self.pdc, self.edt, self.section = [c[order][keep] for c in merged]
+        self.valid = alive
+
+    def edtBytes(self, row):
+        """!
+        @brief プロパティ表のrow行目のEDT
+        @return bytes
+        """
+        return self.buf[self.edt[row]:self.edt[row] + self.pdc[row]].tobytes()
+
+    def save(self, path):
+        """!
+        @brief npzに保存する
+        """
+        columns = {}
+        for name in self.FRAME_COLUMNS + self.PROPERTY_COLUMNS:
+            columns[name] = getattr(self, name)
+        np.savez(path, buf=self.buf, addrs=np.array(self.addrs), dropped=self.dropped, **columns)
+
+    @classmethod
+    def load(cls, path):
+        """!
+        @brief save()したnpzから作る
+        @return Capture
+        """
+        self = cls()
+        with np.load(path) as z:
+            self.buf = z['buf']
+            self.addrs = [str(a) for a in z['addrs']]
+            self.dropped = int(z['dropped'])
+            for name in self.FRAME_COLUMNS + self.PROPERTY_COLUMNS:
+                setattr(self, name, z[name])
+        return self
+
+    #=================================================================
+    # 集計
+    def duration(self):
+        """!
+        @brief キャプチャの長さ[s]
+        """
+        if len(self.ts) < 2:
+            return 0.0
+        return float(self.ts.max() - self.ts.min())
+
+    def multicastIds(self):
+        """!
+        @brief マルチキャストアドレスの番号
+        @return ndarray
+        """
+        return np.array([i for i, a in enumerate(self.addrs) if a in MULTICAST_ADDRS], np.uint32)
+
+    def pairRequests(self):
+        """!
+        @brief TIDで要求と応答を対応付ける
+        @details 要求と応答を (TID, 要求の種類, コントローラのEOJ) で突き合わせ、応答より前で最後の要求を選ぶ。
+                 要求がユニキャストなら応答の送信元が要求の宛先と一致するものだけ。
+                 マルチキャスト要求には複数の機器の応答が対応する。
+                 送信元と宛先が同じ要求(Recorderで記録した自分のマルチキャストの受信など)は要求として扱わない。
+        @return dict req, res (フレーム表の行), latency[s]
+        """
+        reqFamily, resFamily = _familyTables()
+        ok = self.valid
+        isReq = ok & (reqFamily[self.esv] > 0) & (self.src != self.dst)
+        isRes = ok & (resFamily[self.esv] > 0)
+        req = np.nonzero(isReq)[0]
+        res = np.nonzero(isRes)[0]
+        empty = np.zeros(0, np.int64)
+        if req.size == 0 or res.size == 0:
+            return {'req': empty, 'res': empty, 'latency': np.zeros(0)}
+        # 要求はSEOJ、応答はDEOJがコントローラ
+        keys = np.concatenate([
+            np.stack([self.tid[req], reqFamily[self.esv[req]], self.seoj[req]], 1),
+            np.stack([self.tid[res], resFamily[self.esv[res]], self.deoj[res]], 1)]).astype(np.int64)
+        _, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1).astype(np.int64)
+        reqComp = inverse[:req.size] << 32 | req
+        resComp = inverse[req.size:] << 32 | res
+        order = np.argsort(reqComp)
+        reqSorted = reqComp[order]
+        i = np.searchsorted(reqSorted, resComp, side='right') - 1
+        hit = i >= 0
+        i = np.where(hit, i, 0)
+        hit &= (reqSorted[i] >> 32) == (resComp >> 32)
+        matchedReq = req[order[i]]
+        mcast = np.isin(self.dst[matchedReq], self.multicastIds())
+        hit &= mcast | (self.dst[matchedReq] == self.src[res])
+        pr, ps = matchedReq[hit], res[hit]
+        return {'req': pr, 'res': ps, 'latency': self.ts[ps] - self.ts[pr]}
+
+    def latencyByDevice(self, pairs=None):
+        """!
+        @brief 機器(応答の送信元)ごとの応答遅延分布
+        @param pairs pairRequests()の結果
+        @return dict ip -> {count, p50_ms, p95_ms, p99_ms, max_ms}
+        """
+        if pairs is None:
+            pairs = self.pairRequests()
+        dev = self.src[pairs['res']]
+        lat = pairs['latency'] * 1000.0
+        order = np.lexsort((lat, dev))
+        dev, lat = dev[order], lat[order]
+        ids, start, counts = np.unique(dev, return_index=True, return_counts=True)
+        result = {}
+        for d, s, c in zip(ids, start, counts):
+            v = lat[s:s + c]
+            p = np.percentile(v, [50, 95, 99])
+            result[self.addrs[d]] = {'count': int(c), 'p50_ms': round(float(p[0]), 3), 'p95_ms': round(float(p[1]), 3),
+                                     'p99_ms': round(float(p[2]), 3), 'max_ms': round(float(v[-1]), 3)}
+        return result
+
+    def infRateByEPC(self):
+        """!
+        @brief EPCごとのINF/INFCの頻度
+        @return dict 'epc(16進)' -> {count, per_s, devices}
+        """
+        inf = np.isin(self.esv[self.frame], INF_ESVS)
+        epc = self.epc[inf]
+        src = self.src[self.frame[inf]].astype(np.int64)
+        seconds = self.duration()
+        result = {}
+        values, counts = np.unique(epc, return_counts=True)
+        pairs = np.unique(epc.astype(np.int64) << 32 | src)
+        devices = np.bincount((pairs >> 32).astype(np.int64), minlength=256)
+        for e, c in zip(values, counts):
+            result['{:02x}'.format(int(e))] = {'count': int(c), 'per_s': round(c / seconds, 6) if seconds > 0 else None,
+                                               'devices': int(devices[e])}
+        return result
+
+    def snaRatio(self, pairs=None):
+        """!
+        @brief 機器ごとの不可応答(SNA)の割合
+        @details INF(0x73)は自発的な通知がほとんどなので、INF_REQへの応答としてpairRequests()で対応付いたものだけを数える
+        @param pairs pairRequests()の結果
+        @return dict ip -> {responses, sna, ratio}
+        """
+        if pairs is None:
+            pairs = self.pairRequests()
+        _, resFamily = _familyTables()
+        res = self.valid & (resFamily[self.esv] > 0) & (self.esv != 0x73)
+        res[pairs['res'][self.esv[pairs['res']] == 0x73]] = True
+        sna = res & ((self.esv & 0xF0) == 0x50)
+        total = np.bincount(self.src[res].astype(np.int64), minlength=len(self.addrs))
+        bad = np.bincount(self.src[sna].astype(np.int64), minlength=len(self.addrs))
+        result = {}
+        for d in np.nonzero(total)[0]:
+            result[self.addrs[d]] = {'responses': int(total[d]), 'sna': int(bad[d]), 'ratio': round(float(bad[d] / total[d]), 6)}
+        return result
+
+    def report(self):
+        """!
+        @brief 全集計
+        @return dict
+        """
+        pairs = self.pairRequests()
+        reqFamily, _ = _familyTables()
+        requests = int((self.valid & (reqFamily[self.esv] > 0) & (self.esv != 0x60)).sum())
+        answered = int(np.unique(pairs['req']).size)
+        return {
+            'frames': int(len(self.ts)),
+            'invalid': int((~self.valid).sum()),
+            'not_echonet': self.dropped,
+            'properties': int(len(self.epc)),
+            'duration_s': round(self.duration(), 3),
+            'requests': requests,
+            'answered': answered,
+            'pairs': int(pairs['res'].size),
+            'latency_by_device': self.latencyByDevice(pairs),
+            'inf_rate_by_epc': self.infRateByEPC(),
+            'sna_ratio': self.snaRatio(pairs),
+        }
+
+
+def printReport(r):
+    """!
+    @brief report()を表で表示する
+    """
+    print('frames: {frames}, invalid: {invalid}, not ECHONET Lite: {not_echonet}, properties: {properties}, duration: {duration_s} s'.format(**r))
+    print('requests: {requests}, answered: {answered}, request/response pairs: {pairs}'.format(**r))
+    print('{:40s} {:>8s} {:>9s} {:>9s} {:>9s} {:>9s}'.format('device', 'count', 'p50[ms]', 'p95[ms]', 'p99[ms]', 'max[ms]'))
+    for ip, v in sorted(r['latency_by_device'].items()):
+        print('{:40s} {:8d} {:9.3f} {:9.3f} {:9.3f} {:9.3f}'.format(ip, v['count'], v['p50_ms'], v['p95_ms'], v['p99_ms'], v['max_ms']))
+    print('{:4s} {:>10s} {:>12s} {:>8s}'.format('epc', 'inf', 'per_s', 'devices'))
+    for epc, v in sorted(r['inf_rate_by_epc'].items()):
+        print('{:4s} {:10d} {:>12} {:8d}'.format(epc, v['count'], v['per_s'], v['devices']))
+    print('{:40s} {:>10s} {:>8s} {:>9s}'.format('device', 'responses', 'sna', 'ratio'))
+    for ip, v in sorted(r['sna_ratio'].items()):
+        print('{:40s} {:10d} {:8d} {:9.4f}'.format(ip, v['responses'], v['sna'], v['ratio']))
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Columnar analytics over ECHONET Lite captures')
+    parser.add_argument('capture', nargs='?', help='pcap/pcapngファイル')
+    parser.add_argument('--load', help='save()したnpzを読む')
+    parser.add_argument('--save', help='列をnpzに保存する')
+    parser.add_argument('--json', action='store_true', help='JSONで出力する')
+    args = parser.parse_args()
+    if np is None:
+        print('el_analyze.py needs numpy: pip install numpy')
+        sys.exit(1)
+    if not args.capture and not args.load:
+        parser.error('capture or --load is required')
+
+    start = time.perf_counter()
+    cap = Capture.load(args.load) if args.load else Capture.fromPcap(args.capture)
+    loaded = time.perf_counter() - start
+    if args.save:
+        cap.save(args.save)
+    start = time.perf_counter()
+    r = cap.report()
+    r['load_s'] = round(loaded, 3)
+    r['analyze_s'] = round(time.perf_counter() - start, 3)
+    if args.json:
+        print(json.dumps(r, indent=1))
+    else:
+        printReport(r)
+        print('load: {} s, analyze: {} s'.format(r['load_s'], r['analyze_s']))
+
+
+if __name__ == '__main__':
+    main()
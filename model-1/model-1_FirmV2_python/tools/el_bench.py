@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+"""!
+@file el_bench.py
+@brief EchonetLiteのフレーム解析と返信処理のマイクロベンチマーク
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details verifyPacket, parseDetails, returner(GET/SETC/INF_REQ/インスタンス0), sendDetails,
+         SetMyPropertyMap, parsePropertyMap の1フレームあたりの処理速度とメモリ確保量を測る。
+         MemoryTransportを使うのでネットワークは不要。結果はJSONで出力する。
+         - PC: python3 el_bench.py --out result.json --baseline base.json
+         - ESP32: mpremote run el_bench.py > esp32.json (EchonetLiteを書き込み済みであること)
+           python3 el_bench.py --compare esp32.json --baseline esp32_base.json
+         メモリ確保量はMicroPythonではgcを止めてgc.mem_alloc()の差分(確保した総byte数)、
+         CPythonではtracemallocのピーク(1フレーム処理中の一時確保の最大byte数)で測る。
+"""
+import sys
+import time
+import gc
+import json
+
+MICROPYTHON = sys.implementation.name == 'micropython'
+
+if not MICROPYTHON:
+    import os
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ECHONET_Lite_AirConditioner'))
+    import tracemalloc
+
+from EchonetLite import EchonetLite, PDCEDT, ELOBJ
+from EchonetLite.Transport import MemoryNetwork, MemoryTransport
+
+DEOJ_AIRCON = [0x01, 0x30, 0x01]
+CONTROLLER_IP = '10.255.255.254' # MemoryNetworkに参加していないので返信は捨てられる
+
+# 入力フレーム
+FRAME_GET = [0x10, 0x81, 0x00, 0x01, 0x05, 0xff, 0x01, 0x01, 0x30, 0x01, 0x62, 0x03, 0x80, 0x00, 0xb0, 0x00, 0xb3, 0x00]
+FRAME_SETC = [0x10, 0x81, 0x00, 0x02, 0x05, 0xff, 0x01, 0x01, 0x30, 0x01, 0x61, 0x01, 0x80, 0x01, 0x30]
+FRAME_INF_REQ = [0x10, 0x81, 0x00, 0x03, 0x05, 0xff, 0x01, 0x01, 0x30, 0x01, 0x63, 0x01, 0x80, 0x00]
+FRAME_GET_INSTANCE0 = [0x10, 0x81, 0x00, 0x04, 0x05, 0xff, 0x01, 0x01, 0x30, 0x00, 0x62, 0x01, 0x80, 0x00]
+FRAME_GET_NODEPROFILE = [0x10, 0x81, 0x00, 0x05, 0x05, 0xff, 0x01, 0x0e, 0xf0, 0x01, 0x62, 0x01, 0xd6, 0x00]
+MAP_SMALL = [0x80, 0x8F, 0xA0, 0xB0, 0xB3, 0xB4, 0xB5, 0xB6, 0xB7]
+MAP_LARGE = [0x80, 0x81, 0x82, 0x83, 0x88, 0x8A, 0x8E, 0x8F, 0xA0, 0xB0, 0xB3, 0xB4, 0xB5, 0xB6, 0xB7, 0xBA, 0xBB, 0x9D, 0x9E, 0x9F]
+
+
+def makeDevice():
+    """!
+    @brief ベンチマーク用のエアコン相当のEchonetLiteを作る
+    @return EchonetLite
+    @note begin()しないのでMemoryNetworkに参加せず、自分の送ったマルチキャストも受けない
+    """
+    net = MemoryNetwork()
+    el = EchonetLite([DEOJ_AIRCON[:]], {'transport': MemoryTransport(net), 'mac': [0x02, 0, 0, 0, 0, 1], 'replyCache': 0})
+    for epc, edt in [[0x80, [0x31]], [0x8F, [0x42]], [0xA0, [0x41]], [0xB0, [0x41]], [0xB3, [0x19]]]:
+        el.devices['013001'].SetEDT(epc, edt)
+    el.devices['013001'].SetMyPropertyMap(0x9d, [0x80, 0x8F, 0xA0, 0xB0])
+    el.devices['013001'].SetMyPropertyMap(0x9e, MAP_SMALL[:])
+    el.devices['013001'].SetMyPropertyMap(0x9f, MAP_LARGE[:])
+
+    def setFunc(ip, tid, seoj, deoj, esv, opc, epc, pdcedt):
+        el.update(deoj, epc, pdcedt.edt) # ファームウェアと同じく状態更新とINF送信をする
+        return True
+    el.userSetFunc = setFunc
+    return el, net
+
+
+def cases(el):
+    """!
+    @brief 計測対象の一覧
+    @param el (EchonetLite)
+    @return list [[名前, 1フレーム分の処理], ...]
+    """
+    details_get = FRAME_GET[EchonetLite.EPC:]
+    pdcedts = {0x80: PDCEDT([1, 0x30]), 0xb0: PDCEDT([1, 0x41]), 0xb3: PDCEDT([1, 0x19])}
+    map1 = PDCEDT()
+    map1.setEDT([len(MAP_SMALL)] + MAP_SMALL)
+    map2 = el.devices['013001'][0x9f]
+    obj = ELOBJ()
+    return [
+        ['verifyPacket', lambda: el.verifyPacket(FRAME_GET)],
+        ['parseDetails', lambda: el.parseDetails(EchonetLite.GET, 3, details_get)],
+        ['returner_GET', lambda: el.returner(CONTROLLER_IP, FRAME_GET)],
+        ['returner_SETC', lambda: el.returner(CONTROLLER_IP, FRAME_SETC)],
+        ['returner_INF_REQ', lambda: el.returner(CONTROLLER_IP, FRAME_INF_REQ)],
+        ['returner_GET_instance0', lambda: el.returner(CONTROLLER_IP, FRAME_GET_INSTANCE0)],
+        ['returner_GET_nodeprofile', lambda: el.returner(CONTROLLER_IP, FRAME_GET_NODEPROFILE)],
+        ['sendDetails', lambda: el.sendDetails(CONTROLLER_IP, [0, 1], DEOJ_AIRCON, EchonetLite.EOJ_Controller, EchonetLite.GET_RES, 3, pdcedts)],
+        ['SetMyPropertyMap_format1', lambda: obj.SetMyPropertyMap(0x9e, MAP_SMALL[:])],
+        ['SetMyPropertyMap_format2', lambda: obj.SetMyPropertyMap(0x9f, MAP_LARGE[:])],
+        ['parsePropertyMap_format1', lambda: el.parsePropertyMap(map1)],
+        ['parsePropertyMap_format2', lambda: el.parsePropertyMap(map2)],
+    ]
+
+
+def now_us():
+    """!
+    @brief マイクロ秒の時刻
+    @return int|float
+    """
+    if MICROPYTHON:
+        return time.ticks_us()
+    return time.perf_counter() * 1000000
+
+def elapsed_us(start):
+    """!
+    @brief startからの経過マイクロ秒
+    @return int|float
+    """
+    if MICROPYTHON:
+        return time.ticks_diff(time.ticks_us(), start)
+    return time.perf_counter() * 1000000 - start
+
+
+def measureAlloc(func, n):
+    """!
+    @brief 1フレームあたりのメモリ確保量を測る
+    @param func 1フレーム分の処理
+    @param n (int) 繰り返し回数
+    @return (int, str) byte数と測り方
+    """
+    if MICROPYTHON:
+        gc.collect()
+        gc.disable()
+        before = gc.mem_alloc()
+        for _ in range(n):
+            func()
+        after = gc.mem_alloc()
+        gc.enable()
+        return (after - before) // n, 'gc.mem_alloc'
+    tracemalloc.start()
+    func() # 初回だけの確保を除く
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak - base, 'tracemalloc.peak'
+
+
+def run(n, rounds=3):
+    """!
+    @brief 全ケースを計測する
+    @param n (int) ケースごとの繰り返し回数
+    @param rounds (int) 計測回数、最も速かった回を採用してゆらぎを抑える
+    @return dict
+    """
+    el, net = makeDevice()
+    results = []
+    for name, func in cases(el):
+        for _ in range(min(n, 100)): # ウォームアップ
+            func()
+        us = 0
+        for _ in range(rounds):
+            gc.collect()
+            start = now_us()
+            for _ in range(n):
+                func()
+            t = elapsed_us(start)
+            if us == 0 or t < us:
+                us = t
+        alloc, method = measureAlloc(func, min(n, 50) if MICROPYTHON else 1)
+        results.append({
+            'name': name,
+            'n': n,
+            'us_per_frame': round(us / n, 3),
+            'fps': round(n * 1000000 / us, 1) if us > 0 else 0,
+            'alloc_bytes': alloc,
+            'alloc_method': method,
+        })
+    return {
+        'implementation': sys.implementation.name,
+        'platform': sys.platform,
+        'version': sys.version.split(' ')[0],
+        'rounds': rounds,
+        'results': results,
+    }
+
+
+def compare(current, baseline, threshold):
+    """!
+    @brief ベースラインと比較して表示する
+    @param current (dict) run()の結果
+    @param baseline (dict) run()の結果
+    @param threshold (float) この割合以上遅くなったら劣化とみなす
+    @return bool 劣化が無ければTrue
+    """
+    base = {}
+    for r in baseline['results']:
+        base[r['name']] = r
+    ok = True
+    print('{:28s} {:>12s} {:>12s} {:>8s} {:>10s}'.format('case', 'fps', 'base fps', 'ratio', 'alloc'))
+    for r in current['results']:
+        b = base.get(r['name'])
+        if b is None or b['fps'] == 0:
+            print('{:28s} {:12.1f} {:>12s}'.format(r['name'], r['fps'], '-'))
+            continue
+        ratio = r['fps'] / b['fps']
+        mark = ''
+        if ratio < 1.0 - threshold:
+            mark = ' REGRESSION'
+            ok = False
+        print('{:28s} {:12.1f} {:12.1f} {:8.2f} {:>10s}{}'.format(
+            r['name'], r['fps'], b['fps'], ratio, '{}/{}'.format(r['alloc_bytes'], b['alloc_bytes']), mark))
+    return ok
+
+
+def main():
+    if MICROPYTHON:
+        # mpremote run では引数を渡せないので既定値で実行してJSONだけ出力する
+        print(json.dumps(run(500)))
+        return
+
+    import argparse
+    parser = argparse.ArgumentParser(description='EchonetLite micro benchmark')
+    parser.add_argument('-n', type=int, default=20000, help='ケースごとの繰り返し回数')
+    parser.add_argument('--rounds', type=int, default=3, help='計測回数、最速の回を採用')
+    parser.add_argument('--out', help='結果をJSONで保存するファイル')
+    parser.add_argument('--baseline', help='比較するベースラインのJSON')
+    parser.add_argument('--compare', help='実行せずに、このJSON(ESP32の結果など)をベースラインと比較する')
+    parser.add_argument('--threshold', type=float, default=0.10, help='劣化とみなす割合')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare) as f:
+            current = json.load(f)
+    else:
+        current = run(args.n, args.rounds)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(current, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(current, baseline, args.threshold):
+            sys.exit(1)
+    elif not args.out:
+        print(json.dumps(current, indent=1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,432 @@
+#!/usr/bin/python3
+"""!
+@file el_bundle.py
+@brief ファームウェアごとに不要なコードを落としたEchonetLiteパッケージを作る
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details ファームウェアのフォルダ(main.pyのあるところ)を読み、書き込み用のフォルダを作る。
+         EchonetLiteパッケージの各モジュールはastで読み、次のようにしてから書き出す。
+         - env の判定を --target の値で畳み込む。env == 'esp32' などの分岐は片方だけ残る
+         - __name__ もモジュール名で畳み込むので、単体テストの __main__ ブロックとimportの3分岐が1つになる
+         - self.debug をFalseとして畳み込み、デバッグ表示を消す (--keep-debug で残す)
+         - docstringとコメントを消し、使わなくなったimportを消す
+         - __init__.py の再エクスポートは、ファームウェアのスクリプトがimportする名前だけに絞り、
+           どこからもimportされないモジュール(Recorderなど)は書き出さない
+         ファームウェア直下のスクリプト(main.pyなど)はそのままコピーする。
+         --mpy を付けるとパッケージを.mpyにコンパイルする。出力したフォルダは Python_焼き込み.py でそのまま書き込める。
+         Python 3.9以降 (ast.unparse)
+         例: python3 el_bundle.py ../ECHONET_Lite_AirConditioner -o ../build/aircon
+             python3 el_bundle.py ../ECHONET_Lite_GeneralLight -o ../build/light --mpy rv32imc
+"""
+import argparse
+import ast
+import os
+import shutil
+import subprocess
+import sys
+
+PACKAGE = 'EchonetLite'
+TARGETS = ['esp32', 'rp2', 'Linux', 'Darwin', 'Windows']
+MICROPYTHON_TARGETS = ['esp32', 'rp2']
+
+
+class Shaker(ast.NodeTransformer):
+    """!
+    @brief 一つのモジュールの定数を畳み込み、通らない分岐を消す
+    """
+    def __init__(self, target, modname, keepDebug=False):
+        """!
+        @brief コンストラクタ
+        @param target (str) envの値
+        @param modname (str) __name__の値
+        @param keepDebug (bool) self.debugを畳み込まない
+        """
+        self.target = target
+        self.modname = modname
+        self.keepDebug = keepDebug
+        self.micropython = target in MICROPYTHON_TARGETS
+
+    @staticmethod
+    def constant(node):
+        """!
+        @brief 畳み込めた値
+        @return (bool, value) 定数でなければ (False, None)
+        """
+        if isinstance(node, ast.Constant):
+            return True, node.value
+        return False, None
+
+    def body(self, stmts):
+        """!
+        @brief 文の並びを変換する。return などの後ろの文は消す
+        """
+        out = []
+        for stmt in stmts:
+            result = self.visit(stmt)
+            if result is None:
+                continue
+            out.extend(result if isinstance(result, list) else [result])
+            if out and isinstance(out[-1], (ast.Return, ast.Raise, ast.Continue, ast.Break)):
+                break # 分岐を畳み込んだ結果、後ろの文には来ない
+        return out
+
+    def visit_Module(self, node):
+        node.body = self.body(node.body)
+        return node
+
+    def visit_FunctionDef(self, node):
+        node.decorator_list = [self.visit(d) for d in node.decorator_list]
+        node.args = self.visit(node.args)
+        node.body = self.body(node.body) or [ast.Pass()]
+        return node
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node):
+        node.bases = [self.visit(b) for b in node.bases]
+        node.body = self.body(node.body) or [ast.Pass()]
+        return node
+
+    def visit_If(self, node):
+        node.test = self.visit(node.test)
+        known, value = Shaker.constant(node.test)
+        if known:
+            return self.body(node.body if value else node.orelse)
+        node.body = self.body(node.body) or [ast.Pass()]
+        node.orelse = self.body(node.orelse)
+        return node
+
+    def visit_While(self, node):
+        node.test = self.visit(node.test)
+        known, value = Shaker.constant(node.test)
+        if known and not value:
+            return self.body(node.orelse)
+        node.body = self.body(node.body) or [ast.Pass()]
+        node.orelse = self.body(node.orelse)
+        return node
+
+    def visit_For(self, node):
+        node.target = self.visit(node.target)
+        node.iter = self.visit(node.iter)
+        node.body = self.body(node.body) or [ast.Pass()]
+        node.orelse = self.body(node.orelse)
+        return node
+
+    visit_AsyncFor = visit_For
+
+    def visit_With(self, node):
+        node.items = [self.visit(i) for i in node.items]
+        node.body = self.body(node.body) or [ast.Pass()]
+        return node
+
+    def visit_Try(self, node):
+        node.body = self.body(node.body) or [ast.Pass()]
+        node.handlers = [self.visit(h) for h in node.handlers]
+        node.orelse = self.body(node.orelse)
+        node.finalbody = self.body(node.finalbody)
+        return node
+
+    def visit_ExceptHandler(self, node):
+        if node.type is not None:
+            node.type = self.visit(node.type)
+        node.body = self.body(node.body) or [ast.Pass()]
+        return node
+
+    def visit_Expr(self, node):
+        node.value = self.visit(node.value)
+        if isinstance(node.value, ast.Constant): # docstring、畳み込んだ後のデバッグ表示
+            return None
+        return node
+
+    def visit_Assign(self, node):
+        node.value = self.visit(node.value)
+        if len(node.targets) == 1 and isinstance(node.targets[0], ast.Name) and node.targets[0].id == 'env':
+            node.value = ast.Constant(self.target)
+        return node
+
+    def visit_IfExp(self, node):
+        node.test = self.visit(node.test)
+        known, value = Shaker.constant(node.test)
+        if known:
+            return self.visit(node.body if value else node.orelse)
+        node.body = self.visit(node.body)
+        node.orelse = self.visit(node.orelse)
+        return node
+
+    def visit_BoolOp(self, node):
+        values = [self.visit(v) for v in node.values]
+        isOr = isinstance(node.op, ast.Or)
+        rest = []
+        for v in values:
+            known, value = Shaker.constant(v)
+            if not known:
+                rest.append(v)
+            elif bool(value) == isOr: # or のTrue、and のFalseで決まる
+                if not rest:
+                    return ast.Constant(value)
+                rest.append(v)
+                break
+        if not rest:
+            return ast.Constant(not isOr)
+        if len(rest) == 1:
+            return rest[0]
+        node.values = rest
+        return node
+
+    def visit_UnaryOp(self, node):
+        node.operand = self.visit(node.operand)
+        known, value = Shaker.constant(node.operand)
+        if known and isinstance(node.op, ast.Not):
+            return ast.Constant(not value)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) != 1 or not isinstance(node.ops[0], (ast.Eq, ast.NotEq)):
+            return node
+        left = node.left
+        known, right = Shaker.constant(node.comparators[0])
+        if not known or not isinstance(left, ast.Name):
+            return node
+        if left.id == 'env':
+            value = self.target
+        elif left.id == '__name__':
+            value = self.modname
+        else:
+            return node
+        return ast.Constant((value == right) == isinstance(node.ops[0], ast.Eq))
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        # hasattr(os, 'name') はCPython、hasattr(os, 'uname') はMicroPythonで環境を調べる時の書き方
+        if isinstance(node.func, ast.Name) and node.func.id == 'hasattr' and len(node.args) == 2 \
+           and isinstance(node.args[0], ast.Name) and node.args[0].id == 'os' and isinstance(node.args[1], ast.Constant):
+            if node.args[1].value == 'name':
+                return ast.Constant(not self.micropython)
+            if node.args[1].value == 'uname':
+                return ast.Constant(self.micropython)
+        return node
+
+    def visit_Attribute(self, node):
+        self.generic_visit(node)
+        if not self.keepDebug and isinstance(node.ctx, ast.Load) and node.attr == 'debug' \
+           and isinstance(node.value, ast.Name) and node.value.id == 'self':
+            return ast.Constant(False)
+        return node
+
+
+def usedNames(tree):
+    """!
+    @brief モジュールの中で読まれている名前
+    @return set[str]
+    """
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Store):
+            names.add(node.id)
+    return names
+
+
+def dropUnused(tree):
+    """!
+    @brief モジュール直下の、使わなくなったimportと、一度も読まれないenvの代入を消す
+    """
+    used = usedNames(tree)
+    body = []
+    for stmt in tree.body:
+        if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+            stmt.names = [a for a in stmt.names if (a.asname or a.name.split('.')[0]) in used]
+            if not stmt.names:
+                continue
+        elif isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name) \
+             and stmt.targets[0].id == 'env' and 'env' not in used:
+            continue
+        body.append(stmt)
+    # envは畳み込んだ値を何度も代入しているので、最後の一つだけ残す
+    envs = [i for i, s in enumerate(body) if isinstance(s, ast.Assign) and len(s.targets) == 1
+            and isinstance(s.targets[0], ast.Name) and s.targets[0].id == 'env']
+    for i in reversed(envs[:-1]):
+        del body[i]
+    tree.body = body
+
+
+def importedNames(tree):
+    """!
+    @brief スクリプトがEchonetLiteパッケージからimportする名前とモジュール
+    @return (set[str] | None, set[str]) パッケージから直接importする名前(import EchonetLite なら全部なのでNone)、サブモジュール名
+    """
+    names = set()
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for a in node.names:
+                if a.name == PACKAGE:
+                    return None, modules
+                if a.name.startswith(PACKAGE + '.'):
+                    modules.add(a.name.split('.')[1])
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            if node.module == PACKAGE:
+                names.update(a.name for a in node.names)
+            elif node.module.startswith(PACKAGE + '.'):
+                modules.add(node.module.split('.')[1])
+    return names, modules
+
+
+def packageImports(tree):
+    """!
+    @brief パッケージ内のモジュールがimportする兄弟モジュール
+    @details EchonetLite.pyが使う時にimportする _load('モジュール名', ...) も数える
+    @return set[str]
+    """
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == '_load':
+            if node.args and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str):
+                modules.add(node.args[0].value)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level == 1 and node.module:
+                modules.add(node.module.split('.')[0])
+            elif node.level == 0 and node.module and node.module.startswith(PACKAGE + '.'):
+                modules.add(node.module.split('.')[1])
+    return modules
+
+
+def shakeInit(tree, names):
+    """!
+    @brief __init__.pyの再エクスポートを、使われる名前だけにする
+    @param names (set[str] | None) Noneなら全部残す
+    """
+    if names is None:
+        return
+    body = []
+    for stmt in tree.body:
+        if isinstance(stmt, ast.ImportFrom):
+            stmt.names = [a for a in stmt.names if (a.asname or a.name) in names]
+            if not stmt.names:
+                continue
+        body.append(stmt)
+    tree.body = body
+
+
+def findMpyCross():
+    """!
+    @brief mpy-crossの起動コマンド
+    @return list[str] | None
+    """
+    exe = shutil.which('mpy-cross')
+    if exe:
+        return [exe]
+    try:
+        import mpy_cross # pip install mpy-cross
+        return [sys.executable, '-m', 'mpy_cross']
+    except ImportError:
+        return None
+
+
+def bundle(src, out, target='esp32', keepDebug=False, mpy=None):
+    """!
+    @brief ファームウェアのフォルダから書き込み用のフォルダを作る
+    @param src (str) ファームウェアのフォルダ
+    @param out (str) 出力先、中身は消して作り直す
+    @param target (str) envの値
+    @param keepDebug (bool) デバッグ表示を残す
+    @param mpy (str | None) mpy-crossの-march、Noneならソースのまま
+    @return list[(str, int, int)] (ファイル, 元のバイト数, 出力のバイト数)
+    """
+    pkgSrc = os.path.join(src, PACKAGE)
+    if not os.path.isdir(pkgSrc):
+        raise FileNotFoundError("{} has no {} package".format(src, PACKAGE))
+    if os.path.exists(out):
+        shutil.rmtree(out)
+    os.makedirs(os.path.join(out, PACKAGE))
+    report = []
+
+    # ファームウェア直下はそのままコピーして、パッケージから何を使うかを調べる
+    names = set()
+    needed = set()
+    for name in sorted(os.listdir(src)):
+        path = os.path.join(src, name)
+        if name.startswith('.') or os.path.isdir(path):
+            continue
+        shutil.copy2(path, os.path.join(out, name))
+        report.append((name, os.path.getsize(path), os.path.getsize(path)))
+        if name.endswith('.py') and names is not None:
+            with open(path, encoding='utf-8') as f:
+                used, modules = importedNames(ast.parse(f.read()))
+            names = None if used is None else names | used
+            needed |= modules
+
+    # パッケージのモジュールを畳み込む
+    trees = {}
+    sizes = {}
+    for name in sorted(os.listdir(pkgSrc)):
+        if not name.endswith('.py'):
+            continue
+        mod = name[:-3]
+        with open(os.path.join(pkgSrc, name), encoding='utf-8') as f:
+            source = f.read()
+        sizes[mod] = len(source.encode('utf-8'))
+        tree = ast.parse(source)
+        if mod == '__init__':
+            shakeInit(tree, names)
+        modname = PACKAGE if mod == '__init__' else PACKAGE + '.' + mod
+        tree = Shaker(target, modname, keepDebug).visit(tree)
+        if mod != '__init__':
+            dropUnused(tree)
+        trees[mod] = tree
+
+    # __init__.pyとスクリプトから辿れるモジュールだけを書き出す
+    reachable = set()
+    todo = ['__init__'] + sorted(needed)
+    while todo:
+        mod = todo.pop()
+        if mod in reachable or mod not in trees:
+            continue
+        reachable.add(mod)
+        todo.extend(packageImports(trees[mod]))
+
+    mpyCross = None
+    if mpy:
+        mpyCross = findMpyCross()
+        if mpyCross is None:
+            print("mpy-cross not found, keep source (pip install mpy-cross)")
+    for mod in sorted(trees):
+        rel = PACKAGE + '/' + mod + '.py'
+        if mod not in reachable:
+            report.append((rel, sizes[mod], 0))
+            continue
+        code = ast.unparse(ast.fix_missing_locations(trees[mod])) + '\n'
+        compile(code, rel, 'exec') # 壊れた出力を書き込まないように
+        dst = os.path.join(out, PACKAGE, mod + '.py')
+        with open(dst, 'w', encoding='utf-8') as f:
+            f.write(code)
+        if mpyCross:
+            mpyDst = dst[:-3] + '.mpy'
+            subprocess.run(mpyCross + ['-march={}'.format(mpy), '-o', mpyDst, dst], check=True)
+            os.remove(dst)
+            rel = rel[:-3] + '.mpy'
+            dst = mpyDst
+        report.append((rel, sizes[mod], os.path.getsize(dst)))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a per-firmware EchonetLite bundle')
+    parser.add_argument('firmware', help='ファームウェアのフォルダ (main.pyとEchonetLite/のあるところ)')
+    parser.add_argument('-o', '--out', required=True, help='出力するフォルダ、中身は作り直す')
+    parser.add_argument('--target', default='esp32', choices=TARGETS, help='envの値')
+    parser.add_argument('--keep-debug', action='store_true', help='self.debugのデバッグ表示を残す')
+    parser.add_argument('--mpy', metavar='ARCH', help='パッケージを.mpyにする。mpy-crossの-march (rv32imc, xtensawin など)')
+    args = parser.parse_args()
+
+    report = bundle(args.firmware, args.out, args.target, args.keep_debug, args.mpy)
+    before = after = 0
+    for name, a, b in report:
+        print('{:40s} {:8d} -> {:8d}{}'.format(name, a, b, '  (dropped)' if b == 0 and a else ''))
+        before += a
+        after += b
+    print('{:40s} {:8d} -> {:8d} ({:.0%})'.format('total', before, after, after / before if before else 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+"""!
+@file el_freeze.py
+@brief EchonetLite、ESPWiFiConfigurator、main.pyを凍結モジュールにしたMicroPythonのファームウェアイメージを作る
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details el_bundle.pyで不要なコードを落としたものをマニフェストに書き、MicroPythonのesp32ポートをビルドする。
+         凍結モジュールはフラッシュから直接実行されるので、ヒープにバイトコードを持たずに済む。
+         - main.pyはそのまま凍結すると、ファイルシステムのmain.pyで差し替えられないので device_main として凍結し、
+           ファイルシステムには 'import device_main' だけのmain.pyを置く
+         - 出力フォルダには firmware.bin と、ファイルシステムに書くもの(fs/)を作る。
+           Python_焼き込み.py で firmware.bin をイメージとして、fs/ をプログラムフォルダとして選べば一度に書ける
+         - ファイルシステムに古いEchonetLite/が残っていると凍結モジュールより先にimportされるので、
+           fs/ は差分書き込みで(それ以外のファイルを消して)書くこと
+         MicroPythonのソースとESP-IDFの環境(export.shを実行済み)が必要。
+         例: python3 el_freeze.py ../ECHONET_Lite_AirConditioner --micropython ~/micropython --board ESP32_GENERIC_C3 -o ../build/aircon_image
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from el_bundle import bundle, PACKAGE
+
+FROZEN_MAIN = 'device_main' # 凍結したmain.pyのモジュール名
+BOARDS = ['ESP32_GENERIC_C3', 'ESP32_GENERIC_S3', 'ESP32_GENERIC']
+
+MANIFEST = '''# el_freeze.py で作成
+include("$(PORT_DIR)/boards/manifest.py")
+package("{package}", base_path="{stage}")
+{modules}
+'''
+
+
+def stage(src, out, keepDebug=False):
+    """!
+    @brief 凍結するファイルを用意する
+    @param src (str) ファームウェアのフォルダ
+    @param out (str) 作業フォルダ
+    @param keepDebug (bool) デバッグ表示を残す
+    @return list[str] 凍結するモジュールのファイル名(パッケージ以外)
+    """
+    bundle(src, out, 'esp32', keepDebug)
+    modules = []
+    for name in sorted(os.listdir(out)):
+        if not name.endswith('.py'):
+            continue
+        if name == 'main.py':
+            os.rename(os.path.join(out, name), os.path.join(out, FROZEN_MAIN + '.py'))
+            name = FROZEN_MAIN + '.py'
+        modules.append(name)
+    return modules
+
+
+def writeManifest(path, stageDir, modules):
+    """!
+    @brief 凍結マニフェストを書く
+    """
+    stageDir = os.path.abspath(stageDir).replace('\\', '/')
+    lines = ['module("{}", base_path="{}")'.format(m, stageDir) for m in modules]
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(MANIFEST.format(package=PACKAGE, stage=stageDir, modules='\n'.join(lines)))
+
+
+def writeFs(src, fsDir):
+    """!
+    @brief ファイルシステムに書くもの。凍結したmain.pyを起動するだけのmain.pyと、.py以外のファイル
+    """
+    os.makedirs(fsDir)
+    with open(os.path.join(fsDir, 'main.py'), 'w', encoding='utf-8') as f:
+        f.write('# {} is frozen into the firmware image\nimport {}\n'.format(FROZEN_MAIN, FROZEN_MAIN))
+    for name in sorted(os.listdir(src)):
+        path = os.path.join(src, name)
+        if name.startswith('.') or os.path.isdir(path) or name.endswith('.py') or name == 'wifi_config.csv':
+            continue
+        shutil.copy2(path, os.path.join(fsDir, name))
+
+
+def build(micropython, board, manifest, jobs=None):
+    """!
+    @brief esp32ポートをビルドする
+    @return str firmware.binのパス
+    """
+    make = ['make', '-j{}'.format(jobs or os.cpu_count() or 1)]
+    subprocess.run(make + ['-C', os.path.join(micropython, 'mpy-cross')], check=True)
+    port = os.path.join(micropython, 'ports', 'esp32')
+    subprocess.run(make + ['-C', port, 'BOARD={}'.format(board), 'FROZEN_MANIFEST={}'.format(os.path.abspath(manifest))], check=True)
+    return os.path.join(port, 'build-{}'.format(board), 'firmware.bin')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a MicroPython image with EchonetLite frozen in')
+    parser.add_argument('firmware', help='ファームウェアのフォルダ (main.pyとEchonetLite/のあるところ)')
+    parser.add_argument('-o', '--out', required=True, help='出力するフォルダ、中身は作り直す')
+    parser.add_argument('--micropython', default=os.environ.get('MICROPY_DIR'), help='MicroPythonのソース、省略時は$MICROPY_DIR')
+    parser.add_argument('--board', default='ESP32_GENERIC_C3', choices=BOARDS, help='esp32ポートのボード')
+    parser.add_argument('--keep-debug', action='store_true', help='self.debugのデバッグ表示を残す')
+    parser.add_argument('--manifest-only', action='store_true', help='マニフェストまで作ってビルドしない')
+    parser.add_argument('-j', '--jobs', type=int, help='makeの並列数')
+    args = parser.parse_args()
+
+    if os.path.exists(args.out):
+        shutil.rmtree(args.out)
+    stageDir = os.path.join(args.out, 'frozen')
+    modules = stage(args.firmware, stageDir, args.keep_debug)
+    manifest = os.path.join(args.out, 'manifest.py')
+    writeManifest(manifest, stageDir, modules)
+    writeFs(args.firmware, os.path.join(args.out, 'fs'))
+    print('manifest:', manifest)
+    if args.manifest_only:
+        return
+
+    if not args.micropython or not os.path.isdir(os.path.join(args.micropython, 'ports', 'esp32')):
+        sys.exit('MicroPython source not found, use --micropython or $MICROPY_DIR')
+    if 'IDF_PATH' not in os.environ:
+        sys.exit('ESP-IDF is not set up, run . $IDF_PATH/export.sh first')
+    image = build(args.micropython, args.board, manifest, args.jobs)
+    shutil.copy2(image, os.path.join(args.out, 'firmware.bin'))
+    print('image:', os.path.join(args.out, 'firmware.bin'), os.path.getsize(image), 'bytes')
+    print('fs:', os.path.join(args.out, 'fs'))
+
+
+if __name__ == '__main__':
+    main()
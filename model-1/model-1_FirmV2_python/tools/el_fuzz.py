@@ -0,0 +1,481 @@
+#!/usr/bin/python3
+"""!
+@file el_fuzz.py
+@brief EchonetLiteのフレーム解析のファジング
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details シードのフレームを変異させて verifyPacket()/decode() (--target decode) か returner() (--target returner) に
+         プロセス内で直接入れる。新しい挙動を起こした入力をコーパスに加えて次の変異の元にする。
+         - 挙動の判定: 結果の特徴(検査結果, ESV, OPC, プロパティ数, 例外の型)。returnerの特徴は粗くし、細かい違いは行カバレッジで見る。
+           行カバレッジはPython 3.12以降のsys.monitoringで、速度はほぼ落ちない(--no-traceで使わない)。
+           それ以前は特徴だけで判定する。--traceでsys.settraceを使えるが、1入力ごとに全行で呼ばれるので数分の一の速さになる
+         - 実行速度は5秒ごとと終了時に、実際に測った値を表示する
+         - 例外が出た入力は、同じ例外(型と発生行)が出る範囲で最小化して回帰コーパス(fuzz_corpus/crash-*.bin)に保存する
+         - 1入力ごとの解析時間を測り、中央値より極端に遅く(--slow-factor)、かつ--slow-usを超える入力を fuzz_corpus/slow-*.bin に保存する
+         - --regress はコーパスの全入力を流して、例外か時間超過があれば終了コード1
+         例: python3 el_fuzz.py --seconds 60
+             python3 el_fuzz.py --target returner --seconds 30 --seed-pcap home.pcapng
+             python3 el_fuzz.py --regress
+"""
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ECHONET_Lite_AirConditioner'))
+
+from EchonetLite import EchonetLite
+from EchonetLite.Transport import MemoryNetwork, MemoryTransport
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fuzz_corpus')
+DEOJ_AIRCON = [0x01, 0x30, 0x01]
+SET_EPCS = [0x80, 0xB0, 0xB3]
+KNOWN_CLASSES = [0x0130, 0x0ef0]
+
+SEEDS = [
+    [0x10, 0x81, 0x00, 0x01, 0x05, 0xff, 0x01, 0x01, 0x30, 0x01, 0x62, 0x03, 0x80, 0x00, 0xb0, 0x00, 0xb3, 0x00], # GET
+    [0x10, 0x81, 0x00, 0x02, 0x05, 0xff, 0x01, 0x01, 0x30, 0x01, 0x61, 0x01, 0x80, 0x01, 0x30], # SETC
+    [0x10, 0x81, 0x00, 0x03, 0x05, 0xff, 0x01, 0x01, 0x30, 0x01, 0x60, 0x01, 0xb3, 0x01, 0x1a], # SETI
+    [0x10, 0x81, 0x00, 0x04, 0x05, 0xff, 0x01, 0x01, 0x30, 0x01, 0x63, 0x01, 0x80, 0x00], # INF_REQ
+    [0x10, 0x81, 0x00, 0x05, 0x05, 0xff, 0x01, 0x01, 0x30, 0x00, 0x62, 0x01, 0x80, 0x00], # GET インスタンス0
+    [0x10, 0x81, 0x00, 0x06, 0x05, 0xff, 0x01, 0x0e, 0xf0, 0x01, 0x62, 0x02, 0xd6, 0x00, 0x9f, 0x00], # GET ノードプロファイル
+    [0x10, 0x81, 0x00, 0x07, 0x05, 0xff, 0x01, 0x01, 0x30, 0x01, 0x6e, 0x01, 0x80, 0x01, 0x30, 0x01, 0xb3, 0x00], # SETGET
+    [0x10, 0x81, 0x00, 0x08, 0x01, 0x30, 0x01, 0x05, 0xff, 0x01, 0x72, 0x01, 0x80, 0x01, 0x30], # GET_RES
+    [0x10, 0x81, 0x00, 0x09, 0x01, 0x30, 0x01, 0x0e, 0xf0, 0x01, 0x73, 0x01, 0x80, 0x01, 0x30], # INF
+    [0x10, 0x81, 0x00, 0x0a, 0x01, 0x30, 0x01, 0x05, 0xff, 0x01, 0x74, 0x01, 0x80, 0x01, 0x30], # INFC
+    [0x10, 0x81, 0x00, 0x0b, 0x01, 0x30, 0x01, 0x05, 0xff, 0x01, 0x7e, 0x01, 0x80, 0x00, 0x01, 0xb3, 0x01, 0x1a], # SETGET_RES
+    [0x10, 0x81, 0x00, 0x0c, 0x01, 0x30, 0x01, 0x05, 0xff, 0x01, 0x52, 0x01, 0x80, 0x00], # GET_SNA
+]
+
+# returnerの特徴で区別するESV、それ以外はまとめる
+KNOWN_ESVS = (0x60, 0x61, 0x62, 0x63, 0x6e, 0x71, 0x72, 0x73, 0x74, 0x7a, 0x7e, 0x50, 0x51, 0x52, 0x53, 0x5e)
+
+INTERESTING = [0x00, 0x01, 0x02, 0x7f, 0x80, 0xfe, 0xff, 0x10, 0x81, 0x60, 0x61, 0x62, 0x63, 0x6e, 0x72, 0x73, 0x74, 0x7e]
+
+
+def makeDevice():
+    """!
+    @brief ファジング対象のエアコン相当のEchonetLiteを作る
+    @return EchonetLite
+    @note 返信は宛先がMemoryNetworkに参加していないので捨てられる
+    """
+    el = EchonetLite([DEOJ_AIRCON[:]], {'transport': MemoryTransport(MemoryNetwork()), 'mac': [0x02, 0, 0, 0, 0, 1], 'replyCache': 0})
+    for epc, edt in [[0x80, [0x30]], [0xB0, [0x41]], [0xB3, [0x19]]]:
+        el.devices['013001'].SetEDT(epc, edt)
+    el.devices['013001'].SetMyPropertyMap(0x9e, SET_EPCS[:])
+
+    def setFunc(ip, tid, seoj, deoj, esv, opc, epc, pdcedt):
+        if epc not in SET_EPCS: # ファームウェアと同じく受け付けるEPCだけ更新する
+            return False
+        el.update(deoj, epc, pdcedt.edt)
+        return True
+    el.userSetFunc = setFunc
+    return el
+
+
+def makeTarget(name, el):
+    """!
+    @brief 1入力を処理して挙動の特徴を返す関数を作る
+    @param name (str) 'decode' | 'returner'
+    @param el (EchonetLite)
+    @return function(list[int]) -> tuple
+    """
+    if name == 'decode':
+        def target(data):
+            if not el.verifyPacket(data, False):
+                return (0, len(data) < EchonetLite.MINIMUM_FRAME)
+            tid, seoj, deoj, esv, opc, details = el.decode(data)
+            return (1, esv, opc, len(details['SET']), len(details['GET']), len(details['INF']))
+    else:
+        def target(data):
+            el.returner('10.255.255.254', data)
+            if len(data) < 12:
+                return (len(data),)
+            known = (data[7] << 8 | data[8]) in KNOWN_CLASSES
+            esv = data[10] if data[10] in KNOWN_ESVS else 0
+            return (known, esv, min(data[11], 2)) # DEOJのクラス, ESV, OPC(0, 1, 複数)
+    return target
+
+
+class LineCoverage():
+    """!
+    @brief EchonetLiteパッケージの行カバレッジ
+    @details sys.monitoring(3.12以降)は一度通った行のイベントを止めるので、ほぼ速度が落ちない。
+             sys.settraceは全行で呼ばれるので遅い。
+    """
+    def __init__(self, enabled=True, useSettrace=False):
+        """!
+        @brief コンストラクタ
+        @param enabled (bool) Falseなら行カバレッジを取らない
+        @param useSettrace (bool) sys.monitoringが無い時にsys.settraceを使う(遅い)
+        """
+        self.lines = set()
+        self.new = 0
+        self.prefix = os.path.dirname(sys.modules[EchonetLite.__module__].__file__) # co_filenameと同じ表記
+        self.mode = None
+        if not enabled:
+            pass
+        elif hasattr(sys, 'monitoring'):
+            self.mode = 'monitoring'
+            mon = sys.monitoring
+            self.tool = mon.PROFILER_ID
+            mon.use_tool_id(self.tool, 'el_fuzz')
+            mon.register_callback(self.tool, mon.events.LINE, self._onLine)
+            mon.set_events(self.tool, mon.events.LINE)
+        elif useSettrace:
+            self.mode = 'settrace'
+            sys.settrace(self._globalTrace)
+
+    def _onLine(self, code, line):
+        """!
+        @brief sys.monitoringのLINEイベント、一度通ったら止める
+        """
+        if code.co_filename.startswith(self.prefix):
+            self.lines.add((code.co_filename, line))
+            self.new += 1
+        return sys.monitoring.DISABLE
+
+    def _globalTrace(self, frame, event, arg):
+        """!
+        @brief sys.settraceの関数呼び出し、EchonetLiteの中だけ行を追う
+        """
+        if frame.f_code.co_filename.startswith(self.prefix):
+            return self._localTrace
+        return None
+
+    def _localTrace(self, frame, event, arg):
+        """!
+        @brief sys.settraceの行イベント
+        """
+        if event == 'line':
+            key = (frame.f_code.co_filename, frame.f_lineno)
+            if key not in self.lines:
+                self.lines.add(key)
+                self.new += 1
+        return self._localTrace
+
+    def takeNew(self):
+        """!
+        @brief 前回から新しく通った行数を返してリセットする
+        @return int
+        """
+        n = self.new
+        self.new = 0
+        return n
+
+    def close(self):
+        """!
+        @brief 計測をやめる
+        """
+        if self.mode == 'monitoring':
+            sys.monitoring.set_events(self.tool, 0)
+            sys.monitoring.free_tool_id(self.tool)
+        elif self.mode == 'settrace':
+            sys.settrace(None)
+
+
+def crashSignature(error):
+    """!
+    @brief 例外の型と、発生した行(最も内側)
+    @return str
+    """
+    tb = error.__traceback__
+    if tb is None:
+        return type(error).__name__ + '@?'
+    while tb.tb_next is not None: # tracebackモジュールはソースを読みに行くので使わない
+        tb = tb.tb_next
+    return '{}@{}:{}'.format(type(error).__name__, os.path.basename(tb.tb_frame.f_code.co_filename), tb.tb_lineno)
+
+
+def runOne(target, data):
+    """!
+    @brief 1入力を処理して例外の種類を返す
+    @return str | None
+    """
+    try:
+        target(list(data))
+    except Exception as error:
+        return crashSignature(error)
+    return None
+
+
+def minimize(target, data, signature):
+    """!
+    @brief 同じ例外が出る範囲で入力を縮める
+    @details 半分から1byteまで塊を削り、最後に各byteを0に寄せる
+    @return list[int]
+    """
+    data = list(data)
+    changed = True
+    while changed:
+        changed = False
+        chunk = max(1, len(data) // 2)
+        while chunk >= 1:
+            i = 0
+            while i < len(data):
+                cand = data[:i] + data[i + chunk:]
+                if cand and runOne(target, cand) == signature:
+                    data = cand
+                    changed = True
+                else:
+                    i += chunk
+            chunk //= 2
+    for i in range(len(data)):
+        if data[i] != 0:
+            cand = data[:]
+            cand[i] = 0
+            if runOne(target, cand) == signature:
+                data = cand
+    return data
+
+
+def saveInput(kind, data, tag=''):
+    """!
+    @brief コーパスに保存する
+    @param kind (str) 'crash' | 'slow' | 'seed'
+    @return str ファイル名
+    """
+    if not os.path.isdir(CORPUS_DIR):
+        os.makedirs(CORPUS_DIR)
+    raw = bytes(data)
+    name = '{}-{}{}.bin'.format(kind, tag, hashlib.sha1(raw).hexdigest()[:12])
+    path = os.path.join(CORPUS_DIR, name)
+    with open(path, 'wb') as f:
+        f.write(raw)
+    return name
+
+def loadCorpus():
+    """!
+    @brief コーパスの全入力
+    @return list[(name, list[int])]
+    """
+    result = []
+    if os.path.isdir(CORPUS_DIR):
+        for name in sorted(os.listdir(CORPUS_DIR)):
+            if name.endswith('.bin'):
+                with open(os.path.join(CORPUS_DIR, name), 'rb') as f:
+                    result.append((name, list(f.read())))
+    return result
+
+
+class Fuzzer():
+    """!
+    @brief 変異と実行のループ
+    """
+    def __init__(self, target, seeds, coverage=None, maxLen=256, slowFactor=200.0, slowUs=1000.0, rng=None):
+        """!
+        @brief コンストラクタ
+        @param target makeTarget()の関数
+        @param seeds (list[list[int]])
+        @param coverage (LineCoverage | None)
+        @param maxLen (int) 入力の最大長
+        @param slowFactor (float) 中央値のこの倍より遅い入力を保存する
+        @param slowUs (float) かつ、この時間[us]より遅いもの
+        @param rng (random.Random)
+        """
+        self.target = target
+        self.corpus = [list(s) for s in seeds]
+        self.features = set()
+        self.coverage = coverage
+        self.maxLen = maxLen
+        self.slowFactor = slowFactor
+        self.slowNs = slowUs * 1000
+        self.rng = rng or random.Random()
+        self.execs = 0
+        self.crashes = {} # signature -> 最小化した入力
+        self.slow = [] # [ns, data]
+        self.samples = [] # 解析時間の標本 ns
+        self.median = 0
+
+    def mutate(self, data):
+        """!
+        @brief 1から4回の変異を加える
+        @param data (list[int]) 書き換えてよいコピー
+        @return list[int]
+        """
+        rng = self.rng
+        rand = rng.random
+        bits = rng.getrandbits
+        for _ in range(1 + bits(2)):
+            n = len(data)
+            op = bits(3)
+            if n == 0:
+                data.append(bits(8))
+            elif op == 0: # 1bit反転
+                data[int(rand() * n)] ^= 1 << bits(3)
+            elif op == 1: # 特徴的な値
+                data[int(rand() * n)] = INTERESTING[int(rand() * len(INTERESTING))]
+            elif op == 2: # OPCかPDCらしい位置を書き換え
+                i = 11 if n > 11 and bits(1) else int(rand() * n)
+                data[i] = (0, 1, 2, 3, 0xff, max(0, n - i - 2))[int(rand() * 6)]
+            elif op == 3: # 1byte挿入
+                if n < self.maxLen:
+                    data.insert(int(rand() * (n + 1)), bits(8))
+            elif op == 4: # 1byte削除
+                del data[int(rand() * n)]
+            elif op == 5: # 切り詰め
+                del data[int(rand() * n):]
+            elif op == 6: # 他の入力の後半をつなぐ
+                other = self.corpus[int(rand() * len(self.corpus))]
+                if other:
+                    data = data[:int(rand() * (n + 1))] + other[int(rand() * len(other)):]
+                    del data[self.maxLen:]
+            else: # ランダムな値
+                data[int(rand() * n)] = bits(8)
+        return data
+
+    def runOne(self, data):
+        """!
+        @brief 1入力を実行して、新しい挙動ならコーパスに加える
+        """
+        perf = time.perf_counter_ns
+        t = perf()
+        try:
+            feature = self.target(data) # 解析は入力を書き換えない
+        except Exception as error:
+            dt = perf() - t
+            self.execs += 1
+            sig = crashSignature(error)
+            if sig not in self.crashes:
+                small = minimize(self.target, data, sig)
+                self.crashes[sig] = small
+                print('# crash:', sig, bytes(small).hex(), '->', saveInput('crash', small))
+            return
+        dt = perf() - t
+        self.execs += 1
+        if self.execs & 0x3ff == 0:
+            self._updateMedian(dt)
+        elif self.median and dt > self.slowNs and dt > self.median * self.slowFactor:
+            self._recordSlow(data, dt)
+        if feature not in self.features:
+            self.features.add(feature)
+            self.corpus.append(data)
+        elif self.coverage is not None and self.coverage.new and self.coverage.takeNew():
+            self.corpus.append(data)
+
+    def _updateMedian(self, dt):
+        """!
+        @brief 解析時間の中央値を標本から更新する内部関数
+        """
+        self.samples.append(dt)
+        if len(self.samples) >= 64:
+            self.samples.sort()
+            self.median = self.samples[len(self.samples) // 2]
+            self.samples = self.samples[16:48] # 中央付近を残して次の標本と混ぜる
+
+    def _recordSlow(self, data, dt):
+        """!
+        @brief 遅い入力を記録する内部関数。GCやOSの揺らぎを除くため3回再実行した最小値で確かめる
+        """
+        again = dt
+        for _ in range(3):
+            t = time.perf_counter_ns()
+            runOne(self.target, data)
+            again = min(again, time.perf_counter_ns() - t)
+        if again > self.median * self.slowFactor and again > self.slowNs:
+            self.slow.append([again, data[:]])
+            print('# slow: {:.1f} us (median {:.2f} us)'.format(again / 1000.0, self.median / 1000.0), bytes(data).hex(),
+                  '->', saveInput('slow', data))
+
+    def run(self, seconds, maxExecs=0, reportEvery=5.0):
+        """!
+        @brief 時間か回数まで実行する
+        @return dict 統計
+        """
+        rand = self.rng.random
+        corpus = self.corpus
+        start = time.perf_counter()
+        nextReport = start + reportEvery
+        lastExecs = 0
+        while True:
+            for _ in range(1000):
+                self.runOne(self.mutate(corpus[int(rand() * len(corpus))][:]))
+            now = time.perf_counter()
+            if now >= nextReport:
+                print('# execs: {}, {:.0f}/s, corpus: {}, features: {}, crashes: {}, slow: {}'.format(
+                    self.execs, (self.execs - lastExecs) / (now - nextReport + reportEvery), len(corpus),
+                    len(self.features), len(self.crashes), len(self.slow)))
+                lastExecs = self.execs
+                nextReport = now + reportEvery
+            if now - start >= seconds or (maxExecs and self.execs >= maxExecs):
+                break
+        elapsed = time.perf_counter() - start
+        return {'execs': self.execs, 'elapsed_s': round(elapsed, 3), 'execs_per_s': round(self.execs / elapsed, 1),
+                'corpus': len(corpus), 'features': len(self.features), 'crashes': len(self.crashes),
+                'slow': len(self.slow), 'median_us': round(self.median / 1000.0, 3)}
+
+
+def regress(targets, limitUs):
+    """!
+    @brief コーパスの全入力を流して例外と時間超過を調べる
+    @param targets (dict) 名前 -> makeTarget()の関数
+    @param limitUs (float) 1入力あたりの上限[us]
+    @return bool 問題が無ければTrue
+    """
+    ok = True
+    corpus = loadCorpus()
+    for name, data in corpus:
+        for tname, target in targets.items():
+            t = time.perf_counter_ns()
+            sig = runOne(target, data)
+            us = (time.perf_counter_ns() - t) / 1000.0
+            if sig is not None:
+                print('FAIL {} {}: {} {}'.format(tname, name, sig, bytes(data).hex()))
+                ok = False
+            elif us > limitUs:
+                print('SLOW {} {}: {:.1f} us'.format(tname, name, us))
+                ok = False
+    print('# regress: {} inputs, {}'.format(len(corpus), 'ok' if ok else 'NG'))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='EchonetLite frame decoder fuzzer')
+    parser.add_argument('--target', choices=['decode', 'returner'], default='decode')
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--execs', type=int, default=0, help='この回数で止める')
+    parser.add_argument('--seed', type=int, default=None, help='乱数の種')
+    parser.add_argument('--seed-pcap', help='pcap/pcapngのフレームもシードにする')
+    parser.add_argument('--trace', action='store_true', help='sys.monitoringが無い時(3.11以前)にsys.settraceで行カバレッジを取る(遅い)')
+    parser.add_argument('--no-trace', action='store_true', help='行カバレッジを取らず、特徴だけで判定する')
+    parser.add_argument('--slow-factor', type=float, default=200.0, help='中央値のこの倍より遅い入力を保存する')
+    parser.add_argument('--slow-us', type=float, default=1000.0, help='かつ、この時間[us]より遅い入力を保存する')
+    parser.add_argument('--regress', action='store_true', help='コーパスを流して確認するだけ')
+    parser.add_argument('--limit-us', type=float, default=5000.0, help='--regressで1入力あたりの上限')
+    args = parser.parse_args()
+
+    el = makeDevice()
+    if args.regress:
+        targets = {'decode': makeTarget('decode', el), 'returner': makeTarget('returner', el)}
+        sys.exit(0 if regress(targets, args.limit_us) else 1)
+
+    seeds = [s[:] for s in SEEDS] + [d for _, d in loadCorpus()]
+    if args.seed_pcap:
+        from el_pcap import readUDP
+        for _, _, _, payload in readUDP(args.seed_pcap):
+            seeds.append(list(payload))
+    coverage = LineCoverage(not args.no_trace, args.trace)
+    if coverage.mode is None and not args.no_trace:
+        print('# warning: line coverage unavailable (no sys.monitoring before Python 3.12), guided by result features only; '
+              '--trace uses sys.settrace (slow)')
+    elif coverage.mode == 'settrace':
+        print('# coverage: sys.settrace (slow, several times fewer execs/s)')
+    fuzzer = Fuzzer(makeTarget(args.target, el), seeds, coverage if coverage.mode else None,
+                    slowFactor=args.slow_factor, slowUs=args.slow_us, rng=random.Random(args.seed))
+    try:
+        stats = fuzzer.run(args.seconds, args.execs)
+    except KeyboardInterrupt:
+        stats = None
+    coverage.close()
+    if stats:
+        stats['target'] = args.target
+        stats['coverage'] = coverage.mode or 'features'
+        stats['lines'] = len(coverage.lines)
+        print('# done:', ', '.join('{}={}'.format(k, v) for k, v in stats.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,478 @@
+#!/usr/bin/python3
+"""!
+@file el_pcap.py
+@brief ECHONET Liteのpcap/pcapngの読み書き
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details tcpdumpやWiresharkのキャプチャからUDP/3610のフレームを1パケットずつ取り出し、
+         returner()と同じ verifyPacket() と decode() で解析するジェネレータを提供する。
+         ファイルは先頭から順に読むだけなので、数GBのキャプチャでも使用メモリは一定。
+         PcapWriterはRecorderと同じrx()/tx()を持つので、EchonetLiteのoptions['recorder']に渡すと
+         recvOnce()とsend()/sendMulti()のフレームをそのままpcapに書き出せる。
+         対応リンク層: Ethernet(VLAN含む), Raw IP, Linux SLL/SLL2, BSD loopback。IPv4とIPv6(拡張ヘッダなし)のUDP。
+         例: python3 el_pcap.py decode home.pcapng --limit 20
+             python3 el_pcap.py stats home.pcapng
+             python3 el_pcap.py extract home.pcapng fixture.pcap --limit 1000
+             python3 el_pcap.py convert capture.elr capture.pcap --local 192.168.1.20
+"""
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ECHONET_Lite_AirConditioner'))
+
+from EchonetLite import EchonetLite
+from EchonetLite.Transport import MemoryNetwork, MemoryTransport
+from EchonetLite.Recorder import RX, readRecords
+
+ECHONET_PORT = 3610
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+DLT_RAW = [12, 14] # OSによってRaw IPの番号が違う
+
+PCAP_MAGIC_US = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER = 0x1a2b3c4d
+
+
+#=================================================================
+# 読み込み
+def _ipv4String(b):
+    """!
+    @brief 4byteをIPアドレス文字列にする内部関数
+    """
+    return '{}.{}.{}.{}'.format(b[0], b[1], b[2], b[3])
+
+def _ipv6String(b):
+    """!
+    @brief 16byteをIPv6アドレス文字列にする内部関数(省略表記はしない)
+    """
+    return ':'.join('{:x}'.format(w) for w in struct.unpack('!8H', b))
+
+def _udpFromIP(pkt, off):
+    """!
+    @brief IPパケットからUDPを取り出す内部関数
+    @param pkt (bytes) リンク層込みのパケット
+    @param off (int) IPヘッダの先頭
+    @return (src, dst, sport, dport, payload) | None
+    """
+    if len(pkt) < off + 1:
+        return None
+    version = pkt[off] >> 4
+    if version == 4:
+        if len(pkt) < off + 20:
+            return None
+        ihl = (pkt[off] & 0x0f) * 4
+        total = (pkt[off + 2] << 8) | pkt[off + 3]
+        frag = ((pkt[off + 6] << 8) | pkt[off + 7]) & 0x3fff # MFとフラグメントオフセット
+        if frag != 0 or pkt[off + 9] != 17: # 断片化されたものとUDP以外は扱わない
+            return None
+        src = _ipv4String(pkt[off + 12:off + 16])
+        dst = _ipv4String(pkt[off + 16:off + 20])
+        end = off + total if total else len(pkt)
+        udp = off + ihl
+    elif version == 6:
+        if len(pkt) < off + 40 or pkt[off + 6] != 17: # 拡張ヘッダは扱わない
+            return None
+        src = _ipv6String(pkt[off + 8:off + 24])
+        dst = _ipv6String(pkt[off + 24:off + 40])
+        end = off + 40 + ((pkt[off + 4] << 8) | pkt[off + 5])
+        udp = off + 40
+    else:
+        return None
+    if len(pkt) < udp + 8:
+        return None
+    sport, dport, ulen = struct.unpack_from('!HHH', pkt, udp)
+    end = min(end, udp + ulen, len(pkt))
+    return src, dst, sport, dport, pkt[udp + 8:end]
+
+def _udpFromLink(linktype, pkt):
+    """!
+    @brief リンク層のフレームからUDPを取り出す内部関数
+    @return (src, dst, sport, dport, payload) | None
+    """
+    if linktype == LINKTYPE_ETHERNET:
+        off = 12
+        ethertype = (pkt[off] << 8) | pkt[off + 1] if len(pkt) >= 14 else 0
+        while ethertype in (0x8100, 0x88a8) and len(pkt) >= off + 6: # VLANタグ
+            off += 4
+            ethertype = (pkt[off] << 8) | pkt[off + 1]
+        if ethertype != 0x0800 and ethertype != 0x86dd:
+            return None
+        return _udpFromIP(pkt, off + 2)
+    if linktype == LINKTYPE_RAW or linktype == LINKTYPE_IPV4 or linktype == LINKTYPE_IPV6 or linktype in DLT_RAW:
+        return _udpFromIP(pkt, 0)
+    if linktype == LINKTYPE_LINUX_SLL:
+        return _udpFromIP(pkt, 16)
+    if linktype == LINKTYPE_LINUX_SLL2:
+        return _udpFromIP(pkt, 20)
+    if linktype == LINKTYPE_NULL:
+        return _udpFromIP(pkt, 4)
+    return None
+
+
+def _readPcap(f, head):
+    """!
+    @brief pcapのパケットを読む内部ジェネレータ
+    @param f (file)
+    @param head (bytes) 読み済みのファイル先頭4byte
+    @return generator (ts, linktype, pkt)
+    """
+    rest = f.read(20)
+    if len(rest) < 20:
+        return
+    magic = struct.unpack('<I', head)[0]
+    if magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+        endian = '<'
+    else:
+        endian = '>'
+        magic = struct.unpack('>I', head)[0]
+    scale = 1e-9 if magic == PCAP_MAGIC_NS else 1e-6
+    linktype = struct.unpack(endian + 'I', rest[16:20])[0] & 0x0fffffff
+    rec = endian + 'IIII'
+    while True:
+        h = f.read(16)
+        if len(h) < 16:
+            return
+        sec, frac, incl, orig = struct.unpack(rec, h)
+        pkt = f.read(incl)
+        if len(pkt) < incl:
+            return # 書き込み途中で切れたパケット
+        yield sec + frac * scale, linktype, pkt
+
+def _tsScale(options, endian):
+    """!
+    @brief pcapngのIDBのオプションからタイムスタンプの単位を求める内部関数
+    """
+    scale = 1e-6
+    i = 0
+    while i + 4 <= len(options):
+        code, length = struct.unpack_from(endian + 'HH', options, i)
+        if code == 0:
+            break
+        if code == 9 and length >= 1: # if_tsresol
+            v = options[i + 4]
+            scale = 2.0 ** -(v & 0x7f) if v & 0x80 else 10.0 ** -v
+        i += 4 + ((length + 3) & ~3)
+    return scale
+
+def _readPcapng(f, head):
+    """!
+    @brief pcapngのパケットを読む内部ジェネレータ
+    @param f (file)
+    @param head (bytes) 読み済みのファイル先頭4byte(SHBのブロックタイプ)
+    @return generator (ts, linktype, pkt)
+    """
+    endian = '<'
+    interfaces = [] # [linktype, scale]
+    btype = PCAPNG_SHB
+    while True:
+        if btype == PCAPNG_SHB:
+            h = f.read(8) # block total length, byte-order magic
+            if len(h) < 8:
+                return
+            endian = '<' if struct.unpack('<I', h[4:8])[0] == PCAPNG_BYTE_ORDER else '>'
+            length = struct.unpack(endian + 'I', h[0:4])[0]
+            f.read(length - 12) # 残りは読み飛ばす
+            interfaces = [] # セクションごとにインタフェースは振り直し
+        else:
+            h = f.read(4)
+            if len(h) < 4:
+                return
+            length = struct.unpack(endian + 'I', h)[0]
+            body = f.read(length - 8)
+            if length < 12 or len(body) < length - 8:
+                return # 書き込み途中で切れたブロック
+            if btype == PCAPNG_IDB:
+                linktype = struct.unpack_from(endian + 'H', body, 0)[0]
+                interfaces.append([linktype, _tsScale(body[8:-4], endian)])
+            elif btype == PCAPNG_EPB:
+                iface, hi, lo, incl, orig = struct.unpack_from(endian + 'IIIII', body, 0)
+                if iface < len(interfaces):
+                    linktype, scale = interfaces[iface]
+                    yield ((hi << 32) | lo) * scale, linktype, body[20:20 + incl]
+            elif btype == PCAPNG_SPB:
+                if interfaces:
+                    orig = struct.unpack_from(endian + 'I', body, 0)[0]
+                    yield 0.0, interfaces[0][0], body[4:4 + orig]
+        h = f.read(4)
+        if len(h) < 4:
+            return
+        btype = struct.unpack(endian + 'I', h)[0]
+
+def readPackets(path):
+    """!
+    @brief pcapかpcapngから全パケットを順に読むジェネレータ
+    @param path (str | file) ファイル名か、バイナリ読み込みで開いたファイル
+    @return generator (ts, linktype, pkt) tsはUNIX時刻[s]
+    """
+    f = open(path, 'rb') if isinstance(path, str) else path
+    try:
+        head = f.read(4)
+        if len(head) < 4:
+            return
+        if struct.unpack('<I', head)[0] == PCAPNG_SHB:
+            yield from _readPcapng(f, head)
+        elif struct.unpack('<I', head)[0] in (PCAP_MAGIC_US, PCAP_MAGIC_NS) or struct.unpack('>I', head)[0] in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            yield from _readPcap(f, head)
+        else:
+            raise ValueError("readPackets: not a pcap/pcapng file")
+    finally:
+        if isinstance(path, str):
+            f.close()
+
+def readUDP(path, port=ECHONET_PORT):
+    """!
+    @brief キャプチャからECHONET LiteのUDPペイロードを取り出すジェネレータ
+    @param path (str | file)
+    @param port (int) 送信元か宛先がこのポートのものだけ
+    @return generator (ts, src, dst, payload)
+    """
+    for ts, linktype, pkt in readPackets(path):
+        try:
+            udp = _udpFromLink(linktype, pkt)
+        except (IndexError, struct.error):
+            continue # 途中で切れたパケット
+        if udp is None or (udp[2] != port and udp[3] != port):
+            continue
+        yield ts, udp[0], udp[1], udp[4]
+
+
+def newDecoder():
+    """!
+    @brief 解析用のEchonetLiteを作る。ネットワークには参加しない
+    @return EchonetLite
+    """
+    return EchonetLite(None, {'transport': MemoryTransport(MemoryNetwork()), 'mac': [0, 0, 0, 0, 0, 0]})
+
+def decodeFrames(path, decoder=None, port=ECHONET_PORT):
+    """!
+    @brief キャプチャのECHONET Liteフレームをreturner()と同じ手順で解析するジェネレータ
+    @param path (str | file)
+    @param decoder (EchonetLite) Noneなら newDecoder()
+    @param port (int)
+    @return generator dict ts, src, dst, data(bytes), ok と、okなら tid, seoj, deoj, esv, opc, details
+    @note 異常フレームも ok=False で返すので、ファザーやフィクスチャの元にできる
+    """
+    if decoder is None:
+        decoder = newDecoder()
+    for ts, src, dst, payload in readUDP(path, port):
+        frame = {'ts': ts, 'src': src, 'dst': dst, 'data': payload, 'ok': False}
+        data = list(payload)
+        try:
+            if decoder.verifyPacket(data, False):
+                frame['tid'], frame['seoj'], frame['deoj'], frame['esv'], frame['opc'], frame['details'] = decoder.decode(data)
+                frame['ok'] = True
+        except (IndexError, ValueError, TypeError) as error:
+            frame['error'] = '{}: {}'.format(type(error).__name__, error)
+        yield frame
+
+
+#=================================================================
+# 書き出し
+def _checksum(header):
+    """!
+    @brief IPv4ヘッダのチェックサムを求める内部関数
+    """
+    s = 0
+    for i in range(0, len(header), 2):
+        s += (header[i] << 8) | header[i + 1]
+    while s >> 16:
+        s = (s & 0xffff) + (s >> 16)
+    return (~s) & 0xffff
+
+def _ipv4Bytes(ip):
+    """!
+    @brief IPアドレス文字列を4byteにする内部関数
+    """
+    return bytes([int(p) for p in ip.split('.')])
+
+
+class PcapWriter():
+    """!
+    @brief UDP/3610のフレームをRaw IP(LINKTYPE_RAW)のpcapに書き出す
+    @note rx()/tx()を持つのでEchonetLiteのoptions['recorder']にそのまま渡せる
+    """
+    def __init__(self, f, localAddr='0.0.0.0', snaplen=65535):
+        """!
+        @brief コンストラクタ
+        @param f (str | file) ファイル名か、バイナリ書き込みで開いたファイル
+        @param localAddr (str) rx()/tx()で使う自分のアドレス
+        @param snaplen (int)
+        """
+        if isinstance(f, str):
+            f = open(f, 'wb')
+        self.f = f
+        self.localAddr = localAddr
+        self.count = 0
+        self.ident = 0
+        self.f.write(struct.pack('<IHHiIII', PCAP_MAGIC_US, 2, 4, 0, 0, snaplen, LINKTYPE_RAW))
+
+    def writePacket(self, ts, src, dst, payload, sport=ECHONET_PORT, dport=ECHONET_PORT):
+        """!
+        @brief 1パケット書き出す
+        @param ts (float) UNIX時刻[s]
+        @param src (str) 送信元IPv4
+        @param dst (str) 宛先IPv4
+        @param payload (bytes | list[int]) ECHONET Liteフレーム
+        @param sport (int)
+        @param dport (int)
+        """
+        payload = bytes(payload)
+        total = 28 + len(payload)
+        self.ident = (self.ident + 1) & 0xffff
+        ip = bytearray(struct.pack('!BBHHHBBH4s4s', 0x45, 0, total, self.ident, 0x4000, 64, 17, 0,
+                                   _ipv4Bytes(src), _ipv4Bytes(dst)))
+        struct.pack_into('!H', ip, 10, _checksum(ip))
+        udp = struct.pack('!HHHH', sport, dport, 8 + len(payload), 0) # IPv4ではUDPチェックサム0を許す
+        sec = int(ts)
+        self.f.write(struct.pack('<IIII', sec, int((ts - sec) * 1000000), total, total))
+        self.f.write(ip)
+        self.f.write(udp)
+        self.f.write(payload)
+        self.count += 1
+
+    def rx(self, ip, data):
+        """!
+        @brief 受信フレームを書き出す
+        @param ip (str) 送信元
+        @param data (bytes)
+        """
+        self.writePacket(time.time(), ip, self.localAddr, data)
+
+    def tx(self, ip, data):
+        """!
+        @brief 送信フレームを書き出す
+        @param ip (str) あて先
+        @param data (bytes)
+        """
+        self.writePacket(time.time(), self.localAddr, ip, data)
+
+    def flush(self):
+        """!
+        @brief ファイルに書き出す
+        """
+        self.f.flush()
+
+    def close(self):
+        """!
+        @brief ファイルを閉じる
+        """
+        self.f.close()
+
+
+#=================================================================
+# コマンド
+def _hex(v):
+    """!
+    @brief list[int]を16進文字列にする内部関数
+    """
+    return ''.join('{:02x}'.format(b) for b in v)
+
+def cmdDecode(args):
+    """!
+    @brief フレームを1行ずつ表示する
+    """
+    n = 0
+    for fr in decodeFrames(args.capture):
+        if args.limit and n >= args.limit:
+            break
+        n += 1
+        if not fr['ok']:
+            print('{:.6f} {} > {} DROP {} {}'.format(fr['ts'], fr['src'], fr['dst'], fr['data'].hex(), fr.get('error', '')))
+            continue
+        props = []
+        for kind in ['SET', 'GET', 'INF']:
+            for epc, pdcedt in fr['details'][kind].items():
+                props.append('{:02x}={}'.format(epc, _hex(pdcedt.edt)))
+        print('{:.6f} {} > {} tid={} {} > {} esv={:02x} {}'.format(
+            fr['ts'], fr['src'], fr['dst'], _hex(fr['tid']), _hex(fr['seoj']), _hex(fr['deoj']), fr['esv'], ' '.join(props)))
+
+def cmdStats(args):
+    """!
+    @brief ESVごとの件数と解析速度を表示する
+    """
+    esvs = {}
+    frames = 0
+    dropped = 0
+    start = time.perf_counter()
+    for fr in decodeFrames(args.capture):
+        frames += 1
+        if fr['ok']:
+            esvs[fr['esv']] = esvs.get(fr['esv'], 0) + 1
+        else:
+            dropped += 1
+    elapsed = time.perf_counter() - start
+    print('frames: {}, dropped: {}, elapsed: {:.3f} s, {:.1f} frames/s'.format(
+        frames, dropped, elapsed, frames / elapsed if elapsed > 0 else 0))
+    for esv in sorted(esvs):
+        print('  esv {:02x}: {}'.format(esv, esvs[esv]))
+
+def cmdExtract(args):
+    """!
+    @brief UDP/3610だけをRaw IPのpcapに抜き出す。IPv4のみ
+    """
+    w = PcapWriter(args.out)
+    for ts, src, dst, payload in readUDP(args.capture):
+        if args.limit and w.count >= args.limit:
+            break
+        if ':' in src:
+            continue
+        w.writePacket(ts, src, dst, payload)
+    w.close()
+    print('# extract: {} packets'.format(w.count))
+
+def cmdConvert(args):
+    """!
+    @brief Recorderのログをpcapに変換する
+    """
+    w = PcapWriter(args.out, args.local)
+    t0 = time.time()
+    for t_us, direction, ip, data in readRecords(args.log):
+        if direction == RX:
+            w.writePacket(t0 + t_us / 1000000.0, ip, args.local, data)
+        else:
+            w.writePacket(t0 + t_us / 1000000.0, args.local, ip, data)
+    w.close()
+    print('# convert: {} packets'.format(w.count))
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='ECHONET Lite pcap/pcapng tool')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+    p = sub.add_parser('decode', help='フレームを解析して表示する')
+    p.add_argument('capture')
+    p.add_argument('--limit', type=int, default=0)
+    p.set_defaults(func=cmdDecode)
+    p = sub.add_parser('stats', help='ESVごとの件数と解析速度')
+    p.add_argument('capture')
+    p.set_defaults(func=cmdStats)
+    p = sub.add_parser('extract', help='UDP/3610だけを抜き出してpcapにする')
+    p.add_argument('capture')
+    p.add_argument('out')
+    p.add_argument('--limit', type=int, default=0)
+    p.set_defaults(func=cmdExtract)
+    p = sub.add_parser('convert', help='Recorderのログをpcapにする')
+    p.add_argument('log')
+    p.add_argument('out')
+    p.add_argument('--local', default='0.0.0.0', help='記録した機器のアドレス')
+    p.set_defaults(func=cmdConvert)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+"""!
+@file el_replay.py
+@brief Recorderで記録したECHONET Liteフレームを再生する
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details 記録したログを returner() か UDP socket に、記録どおりの間隔(1x)、N倍速、最高速で流す。
+         - returner: 仮想機器(device_farmのプロファイル)のreturner()に直接入れる。返信はMemoryNetworkで捨てる
+         - udp: 記録したフレームをそのまま --to のアドレスの3610番へ送る
+         例: python3 el_replay.py capture.elr --target returner --profile aircon --speed 0
+             python3 el_replay.py capture.elr --target udp --to 192.168.1.20 --speed 2
+             python3 el_replay.py capture.elr --dump
+"""
+import argparse
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from device_farm import VirtualNode, compileProfile, PROFILES
+from EchonetLite import EchonetLite
+from EchonetLite.Transport import MemoryNetwork
+from EchonetLite.Recorder import RX, TX, readRecords
+
+
+class Pacer():
+    """!
+    @brief 記録時刻に合わせて待つ
+    """
+    def __init__(self, speed):
+        """!
+        @brief コンストラクタ
+        @param speed (float) 再生速度、0なら待たない
+        """
+        self.speed = speed
+        self.start = None
+
+    def wait(self, t_us):
+        """!
+        @brief 記録開始から t_us のフレームを流す時刻まで待つ
+        @param t_us (int)
+        """
+        if self.speed <= 0:
+            return
+        now = time.perf_counter()
+        if self.start is None:
+            self.start = now - t_us / 1000000.0 / self.speed
+            return
+        delay = self.start + t_us / 1000000.0 / self.speed - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def selectRecords(path, directions):
+    """!
+    @brief 方向で絞り込んだレコードのジェネレータ
+    @param path (str)
+    @param directions (list[int]) RX, TX
+    """
+    for rec in readRecords(path):
+        if rec[1] in directions:
+            yield rec
+
+
+def replayReturner(records, speed, profile):
+    """!
+    @brief returner()に流す
+    @return dict 統計
+    """
+    net = MemoryNetwork()
+    node = VirtualNode(1, profile, '10.0.0.1', compileProfile(PROFILES[profile]), net=net)
+    el = node.el
+    el.userSetFunc = node.userSetFunc # begin()しないのでここで設定する
+    pacer = Pacer(speed)
+    frames = 0
+    errors = 0
+    start = time.perf_counter()
+    for t_us, direction, ip, data in records:
+        pacer.wait(t_us)
+        try:
+            el.returner(ip, list(data))
+        except Exception as error:
+            errors += 1
+            print("# replay exception:", type(error).__name__, error, data.hex())
+        frames += 1
+    elapsed = time.perf_counter() - start
+    return {'frames': frames, 'exceptions': errors, 'elapsed_s': elapsed}
+
+
+def replayUDP(records, speed, to, multicast):
+    """!
+    @brief UDP socketに流す
+    @return dict 統計
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    pacer = Pacer(speed)
+    frames = 0
+    start = time.perf_counter()
+    for t_us, direction, ip, data in records:
+        pacer.wait(t_us)
+        if multicast:
+            sock.sendto(data, (EchonetLite.MULTICAST_GROUP, EchonetLite.ECHONETport))
+        else:
+            sock.sendto(data, (to, EchonetLite.ECHONETport))
+        frames += 1
+    sock.close()
+    elapsed = time.perf_counter() - start
+    return {'frames': frames, 'elapsed_s': elapsed}
+
+
+def dump(records):
+    """!
+    @brief ログの内容を表示する
+    """
+    for t_us, direction, ip, data in records:
+        print('{:12.6f} {} {:15s} {}'.format(t_us / 1000000.0, chr(direction), ip, data.hex()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ECHONET Lite traffic replayer')
+    parser.add_argument('log', help='Recorderのログファイル')
+    parser.add_argument('--target', choices=['returner', 'udp'], default='returner')
+    parser.add_argument('--speed', type=float, default=1.0, help='再生速度、1=記録どおり、0=最高速')
+    parser.add_argument('--direction', choices=['rx', 'tx', 'all'], default='rx', help='再生するフレームの方向')
+    parser.add_argument('--profile', choices=sorted(PROFILES.keys()), default='aircon', help='returnerに使う機器')
+    parser.add_argument('--to', default='127.0.0.1', help='udpの送り先')
+    parser.add_argument('--multicast', action='store_true', help='udpをマルチキャストで送る')
+    parser.add_argument('--loops', type=int, default=1, help='繰り返し回数')
+    parser.add_argument('--dump', action='store_true', help='再生せずに内容を表示する')
+    args = parser.parse_args()
+
+    directions = {'rx': [RX], 'tx': [TX], 'all': [RX, TX]}[args.direction]
+    if args.dump:
+        dump(selectRecords(args.log, directions))
+        return
+    for _ in range(args.loops):
+        records = selectRecords(args.log, directions)
+        if args.target == 'returner':
+            stats = replayReturner(records, args.speed, args.profile)
+        else:
+            stats = replayUDP(records, args.speed, args.to, args.multicast)
+        fps = stats['frames'] / stats['elapsed_s'] if stats['elapsed_s'] > 0 else 0
+        stats['fps'] = round(fps, 1)
+        print('# replay:', ', '.join('{}={}'.format(k, round(v, 3) if isinstance(v, float) else v) for k, v in stats.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+"""!
+@file el_rtt_bench.py
+@brief ループバックUDPでのECHONET Lite往復遅延ベンチマーク
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details エアコンのプロファイルを持つ機器インスタンスを別プロセスで127.0.0.2に起動し、
+         コントローラのインスタンスからGET/SETC/INF_REQを指定の同時実行数と送信レートで送り、
+         往復遅延のp50/p95/p99/p99.9と損失率を出す。
+         機器側はrecvOnce()を回し続けるビジーループ(--device-loop busy)か、
+         ファームウェアと同じEventLoop(--device-loop event)で動かせる。Linux用。
+         例: python3 el_rtt_bench.py --workload get,setc,infreq --concurrency 4 --rate 500 --count 5000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from device_farm import VirtualNode, compileProfile, PROFILES
+from EchonetLite import EchonetLite, PDCEDT
+from EchonetLite.EventLoop import EventLoop
+
+DEOJ_AIRCON = [0x01, 0x30, 0x01]
+
+# ワークロード: [ESV, details, 正常応答ESV, 不可応答ESV]
+WORKLOADS = {
+    'get': [EchonetLite.GET, {0x80: [0], 0xB0: [0], 0xB3: [0]}, EchonetLite.GET_RES, EchonetLite.GET_SNA],
+    'setc': [EchonetLite.SETC, {0xB3: [1, 0x1A]}, EchonetLite.SET_RES, EchonetLite.SETC_SNA],
+    'infreq': [EchonetLite.INF_REQ, {0x80: [0]}, EchonetLite.INF, EchonetLite.INF_SNA],
+}
+
+
+def deviceMain(ip, mode, ready):
+    """!
+    @brief 機器プロセス
+    @param ip (str) bindするアドレス
+    @param mode (str) 'busy' = recvOnce()のループ, 'event' = EventLoop
+    @param ready (multiprocessing.Event) 起動完了の通知
+    """
+    node = VirtualNode(1, 'aircon', ip, compileProfile(PROFILES['aircon']))
+    node.el.update(DEOJ_AIRCON, 0x80, [0x30]) # SETCを受け付けるように電源ON
+    node.el.begin(node.userSetFunc, node.userNopFunc, node.userNopFunc)
+    ready.set()
+    if mode == 'busy':
+        while True:
+            node.el.recvOnce()
+    else:
+        loop = EventLoop()
+        node.el.attach(loop)
+        loop.runForever()
+
+
+def percentile(sorted_values, p):
+    """!
+    @brief 最近傍順位法によるパーセンタイル
+    @param sorted_values (list) 昇順に並べた値
+    @param p (float) 0-100
+    @return float | None
+    """
+    if not sorted_values:
+        return None
+    k = int(len(sorted_values) * p / 100.0 + 0.999999) - 1
+    k = max(0, min(len(sorted_values) - 1, k))
+    return sorted_values[k]
+
+
+class Controller():
+    """!
+    @brief 要求を送って応答を待つコントローラ
+    """
+    def __init__(self, device_ip, workloads, concurrency, rate, count, timeout_ms, mcast_if='127.0.0.1'):
+        """!
+        @brief コンストラクタ
+        @param device_ip (str)
+        @param workloads (list[str]) WORKLOADSのキー、順番に繰り返す
+        @param concurrency (int) 同時に応答待ちにする要求数
+        @param rate (float) 毎秒の送信数、0なら同時実行数だけで制限する
+        @param count (int) 送信する要求の総数
+        @param timeout_ms (int) これを過ぎた要求は損失とみなす
+        @param mcast_if (str) INF_REQの応答(マルチキャスト)を受けるインタフェース
+        """
+        self.device_ip = device_ip
+        self.workloads = workloads
+        self.concurrency = concurrency
+        self.interval_ms = 1000.0 / rate if rate > 0 else 0
+        self.count = count
+        self.timeout_ms = timeout_ms
+        self.loop = EventLoop()
+        self.el = EchonetLite(None)
+        self.el.begin(None, None, self.onResponse)
+        # INF_REQの応答はマルチキャストなのでループバックでも受けられるように参加する
+        mreq = struct.pack('4s4s', socket.inet_aton(EchonetLite.MULTICAST_GROUP), socket.inet_aton(mcast_if))
+        self.el.rsock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        self.el.attach(self.loop)
+        self.pending = {} # tid -> [送信時刻, 正常ESV, 不可ESV, タイマ, 種類]
+        self.sent = 0
+        self.latencies = {}
+        self.sna = {}
+        self.lost = {}
+        for w in workloads:
+            self.latencies[w] = []
+            self.sna[w] = 0
+            self.lost[w] = 0
+        self.next_send = 0
+
+    def onResponse(self, ip, tid, seoj, deoj, esv, opc, epc, pdcedt):
+        """!
+        @brief 応答受信、EchonetLiteのINF系コールバック
+        """
+        t = self.loop.now()
+        key = (tid[0] << 8) | tid[1]
+        entry = self.pending.get(key)
+        if entry is None or (esv != entry[1] and esv != entry[2]):
+            return True # 別の通知や、遅れて届いた応答
+        del self.pending[key]
+        self.loop.cancel(entry[3])
+        if esv == entry[1]:
+            self.latencies[entry[4]].append(t - entry[0])
+        else:
+            self.sna[entry[4]] += 1
+        self.pump()
+        return True
+
+    def onTimeout(self, key):
+        """!
+        @brief 応答が来なかった要求を損失として数える
+        """
+        entry = self.pending.pop(key, None)
+        if entry is not None:
+            self.lost[entry[4]] += 1
+        self.pump()
+
+    def sendOne(self):
+        """!
+        @brief 要求を一つ送る
+        """
+        kind = self.workloads[self.sent % len(self.workloads)]
+        esv, details, ok_esv, sna_esv = WORKLOADS[kind]
+        key = self.sent & 0xffff
+        tid = [key >> 8, key & 0xff]
+        pdcedts = {}
+        for epc in details:
+            pdcedts[epc] = PDCEDT(details[epc])
+        timer = self.loop.callLater(self.timeout_ms, self.onTimeout, key)
+        self.pending[key] = [self.loop.now(), ok_esv, sna_esv, timer, kind]
+        self.sent += 1
+        self.el.sendDetails(self.device_ip, tid, EchonetLite.EOJ_Controller, DEOJ_AIRCON, esv, len(pdcedts), pdcedts)
+
+    def pump(self):
+        """!
+        @brief 同時実行数とレートの範囲で送れるだけ送る
+        """
+        while self.sent < self.count and len(self.pending) < self.concurrency:
+            if self.interval_ms > 0:
+                wait = self.next_send - self.loop.now()
+                if wait > 0:
+                    self.loop.callLater(wait, self.pump)
+                    return
+                self.next_send = max(self.next_send, self.loop.now() - self.interval_ms) + self.interval_ms
+            self.sendOne()
+        if self.sent >= self.count and not self.pending:
+            self.loop.stop()
+
+    def run(self):
+        """!
+        @brief 全要求を送り終えて応答か時間切れを待つまで実行する
+        @return float 所要時間[s]
+        """
+        start = time.time()
+        self.next_send = self.loop.now()
+        self.loop.callLater(0, self.pump)
+        self.loop.runForever()
+        return time.time() - start
+
+    def report(self, elapsed):
+        """!
+        @brief 結果をまとめる
+        @param elapsed (float) 所要時間[s]
+        @return dict
+        """
+        result = {'elapsed_s': round(elapsed, 3), 'sent': self.sent, 'workloads': {}}
+        for kind in self.workloads:
+            lat = sorted(self.latencies[kind])
+            n = len(lat) + self.sna[kind] + self.lost[kind]
+            r = {'requests': n, 'ok': len(lat), 'sna': self.sna[kind], 'lost': self.lost[kind],
+                 'loss_rate': round(self.lost[kind] / n, 6) if n else 0}
+            for name, p in [['p50', 50], ['p95', 95], ['p99', 99], ['p99.9', 99.9]]:
+                v = percentile(lat, p)
+                r[name + '_ms'] = round(v, 4) if v is not None else None
+            result['workloads'][kind] = r
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ECHONET Lite round-trip latency benchmark over loopback UDP')
+    parser.add_argument('--workload', default='get,setc,infreq', help='get, setc, infreq をカンマ区切りで')
+    parser.add_argument('--concurrency', type=int, default=1, help='同時に応答待ちにする要求数')
+    parser.add_argument('--rate', type=float, default=0, help='毎秒の送信数、0なら制限なし')
+    parser.add_argument('--count', type=int, default=3000, help='送信する要求の総数')
+    parser.add_argument('--timeout-ms', type=int, default=1000, help='これを過ぎた要求は損失とみなす')
+    parser.add_argument('--device-ip', default='127.0.0.2', help='機器インスタンスのアドレス')
+    parser.add_argument('--device-loop', choices=['busy', 'event'], default='busy', help='機器の受信方式')
+    parser.add_argument('--json', action='store_true', help='JSONで出力する')
+    args = parser.parse_args()
+
+    workloads = [w.strip() for w in args.workload.split(',') if w.strip()]
+    for w in workloads:
+        if w not in WORKLOADS:
+            parser.error('unknown workload: ' + w)
+
+    ready = multiprocessing.Event()
+    device = multiprocessing.Process(target=deviceMain, args=(args.device_ip, args.device_loop, ready), daemon=True)
+    device.start()
+    try:
+        if not ready.wait(10):
+            print('device did not start')
+            sys.exit(1)
+        time.sleep(0.2) # 起動時のINF通知をやり過ごす
+        ctl = Controller(args.device_ip, workloads, args.concurrency, args.rate, args.count, args.timeout_ms)
+        result = ctl.report(ctl.run())
+    finally:
+        device.terminate()
+        device.join()
+
+    result['device_loop'] = args.device_loop
+    result['concurrency'] = args.concurrency
+    result['rate'] = args.rate
+    if args.json:
+        print(json.dumps(result, indent=1))
+        return
+    print('device loop: {}, concurrency: {}, rate: {}, elapsed: {} s'.format(
+        args.device_loop, args.concurrency, args.rate or 'max', result['elapsed_s']))
+    print('{:8s} {:>8s} {:>6s} {:>6s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s}'.format(
+        'workload', 'ok', 'sna', 'lost', 'loss', 'p50[ms]', 'p95[ms]', 'p99[ms]', 'p99.9[ms]'))
+    for kind in workloads:
+        r = result['workloads'][kind]
+        print('{:8s} {:8d} {:6d} {:6d} {:9.4f} {:>9} {:>9} {:>9} {:>9}'.format(
+            kind, r['ok'], r['sna'], r['lost'], r['loss_rate'],
+            r['p50_ms'], r['p95_ms'], r['p99_ms'], r['p99.9_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+"""!
+@file el_startup_bench.py
+@brief EchonetLiteの起動時間のベンチマーク
+@author SUGIMURA Hiroshi, Kanagawa Institute of Technology
+@date 2023年度
+@details 起動直後の状態から import EchonetLite、コンストラクタ、begin() にかかる時間と、
+         読み込まれたモジュールの数、(MicroPythonでは)ヒープの使用量を測る。
+         Wi-Fiのリセットのたびに再起動するので、起動の遅れがそのまま復帰の遅れになる。
+         MemoryTransportを使うのでネットワークは不要。結果はJSONで出力する。
+         - PC: 毎回新しいプロセスで測り、中央値を取る
+           python3 el_startup_bench.py --out result.json --baseline base.json
+         - ESP32: mpremote run el_startup_bench.py > esp32.json (mpremoteがソフトリセットしてから実行する)
+           python3 el_startup_bench.py --compare esp32.json --baseline esp32_base.json
+"""
+import sys
+import time
+import gc
+import json
+
+MICROPYTHON = sys.implementation.name == 'micropython'
+
+if not MICROPYTHON:
+    import os
+    FIRMWARE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ECHONET_Lite_AirConditioner')
+
+DEOJ_AIRCON = [0x01, 0x30, 0x01]
+PHASES = ['import', 'construct', 'begin']
+
+
+def now_us():
+    """!
+    @brief マイクロ秒の時刻
+    @return int|float
+    """
+    if MICROPYTHON:
+        return time.ticks_us()
+    return time.perf_counter() * 1000000
+
+def elapsed_us(start):
+    """!
+    @brief startからの経過マイクロ秒
+    @return int|float
+    """
+    if MICROPYTHON:
+        return time.ticks_diff(time.ticks_us(), start)
+    return time.perf_counter() * 1000000 - start
+
+
+def measure():
+    """!
+    @brief このプロセスで一度だけ起動を測る。EchonetLiteがまだimportされていないこと
+    @return dict
+    """
+    modules = len(sys.modules)
+    gc.collect()
+    mem = gc.mem_alloc() if MICROPYTHON else 0
+    start = now_us()
+    from EchonetLite import EchonetLite
+    from EchonetLite.Transport import MemoryNetwork, MemoryTransport
+    t_import = elapsed_us(start)
+
+    start = now_us()
+    el = EchonetLite([DEOJ_AIRCON[:]], {'transport': MemoryTransport(MemoryNetwork()), 'mac': [0x02, 0, 0, 0, 0, 1]})
+    t_construct = elapsed_us(start)
+
+    start = now_us()
+    el.begin(lambda ip, tid, seoj, deoj, esv, opc, epc, pdcedt: True)
+    t_begin = elapsed_us(start)
+
+    result = {
+        'import': round(t_import),
+        'construct': round(t_construct),
+        'begin': round(t_begin),
+        'modules': len(sys.modules) - modules,
+    }
+    if MICROPYTHON:
+        gc.collect()
+        result['heap_bytes'] = gc.mem_alloc() - mem
+    return result
+
+
+def run(n):
+    """!
+    @brief 新しいプロセスでn回測って中央値を取る
+    @param n (int) 回数
+    @return dict
+    """
+    import subprocess
+    samples = []
+    for _ in range(n):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child'], cwd=FIRMWARE_DIR,
+                             check=True, stdout=subprocess.PIPE).stdout
+        samples.append(json.loads(out.decode()))
+    results = []
+    for name in PHASES:
+        values = sorted(s[name] for s in samples)
+        results.append({'name': name, 'us': values[len(values) // 2], 'min_us': values[0], 'max_us': values[-1]})
+    return {
+        'implementation': sys.implementation.name,
+        'platform': sys.platform,
+        'version': sys.version.split(' ')[0],
+        'runs': n,
+        'modules': samples[-1]['modules'],
+        'results': results,
+    }
+
+
+def single():
+    """!
+    @brief 一回だけ測ってrun()と同じ形にする(MicroPython用)
+    @return dict
+    """
+    r = measure()
+    result = {
+        'implementation': sys.implementation.name,
+        'platform': sys.platform,
+        'version': sys.version.split(' ')[0],
+        'runs': 1,
+        'modules': r['modules'],
+        'results': [{'name': name, 'us': r[name], 'min_us': r[name], 'max_us': r[name]} for name in PHASES],
+    }
+    if 'heap_bytes' in r:
+        result['heap_bytes'] = r['heap_bytes']
+    return result
+
+
+def compare(current, baseline, threshold):
+    """!
+    @brief ベースラインと比較して表示する
+    @param current (dict) run()の結果
+    @param baseline (dict) run()の結果
+    @param threshold (float) この割合以上遅くなったら劣化とみなす
+    @return bool 劣化が無ければTrue
+    """
+    base = {}
+    for r in baseline['results']:
+        base[r['name']] = r
+    ok = True
+    print('{:12s} {:>12s} {:>12s} {:>8s}'.format('phase', 'us', 'base us', 'ratio'))
+    total = base_total = 0
+    for r in current['results']:
+        b = base.get(r['name'])
+        total += r['us']
+        if b is None or b['us'] == 0:
+            print('{:12s} {:12d} {:>12s}'.format(r['name'], r['us'], '-'))
+            continue
+        base_total += b['us']
+        ratio = r['us'] / b['us']
+        mark = ''
+        if ratio > 1.0 + threshold:
+            mark = ' REGRESSION'
+            ok = False
+        print('{:12s} {:12d} {:12d} {:8.2f}{}'.format(r['name'], r['us'], b['us'], ratio, mark))
+    if base_total:
+        print('{:12s} {:12d} {:12d} {:8.2f}'.format('total', total, base_total, total / base_total))
+    print('modules: {} (base {})'.format(current.get('modules'), baseline.get('modules')))
+    return ok
+
+
+def main():
+    if MICROPYTHON:
+        # mpremote run では引数を渡せないので一回だけ測ってJSONだけ出力する
+        print(json.dumps(single()))
+        return
+
+    import argparse
+    parser = argparse.ArgumentParser(description='EchonetLite startup benchmark')
+    parser.add_argument('-n', type=int, default=20, help='測る回数(毎回新しいプロセス)')
+    parser.add_argument('--out', help='結果をJSONで保存するファイル')
+    parser.add_argument('--baseline', help='比較するベースラインのJSON')
+    parser.add_argument('--compare', help='実行せずに、このJSON(ESP32の結果など)をベースラインと比較する')
+    parser.add_argument('--threshold', type=float, default=0.20, help='劣化とみなす割合')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, FIRMWARE_DIR)
+        print(json.dumps(measure()))
+        return
+
+    if args.compare:
+        with open(args.compare) as f:
+            current = json.load(f)
+    else:
+        current = run(args.n)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(current, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(current, baseline, args.threshold):
+            sys.exit(1)
+    elif not args.out:
+        print(json.dumps(current, indent=1))
+
+
+if __name__ == '__main__':
+    main()